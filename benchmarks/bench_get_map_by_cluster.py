@@ -0,0 +1,85 @@
+# Benchmark of label propagation through the hierarchy (HSNE.get_map_by_cluster)
+# Run with: python benchmarks/bench_get_map_by_cluster.py
+import time
+import numpy as np
+from scipy.sparse import csc_matrix, csr_matrix, lil_matrix, identity
+from schnel.clustering.HSNE import HSNE, SubScale
+
+
+def legacy_get_map_by_cluster(hsne, scalenumber, clustering):
+    """
+    Column by column propagation with a lil_matrix, as implemented before the one-hot indicator product.
+
+    :param hsne: HSNE object
+    :param scalenumber: scale to create map at
+    :param clustering: membership results of clustering
+    :return: map between data and cluster assignment
+    """
+    for scale in hsne.scales[scalenumber:0:-1]:
+        new_aoi = lil_matrix((scale.area_of_influence.shape[0],
+                              len(set(clustering))))
+        for i, label in enumerate(np.unique(clustering)):
+            new_aoi[:, i] = scale.area_of_influence * [[1] if label == x else [0] for x in clustering]
+        clustering = csc_matrix(new_aoi).argmax(axis=1).A1
+    return clustering
+
+
+def synthetic_hierarchy(sizes, landmarks_per_point=4, seed=0):
+    """
+    Build a HSNE object whose subscales have random areas of influence.
+
+    :param sizes: number of points per scale, starting with the data scale
+    :param landmarks_per_point: number of landmarks influencing every point of the previous scale
+    :param seed: seed of the random generator
+    :return: HSNE object
+    """
+    rng = np.random.default_rng(seed)
+    hsne = HSNE(len(sizes))
+    for i in range(1, len(sizes)):
+        previous, size = sizes[i - 1], sizes[i]
+        cols = rng.integers(0, size, size=(previous, landmarks_per_point)).ravel()
+        rows = np.repeat(np.arange(previous), landmarks_per_point)
+        weights = rng.random(len(cols)).astype(np.float32)
+        aoi = csr_matrix((weights, (rows, cols)), shape=(previous, previous))
+        lm = np.sort(rng.choice(previous, size, replace=False)).astype(np.int32)
+        hsne[i] = SubScale(scalenum=i, num_scales=len(sizes), tmatrix=identity(size, format='csr'),
+                           lm_to_original=lm, lm_to_previous=lm, lm_weights=np.ones(size, dtype=np.float32),
+                           previous_to_current=np.full(previous, -1, dtype=np.int32), area_of_influence=aoi)
+    return hsne
+
+
+def run(sizes=(20000, 4000, 800), label_counts=(2, 10, 50, 200, 800), repeats=3):
+    """
+    Time the legacy and the vectorized propagation from the top scale for a range of label counts.
+
+    :param sizes: number of points per scale, starting with the data scale
+    :param label_counts: numbers of distinct labels on the top scale
+    :param repeats: number of timings per implementation, the best one is reported
+    :return: list of dicts with the timings in seconds
+    """
+    hsne = synthetic_hierarchy(sizes)
+    top = len(sizes) - 1
+    rng = np.random.default_rng(1)
+    results = []
+    for num_labels in label_counts:
+        clustering = rng.integers(0, num_labels, size=sizes[top]).tolist()
+        timings = {}
+        for name, func in (('legacy', legacy_get_map_by_cluster), ('vectorized', HSNE.get_map_by_cluster)):
+            best = float('inf')
+            for _ in range(repeats):
+                tic = time.perf_counter()
+                labels = func(hsne, top, clustering)
+                best = min(best, time.perf_counter() - tic)
+            timings[name] = (best, labels)
+        if not np.array_equal(timings['legacy'][1], timings['vectorized'][1]):
+            raise AssertionError("Implementations disagree for %i labels" % num_labels)
+        results.append({'labels': num_labels, 'legacy': timings['legacy'][0],
+                        'vectorized': timings['vectorized'][0]})
+    return results
+
+
+if __name__ == "__main__":
+    print("%8s %12s %12s %9s" % ("labels", "legacy (s)", "vector (s)", "speedup"))
+    for res in run():
+        print("%8i %12.4f %12.4f %8.1fx" % (res['labels'], res['legacy'], res['vectorized'],
+                                            res['legacy'] / res['vectorized']))
@@ -0,0 +1,92 @@
+# Benchmark of the k nearest neighbour backends of clustering.knn: recall against the exact graph versus time
+# Run with: python benchmarks/bench_knn.py [number of synthetic points, default 1000000]
+import sys
+import time
+import numpy as np
+from schnel.clustering.knn import KNN_METHODS, exact_knn, knn_graph
+
+
+def gaussian_mixture(num_points, num_features=30, num_clusters=20, seed=0):
+    """
+    Mixture of isotropic Gaussians with random centers.
+
+    :param num_points: number of points
+    :param num_features: number of features
+    :param num_clusters: number of mixture components
+    :param seed: seed of the random generator
+    :return: float32 array
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(-10, 10, size=(num_clusters, num_features)).astype(np.float32)
+    data = rng.standard_normal((num_points, num_features), dtype=np.float32)
+    data += centers[rng.integers(0, num_clusters, size=num_points)]
+    return data
+
+
+def mnist():
+    """
+    The bundled MNIST sample reduced to 50 principal components, None if the images are not available.
+
+    :return: float32 array or None
+    """
+    try:
+        from schnel.Data_Prep.load_data import load_mnist
+        from schnel.Data_Prep.pca import pca
+        images, _ = load_mnist()
+    except (ImportError, OSError):
+        return None
+    return pca(images.astype(np.float32), 50)
+
+
+def recall(indices, reference):
+    """
+    Fraction of the exact neighbours found, the point itself excluded.
+
+    :param indices: neighbours of the query points
+    :param reference: exact neighbours of the same points
+    :return: float
+    """
+    found = [len(np.intersect1d(row[1:], ref[1:])) for row, ref in zip(indices, reference)]
+    return float(np.sum(found)) / reference[:, 1:].size
+
+
+def run(data, num_neighbours=30, methods=KNN_METHODS, num_queries=1000, exact_limit=200000, seed=0):
+    """
+    Time every backend on the full data set and measure its recall on a sample of query points.
+
+    :param data: float32 array
+    :param num_neighbours: number of neighbours per point
+    :param methods: backends to compare, unavailable ones are skipped
+    :param num_queries: number of points the recall is measured on
+    :param exact_limit: largest data set on which the exact backend is timed in full
+    :param seed: seed of the query sample and the approximated backends
+    :return: list of dicts with seconds and recall per backend
+    """
+    rng = np.random.default_rng(seed)
+    queries = np.sort(rng.choice(len(data), min(num_queries, len(data)), replace=False))
+    reference, _ = exact_knn(data, num_neighbours, rows=queries)
+    results = []
+    for method in methods:
+        if method == 'exact' and len(data) > exact_limit:
+            continue
+        tic = time.perf_counter()
+        try:
+            indices, _ = knn_graph(data, num_neighbours, method=method, seed=seed + 1)
+        except ImportError as error:
+            print("skipping %s: %s" % (method, error))
+            continue
+        seconds = time.perf_counter() - tic
+        results.append({'method': method, 'seconds': seconds, 'recall': recall(indices[queries], reference)})
+    return results
+
+
+if __name__ == "__main__":
+    datasets = [('mnist', mnist()),
+                ('gaussians', gaussian_mixture(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000))]
+    print("%10s %10s %10s %10s %8s" % ("data", "points", "method", "time (s)", "recall"))
+    for name, data in datasets:
+        if data is None:
+            print("%10s not available" % name)
+            continue
+        for res in run(data):
+            print("%10s %10i %10s %10.2f %8.4f" % (name, len(data), res['method'], res['seconds'], res['recall']))
@@ -0,0 +1,85 @@
+# Benchmark of the pca engines of Data_Prep.pca: time, peak memory and captured variance
+# Run with: python benchmarks/bench_pca.py
+import multiprocessing
+import resource
+import sys
+import time
+import numpy as np
+from schnel.Data_Prep.pca import pca
+
+CONFIGS = (('exact', None), ('randomized', None), ('incremental', None),
+           ('randomized', 0.1), ('incremental', 0.1), ('exact', 0.1))
+
+
+def synthetic_data(num_rows, num_features, rank=30, seed=0, chunk_rows=1 << 16):
+    """
+    Low-rank float32 data with a decaying spectrum plus noise, generated in chunks.
+
+    :param num_rows: number of rows
+    :param num_features: number of features
+    :param rank: rank of the signal
+    :param seed: seed of the random generator
+    :param chunk_rows: number of rows generated at once
+    :return: np.ndarray
+    """
+    rng = np.random.default_rng(seed)
+    basis = rng.standard_normal((rank, num_features)).astype(np.float32)
+    basis *= (10.0 / np.arange(1, rank + 1, dtype=np.float32))[:, None]
+    data = np.empty((num_rows, num_features), dtype=np.float32)
+    for start in range(0, num_rows, chunk_rows):
+        stop = min(start + chunk_rows, num_rows)
+        data[start:stop] = rng.standard_normal((stop - start, rank), dtype=np.float32) @ basis
+        data[start:stop] += rng.standard_normal((stop - start, num_features), dtype=np.float32)
+    return data
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / (1 << 10)
+
+
+def _measure(args):
+    """
+    Runs one pca engine in a fresh process so that its peak memory is not shadowed by earlier runs.
+
+    :param args: (method, fit fraction, number of rows, number of features, number of components)
+    :return: (seconds, peak rss above the input data in MB, variance captured by the projection)
+    """
+    method, fraction, num_rows, num_features, comps = args
+    data = synthetic_data(num_rows, num_features)
+    baseline = _peak_rss_mb()
+    fit_rows = None if fraction is None else int(fraction * num_rows)
+    tic = time.perf_counter()
+    projected = pca(data, comps, method=method, fit_rows=fit_rows, seed=0)
+    seconds = time.perf_counter() - tic
+    return seconds, _peak_rss_mb() - baseline, float(projected.var(axis=0, dtype=np.float64).sum())
+
+
+def run(num_rows=200000, num_features=200, comps=50, configs=CONFIGS):
+    """
+    Time every engine and compare the variance its components capture with the exact solver.
+
+    :param num_rows: number of rows of the synthetic data
+    :param num_features: number of features of the synthetic data
+    :param comps: number of PC's
+    :param configs: pairs of pca method and fraction of rows the components are fitted on (None for all)
+    :return: list of dicts with time, peak memory and relative difference in explained variance
+    """
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for method, fraction in configs:
+        with context.Pool(1) as pool:
+            seconds, peak, variance = pool.apply(_measure, ((method, fraction, num_rows, num_features, comps),))
+        results.append({'method': method, 'fit_fraction': fraction or 1.0, 'seconds': seconds,
+                        'peak_rss_mb': peak, 'variance': variance})
+    exact = next(res['variance'] for res in results if res['method'] == 'exact' and res['fit_fraction'] == 1.0)
+    for res in results:
+        res['variance_diff'] = (exact - res['variance']) / exact
+    return results
+
+
+if __name__ == "__main__":
+    print("%12s %8s %10s %14s %14s" % ("method", "fit", "time (s)", "peak RSS (MB)", "var. diff"))
+    for res in run():
+        print("%12s %8.2f %10.3f %14.1f %14.2e" % (res['method'], res['fit_fraction'], res['seconds'],
+                                                 res['peak_rss_mb'], res['variance_diff']))
@@ -0,0 +1,242 @@
+# Benchmark of the stages of the SCHNEL pipeline on Gaussian mixtures: time and peak memory per stage, as JSON
+# Run with: python benchmarks/bench_pipeline.py [numbers of points, default 10000 100000] [--out results.json]
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import numpy as np
+from numpy.lib.format import open_memmap
+
+SIZES = (10000, 100000, 1000000, 10000000)
+PARSE_FORMATS = ('csv', 'fcs', 'h5ad')
+NUM_FEATURES = 64
+NUM_COMPONENTS = 32
+NUM_NEIGHBOURS = 30
+_CHUNK_ROWS = 1 << 16
+
+
+def _peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20) if sys.platform == 'darwin' else peak / (1 << 10)
+
+
+def write_mixture(path, num_points, num_features=NUM_FEATURES, num_clusters=20, seed=0):
+    """
+    Writes a mixture of isotropic Gaussians with random centers to a .npy file, generated in chunks.
+
+    :param path: path of the .npy file
+    :param num_points: number of points
+    :param num_features: number of features
+    :param num_clusters: number of mixture components
+    :param seed: seed of the random generator
+    """
+    rng = np.random.default_rng(seed)
+    centers = rng.uniform(-10, 10, size=(num_clusters, num_features)).astype(np.float32)
+    data = open_memmap(path, mode='w+', dtype=np.float32, shape=(num_points, num_features))
+    for start in range(0, num_points, _CHUNK_ROWS):
+        stop = min(start + _CHUNK_ROWS, num_points)
+        data[start:stop] = rng.standard_normal((stop - start, num_features), dtype=np.float32)
+        data[start:stop] += centers[rng.integers(0, num_clusters, size=stop - start)]
+    data.flush()
+
+
+def write_fcs(path, data):
+    """
+    Writes a float32 matrix as a minimal FCS 3.0 file with little-endian list mode data.
+
+    :param path: path of the .fcs file
+    :param data: 2d array, written in chunks of rows
+    """
+    rows, cols = data.shape
+    keywords = [('$BYTEORD', '1,2,3,4'), ('$DATATYPE', 'F'), ('$MODE', 'L'), ('$NEXTDATA', '0'),
+                ('$PAR', str(cols)), ('$TOT', str(rows)), ('$BEGINANALYSIS', '0'), ('$ENDANALYSIS', '0'),
+                ('$BEGINSTEXT', '0'), ('$ENDSTEXT', '0')]
+    for par in range(1, cols + 1):
+        keywords += [('$P%iB' % par, '32'), ('$P%iE' % par, '0,0'), ('$P%iN' % par, 'F%i' % par),
+                     ('$P%iR' % par, '262144')]
+    # The data offsets are written with a fixed width, so the length of the text segment is known beforehand
+    text_start = 58
+    text = '|' + ''.join('%s|%s|' % pair for pair in keywords) + '$BEGINDATA|%020i|$ENDDATA|%020i|'
+    data_start = text_start + len(text % (0, 0))
+    data_end = data_start + rows * cols * 4 - 1
+    text = text % (data_start, data_end)
+    fits = data_end <= 99999999
+    header = 'FCS3.0    %8i%8i%8i%8i%8i%8i' % (text_start, text_start + len(text) - 1,
+                                              data_start if fits else 0, data_end if fits else 0, 0, 0)
+    with open(path, 'wb') as handle:
+        handle.write(header.encode('ascii'))
+        handle.write(text.encode('ascii'))
+        for start in range(0, rows, _CHUNK_ROWS):
+            handle.write(np.ascontiguousarray(data[start:start + _CHUNK_ROWS], dtype='<f4').tobytes())
+
+
+def _write_input(args):
+    """
+    Writes the data set of one size and its files in every parse format, in a worker process.
+
+    :param args: (working directory, number of points, parse formats)
+    """
+    workdir, num_points, formats = args
+    data_path = os.path.join(workdir, 'data.npy')
+    write_mixture(data_path, num_points)
+    data = np.load(data_path, mmap_mode='r')
+    if 'csv' in formats:
+        with open(os.path.join(workdir, 'data.csv'), 'wb') as handle:
+            for start in range(0, num_points, _CHUNK_ROWS):
+                np.savetxt(handle, data[start:start + _CHUNK_ROWS], fmt='%.6g', delimiter=',')
+    if 'fcs' in formats:
+        write_fcs(os.path.join(workdir, 'data.fcs'), data)
+    if 'h5ad' in formats:
+        import anndata as ad
+        ad.AnnData(np.asarray(data)).write_h5ad(os.path.join(workdir, 'data.h5ad'))
+
+
+def _measure(args):
+    """
+    Runs one stage in a fresh process, so that its peak memory is not shadowed by earlier stages.
+    Inputs of the stage are loaded before the baseline is taken, outputs needed by later stages are written
+    to the working directory after the timing.
+
+    :param args: (stage, working directory, scale number or None)
+    :return: (seconds, peak rss above the loaded input in MB, dict with details of the stage)
+    """
+    #pylint: disable=too-many-locals
+    stage, workdir, scalenum = args
+    from schnel.Data_Prep import dataprep as dp
+    from schnel.Data_Prep.pca import pca
+    from schnel.algorithm import _build_hierarchy
+    from schnel.clustering.HSNE_parser import read_HSNE_binary
+    from schnel.clustering.knn import knn_graph
+    hsne_path = os.path.join(workdir, 'hierarchy.hsne')
+    details = {}
+    if stage.startswith('parse_'):
+        path = os.path.join(workdir, 'data.' + stage[len('parse_'):])
+        baseline = _peak_rss_mb()
+        tic = time.perf_counter()
+        dp.parse_to_numpy(path, features_after_pca=NUM_FEATURES)
+    elif stage == 'pca':
+        data = np.load(os.path.join(workdir, 'data.npy'))
+        baseline = _peak_rss_mb()
+        tic = time.perf_counter()
+        projected = pca(data, NUM_COMPONENTS, seed=0)
+        seconds = time.perf_counter() - tic
+        np.save(os.path.join(workdir, 'pca.npy'), projected)
+        return seconds, _peak_rss_mb() - baseline, details
+    elif stage in ('knn', 'hierarchy'):
+        data = np.load(os.path.join(workdir, 'pca.npy'))
+        baseline = _peak_rss_mb()
+        tic = time.perf_counter()
+        if stage == 'knn':
+            knn_graph(data, NUM_NEIGHBOURS, method='flann', seed=1)
+        else:
+            hsne, _ = _build_hierarchy(data, num_of_neighbours=NUM_NEIGHBOURS, seed=1, hsne_file=hsne_path)
+            details['scale_sizes'] = [hsne.scale_size(num) for num in range(hsne.num_scales)]
+            details['scale_statistics'] = hsne.statistics
+    elif stage == 'read_hsne':
+        baseline = _peak_rss_mb()
+        tic = time.perf_counter()
+        read_HSNE_binary(hsne_path, verbose=False, lazy=False)
+    elif stage == 'leiden':
+        hsne = read_HSNE_binary(hsne_path, verbose=False)
+        hsne[scalenum]  # pylint: disable=pointless-statement
+        baseline = _peak_rss_mb()
+        tic = time.perf_counter()
+        membership = hsne.run_louvain(scalenum, seed=1)
+        seconds = time.perf_counter() - tic
+        np.save(os.path.join(workdir, 'leiden%i.npy' % scalenum), np.asarray(membership))
+        details['clusters'] = len(set(membership))
+        return seconds, _peak_rss_mb() - baseline, details
+    elif stage == 'propagation':
+        hsne = read_HSNE_binary(hsne_path, verbose=False)
+        membership = np.load(os.path.join(workdir, 'leiden%i.npy' % scalenum))
+        for num in range(1, scalenum + 1):
+            hsne[num]  # pylint: disable=pointless-statement
+        baseline = _peak_rss_mb()
+        tic = time.perf_counter()
+        hsne.get_map_by_cluster(scalenum, membership)
+    else:
+        raise ValueError("Unknown stage '%s'" % stage)
+    return time.perf_counter() - tic, _peak_rss_mb() - baseline, details
+
+
+def _environment():
+    """
+    :return: dict describing the machine and the version of the code
+    """
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=os.path.dirname(os.path.abspath(__file__)),
+                                stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, check=True).stdout.decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {'commit': commit, 'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'python': platform.python_version(),
+            'numpy': np.__version__, 'platform': platform.platform(), 'cpus': os.cpu_count()}
+
+
+def run(sizes=SIZES[:2], formats=PARSE_FORMATS, parse_limit=1000000, workdir=None):
+    """
+    Runs every stage of the pipeline on Gaussian mixtures of the given sizes. The stages are parsing of .csv,
+    .fcs and .h5ad files (parse_to_numpy, up to parse_limit points), pca, the FLANN neighbour graph on its own,
+    the whole hierarchy computation (numpy_to_hsne.compute, including the neighbour graph), reading the .hsne
+    file, and Leiden clustering (run_louvain) and label propagation (get_map_by_cluster) of every subscale.
+
+    :param sizes: numbers of points
+    :param formats: file formats whose parsing is measured
+    :param parse_limit: largest number of points written to files for the parse stages
+    :param workdir: directory for the generated data, a temporary directory that is removed afterwards if None
+    :return: list of dicts with stage, number of points, scale, seconds and peak memory
+    """
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for num_points in sizes:
+        directory = tempfile.mkdtemp(prefix='schnel_bench_', dir=workdir)
+        try:
+            size_formats = formats if num_points <= parse_limit else ()
+            with context.Pool(1) as pool:
+                pool.apply(_write_input, ((directory, num_points, size_formats),))
+            stages = [('parse_' + fmt, None) for fmt in size_formats]
+            stages += [('pca', None), ('knn', None), ('hierarchy', None), ('read_hsne', None)]
+            num_scales = None
+            while stages:
+                stage, scalenum = stages.pop(0)
+                with context.Pool(1) as pool:
+                    seconds, peak, details = pool.apply(_measure, ((stage, directory, scalenum),))
+                result = {'stage': stage, 'points': num_points, 'scale': scalenum, 'seconds': seconds,
+                          'peak_rss_mb': peak}
+                result.update(details)
+                results.append(result)
+                if stage == 'hierarchy':
+                    num_scales = len(details['scale_sizes'])
+                if stage == 'read_hsne':
+                    for num in range(1, num_scales):
+                        stages += [('leiden', num), ('propagation', num)]
+        finally:
+            shutil.rmtree(directory, ignore_errors=True)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Times the stages of the SCHNEL pipeline")
+    parser.add_argument('sizes', nargs='*', type=int, default=list(SIZES[:2]),
+                        help="numbers of points, e.g. %s" % ' '.join(str(size) for size in SIZES))
+    parser.add_argument('--out', help="JSON file the results are written to")
+    parser.add_argument('--formats', default=','.join(PARSE_FORMATS), help="parse formats, comma separated")
+    parser.add_argument('--parse-limit', type=int, default=1000000,
+                        help="largest number of points written to files for the parse stages")
+    parser.add_argument('--workdir', help="directory for the generated data")
+    args = parser.parse_args()
+    formats = tuple(fmt for fmt in args.formats.split(',') if fmt)
+    results = run(args.sizes, formats, args.parse_limit, args.workdir)
+    print("%12s %10s %6s %10s %14s" % ("stage", "points", "scale", "time (s)", "peak RSS (MB)"))
+    for res in results:
+        print("%12s %10i %6s %10.3f %14.1f" % (res['stage'], res['points'], '' if res['scale'] is None else res['scale'],
+                                              res['seconds'], res['peak_rss_mb']))
+    if args.out:
+        with open(args.out, 'w') as handle:
+            json.dump({'environment': _environment(), 'results': results}, handle, indent=1)
@@ -0,0 +1,58 @@
+# Benchmark of the random walks of the hierarchy computation: throughput per scale with and without the walk tables
+# Run with: python benchmarks/bench_random_walks.py [number of synthetic points, default 100000]
+import sys
+import numpy as np
+import numpy_to_hsne
+from bench_knn import gaussian_mixture
+
+
+def scale_matrices(data, num_scales=4, seed=1):
+    """
+    Transition matrices of every scale of the hierarchy of data, computed with the parameters of algorithm.cluster.
+
+    :param data: float32 array
+    :param num_scales: number of scales
+    :param seed: seed of the hierarchy
+    :return: list of (indptr, indices, data) CSR arrays, starting with the data scale
+    """
+    scales = numpy_to_hsne.compute(data, num_scales, seed, 1.5, 30, 6, 1024, 1.5, 200, 200, True, True)
+    return [(scale['tmatrix_indptr'], scale['tmatrix_indices'], scale['tmatrix_data']) for scale in scales]
+
+
+def run(data, num_walks=200, walk_length=10, num_threads=0, seed=0):
+    """
+    Time the walks of the Monte Carlo landmark selection on every scale, taking the steps with the alias tables and
+    with the linear scan of the rows used before.
+
+    :param data: float32 array
+    :param num_walks: number of walks from every point
+    :param walk_length: number of steps per walk
+    :param num_threads: number of threads, all cores if 0
+    :param seed: seed of the walks
+    :return: list of dicts with the size of the scale, entries per row, steps per second of both methods and the
+        time and memory of building the tables
+    """
+    results = []
+    for num, (indptr, indices, values) in enumerate(scale_matrices(data)):
+        timings = {}
+        for name, linear_scan in (('table', False), ('linear', True)):
+            res = numpy_to_hsne.random_walks(indptr, indices, values, num_walks=num_walks, walk_length=walk_length,
+                                             seed=seed, num_threads=num_threads, linear_scan=linear_scan)
+            timings[name] = res
+        num_steps = (len(indptr) - 1) * num_walks * (walk_length + 1)
+        results.append({'scale': num, 'points': len(indptr) - 1, 'row_entries': len(indices) / (len(indptr) - 1),
+                        'table_steps_per_s': num_steps / timings['table']['walk_seconds'],
+                        'linear_steps_per_s': num_steps / timings['linear']['walk_seconds'],
+                        'build_seconds': timings['table']['build_seconds'],
+                        'table_mb': timings['table']['table_bytes'] / float(1 << 20)})
+    return results
+
+
+if __name__ == "__main__":
+    points = gaussian_mixture(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
+    print("%6s %10s %12s %16s %16s %9s %10s %10s" % ("scale", "points", "entries/row", "table (steps/s)",
+                                                      "linear (steps/s)", "speedup", "build (s)", "table (MB)"))
+    for res in run(points):
+        print("%6i %10i %12.1f %16.3g %16.3g %8.1fx %10.3f %10.1f" % (
+            res['scale'], res['points'], res['row_entries'], res['table_steps_per_s'], res['linear_steps_per_s'],
+            res['table_steps_per_s'] / res['linear_steps_per_s'], res['build_seconds'], res['table_mb']))
@@ -0,0 +1,84 @@
+# Benchmark of warm-started Leiden: iterations, time and modularity per scale from singletons and from the projected
+# membership of the coarser scale, and resolution sweeps with and without reuse of the previous partition
+# Run with: python benchmarks/bench_warm_start.py [number of synthetic points, default 100000]
+import sys
+import time
+import leidenalg
+from bench_knn import gaussian_mixture
+from schnel.algorithm import _build_hierarchy
+
+RESOLUTIONS = (0.25, 0.5, 1.0, 2.0, 4.0)
+
+
+def optimise(graph, partition_type, initial_membership=None, seed=1, **kwargs):
+    """
+    Runs Leiden iterations until the quality no longer improves.
+
+    :param graph: igraph Graph with edge attribute 'weight'
+    :param partition_type: leidenalg partition class
+    :param initial_membership: membership to start from, singletons if None
+    :param seed: seed of the optimiser
+    :return: (partition, number of iterations, seconds)
+    """
+    tic = time.perf_counter()
+    partition = partition_type(graph, weights='weight', initial_membership=initial_membership, **kwargs)
+    optimiser = leidenalg.Optimiser()
+    optimiser.set_rng_seed(seed)
+    iterations = 1
+    while optimiser.optimise_partition(partition) > 0:
+        iterations += 1
+    return partition, iterations, time.perf_counter() - tic
+
+
+def run(data, seed=1):
+    """
+    Clusters every subscale of the hierarchy of data from the coarsest down, once from singletons and once from
+    the membership of the coarser scale projected with HSNE.project_membership, then sweeps the resolutions of
+    RBConfigurationVertexPartition on the finest subscale.
+
+    :param data: float32 array
+    :param seed: seed of the hierarchy and of Leiden
+    :return: (list of dicts per scale, list of dicts per resolution)
+    """
+    hsne, _ = _build_hierarchy(data, num_of_neighbours=30, seed=seed)
+    scales = []
+    coarser = None
+    for num in range(hsne.num_scales - 1, 0, -1):
+        graph = hsne.get_graph(num)
+        cold, cold_iterations, cold_seconds = optimise(graph, leidenalg.ModularityVertexPartition, seed=seed)
+        initial = None if coarser is None else hsne.project_membership(num + 1, coarser, num).tolist()
+        warm, warm_iterations, warm_seconds = optimise(graph, leidenalg.ModularityVertexPartition, initial, seed)
+        coarser = warm.membership
+        scales.append({'scale': num, 'landmarks': graph.vcount(), 'cold_iterations': cold_iterations,
+                       'cold_seconds': cold_seconds, 'cold_modularity': cold.modularity,
+                       'warm_iterations': warm_iterations, 'warm_seconds': warm_seconds,
+                       'warm_modularity': warm.modularity})
+    graph = hsne.get_graph(1)
+    sweep = []
+    previous = None
+    for resolution in RESOLUTIONS:
+        _, cold_iterations, cold_seconds = optimise(graph, leidenalg.RBConfigurationVertexPartition, seed=seed,
+                                                    resolution_parameter=resolution)
+        warm, warm_iterations, warm_seconds = optimise(graph, leidenalg.RBConfigurationVertexPartition, previous,
+                                                       seed, resolution_parameter=resolution)
+        previous = warm.membership
+        sweep.append({'resolution': resolution, 'clusters': len(warm), 'cold_iterations': cold_iterations,
+                      'cold_seconds': cold_seconds, 'warm_iterations': warm_iterations, 'warm_seconds': warm_seconds})
+    return scales, sweep
+
+
+if __name__ == "__main__":
+    points = gaussian_mixture(int(sys.argv[1]) if len(sys.argv) > 1 else 100000)
+    scale_results, sweep_results = run(points)
+    print("%6s %10s %12s %10s %10s %12s %10s %10s" % ("scale", "landmarks", "cold (iter)", "cold (s)", "cold (Q)",
+                                                      "warm (iter)", "warm (s)", "warm (Q)"))
+    for res in scale_results:
+        print("%6i %10i %12i %10.3f %10.4f %12i %10.3f %10.4f" % (
+            res['scale'], res['landmarks'], res['cold_iterations'], res['cold_seconds'], res['cold_modularity'],
+            res['warm_iterations'], res['warm_seconds'], res['warm_modularity']))
+    print("%10s %9s %12s %10s %12s %10s" % ("resolution", "clusters", "cold (iter)", "cold (s)", "warm (iter)",
+                                             "warm (s)"))
+    for res in sweep_results:
+        print("%10.2f %9i %12i %10.3f %12i %10.3f" % (res['resolution'], res['clusters'], res['cold_iterations'],
+                                                      res['cold_seconds'], res['warm_iterations'],
+                                                      res['warm_seconds']))
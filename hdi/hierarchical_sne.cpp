@@ -64,6 +64,13 @@ namespace hdi{
       template void saveHSNE<HierarchicalSNE<float,std::vector<hdi::data::MapMemEff<uint32_t,float>>>,std::ofstream>(const HierarchicalSNE<float,std::vector<hdi::data::MapMemEff<uint32_t,float>>>& hsne, std::ofstream& stream, utils::AbstractLog* log);
       template void loadHSNE<HierarchicalSNE<double,std::vector<hdi::data::MapMemEff<uint32_t,double>>>,std::ifstream>(HierarchicalSNE<double,std::vector<hdi::data::MapMemEff<uint32_t,double>>>& hsne, std::ifstream& stream, utils::AbstractLog* log);
       template void loadHSNE<HierarchicalSNE<float,std::vector<hdi::data::MapMemEff<uint32_t,float>>>,std::ifstream>(HierarchicalSNE<float,std::vector<hdi::data::MapMemEff<uint32_t,float>>>& hsne, std::ifstream& stream, utils::AbstractLog* log);
+
+      template void saveHSNEv2<HierarchicalSNE<double,std::vector<std::map<uint32_t,double>>>,std::ofstream>(const HierarchicalSNE<double,std::vector<std::map<uint32_t,double>>>& hsne, std::ofstream& stream, bool compress, utils::AbstractLog* log);
+      template void saveHSNEv2<HierarchicalSNE<float,std::vector<std::map<uint32_t,float>>>,std::ofstream>(const HierarchicalSNE<float,std::vector<std::map<uint32_t,float>>>& hsne, std::ofstream& stream, bool compress, utils::AbstractLog* log);
+      template void saveHSNEv2<HierarchicalSNE<double,std::vector<std::unordered_map<uint32_t,double>>>,std::ofstream>(const HierarchicalSNE<double,std::vector<std::unordered_map<uint32_t,double>>>& hsne, std::ofstream& stream, bool compress, utils::AbstractLog* log);
+      template void saveHSNEv2<HierarchicalSNE<float,std::vector<std::unordered_map<uint32_t,float>>>,std::ofstream>(const HierarchicalSNE<float,std::vector<std::unordered_map<uint32_t,float>>>& hsne, std::ofstream& stream, bool compress, utils::AbstractLog* log);
+      template void saveHSNEv2<HierarchicalSNE<double,std::vector<hdi::data::MapMemEff<uint32_t,double>>>,std::ofstream>(const HierarchicalSNE<double,std::vector<hdi::data::MapMemEff<uint32_t,double>>>& hsne, std::ofstream& stream, bool compress, utils::AbstractLog* log);
+      template void saveHSNEv2<HierarchicalSNE<float,std::vector<hdi::data::MapMemEff<uint32_t,float>>>,std::ofstream>(const HierarchicalSNE<float,std::vector<hdi::data::MapMemEff<uint32_t,float>>>& hsne, std::ofstream& stream, bool compress, utils::AbstractLog* log);
     }
   }
 }
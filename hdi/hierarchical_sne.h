@@ -34,6 +34,7 @@
 #define HIERARCHICAL_SNE_H
 
 #include <vector>
+#include <functional>
 #include <stdint.h>
 #include "assert_by_exception.h"
 #include "abstract_log.h"
@@ -46,6 +47,38 @@
 
 namespace hdi{
   namespace dr{
+    //! Transition matrix frozen for random walks
+    /*!
+      The rows of a transition matrix as alias tables in CSR layout, so that a step of a random walk takes a single
+      uniform draw and a single entry of the row, instead of a linear scan of the row.
+      The neighbors are sampled with the probabilities of the row normalized to one.
+      It is built once per scale and only read by the threads performing the walks.
+    */
+    class WalkTable{
+    public:
+      typedef uint32_t unsigned_int_type;
+
+      //! Freeze a transition matrix, whose rows are filled by num_threads threads
+      template <typename sparse_matrix_type>
+      explicit WalkTable(const sparse_matrix_type& transition_matrix, int num_threads = 1);
+
+      //! Number of rows
+      unsigned_int_type size()const{return static_cast<unsigned_int_type>(_indptr.size()-1);}
+      //! Bytes held by the table
+      uint64_t memory()const{return _indptr.size()*sizeof(uint64_t)+_entries.size()*sizeof(Entry);}
+      //! Neighbor selected by a uniform draw in [0,1), the row itself if the row is empty or has no probability
+      unsigned_int_type step(unsigned_int_type row, double rnd_num)const;
+
+    private:
+      struct Entry{
+        float _threshold;
+        unsigned_int_type _neighbor;
+        unsigned_int_type _alias;
+      };
+      std::vector<uint64_t> _indptr;
+      std::vector<Entry> _entries;
+    };
+
     //! Hierarchical Stochastic Neighbor Embedding algorithm
     /*!
       Algorithm for the generation of a hierarchical representation of the data as presented in the Hierarchical Stochastic Neighbor Embedding paper
@@ -81,6 +114,8 @@ namespace hdi{
       };
       typedef Scale scale_type;
       typedef std::vector<scale_type> hierarchy_type;
+      //! Progress of a loop of the computation: name of the stage, scale, steps done and total steps
+      typedef std::function<void(const std::string&, unsigned_int_type, uint64_t, uint64_t)> progress_callback_type;
 
     public:
       //! Parameters used for the initialization of the algorithm
@@ -88,6 +123,7 @@ namespace hdi{
       public:
         Parameters();
         int _seed; //! Seed for random algorithms. If a negative value is provided, a time-based seed is used.
+        int _num_threads; //! Number of OpenMP threads. If a non-positive value is provided, all available threads are used. Results do not depend on it.
         unsigned_int_type _num_neighbors; //! Number of neighbors used in the KNN graph
         unsigned_int_type _aknn_num_trees; //! Number of trees in the Approximated KNN algorithm (See Approximated and User Steerable tSNE paper)
         unsigned_int_type _aknn_num_checks; //! Number of checks in the Approximated KNN algorithm (See Approximated and User Steerable tSNE paper)
@@ -223,6 +259,12 @@ namespace hdi{
       void initialize(scalar_type* high_dimensional_data, unsigned_int_type num_dps, Parameters params = Parameters());
       //! Initialize the class with the current data-points from a given similarity matrix
       void initialize(const sparse_scalar_matrix_type& similarities, Parameters params = Parameters());
+      //! Use a precomputed neighborhood graph instead of the FLANN kd-trees in the next initialization.
+      //! Both vectors hold _num_neighbors+1 entries per data point, the point itself included, distances are squared euclidean.
+      void setNeighborhoodGraph(std::vector<int> neighborhood_graph, scalar_vector_type distances){
+        _precomputed_neighborhood_graph.swap(neighborhood_graph);
+        _precomputed_distances.swap(distances);
+      }
       //! Reset the internal state of the class but it keeps the inserted data-points
       void reset();
       //! Reset the class and remove all the data points
@@ -242,6 +284,8 @@ namespace hdi{
 
       //! Return statistics on the computation of the last scale
       const Statistics& statistics(){ return _statistics; }
+      //! Set a callback that reports the progress of the parallel loops, called from the worker threads
+      void setProgressCallback(const progress_callback_type& callback){_progress_callback = callback;}
 
       //! Return the whole hierarchy
       hierarchy_type& hierarchy(){return _hierarchy;}
@@ -291,18 +335,25 @@ namespace hdi{
       //! Compute a new scale with a out-of-core
       bool addScaleOutOfCoreImpl();
 
-      void selectLandmarks(const Scale& previous_scale,Scale& scale, unsigned_int_type& selected_landmarks);
-      void selectLandmarksWithStationaryDistribution(const Scale& previous_scale,Scale& scale, unsigned_int_type& selected_landmarks);
+      void selectLandmarks(const Scale& previous_scale, const WalkTable& walk_table, Scale& scale, unsigned_int_type& selected_landmarks);
+      void selectLandmarksWithStationaryDistribution(const Scale& previous_scale, const WalkTable& walk_table, Scale& scale, unsigned_int_type& selected_landmarks);
 
 
       //! Return the seed for the random number generation
       unsigned_int_type seed()const;
+      //! Return the random generator of a single work item (e.g. a data point) of a stage of the computation of a scale.
+      //! Every item has its own stream, so that the results do not depend on the number of threads.
+      static std::default_random_engine itemGenerator(unsigned_int_type stream_seed, unsigned_int_type scale_id, unsigned_int_type stage, unsigned_int_type item);
+      //! Return the number of threads used by the parallel loops
+      int numThreads()const;
+      //! Return the progress callback of the scale being computed, empty if no callback is set
+      std::function<void(const std::string&, uint64_t, uint64_t)> progressCallback()const;
 
     private:
       //!Compute a random walk using a transition matrix and return the end point after a max_length steps -> used for landmark selection
-      inline unsigned_int_type randomWalk(unsigned_int_type starting_point, unsigned_int_type max_length, const sparse_scalar_matrix_type& transition_matrix, std::uniform_real_distribution<double>& distribution, std::default_random_engine& generator);
+      inline unsigned_int_type randomWalk(unsigned_int_type starting_point, unsigned_int_type max_length, const WalkTable& walk_table, std::uniform_real_distribution<double>& distribution, std::default_random_engine& generator);
       //!Compute a random walk using a transition matrix that stops at a provided stopping point -> used for landmark similarity computation
-      inline int randomWalk(unsigned_int_type starting_point, const std::vector<int>& stopping_points, unsigned_int_type max_length, const sparse_scalar_matrix_type& transition_matrix, std::uniform_real_distribution<double>& distribution, std::default_random_engine& generator);
+      inline int randomWalk(unsigned_int_type starting_point, const std::vector<int>& stopping_points, unsigned_int_type max_length, const WalkTable& walk_table, std::uniform_real_distribution<double>& distribution, std::default_random_engine& generator);
 
     private:
       hierarchy_type _hierarchy;
@@ -311,6 +362,8 @@ namespace hdi{
       unsigned_int_type _dimensionality;
       unsigned_int_type _num_dps;
        scalar_type* _high_dimensional_data; //! High-dimensional data
+      std::vector<int> _precomputed_neighborhood_graph; //! Neighborhood graph used instead of the kd-trees, consumed by the initialization
+      scalar_vector_type _precomputed_distances; //! Squared distances of the precomputed neighborhood graph
 
       bool _initialized; //! Initialization flag
       bool _verbose;
@@ -319,6 +372,7 @@ namespace hdi{
 
       utils::AbstractLog* _logger;
       Statistics _statistics;
+      progress_callback_type _progress_callback;
     };
 
 ///////////////   AOI STATS   ////////////////////////////
@@ -340,6 +394,12 @@ namespace hdi{
       template <typename hsne_type, class output_stream_type>
       void saveHSNE(const hsne_type& hsne, output_stream_type& stream, utils::AbstractLog* log = nullptr);
 
+      //! Compact format (version 2.0): uint64 sizes, a table of byte offsets of the scales and CSR arrays per scale,
+      //! optionally LZ4 compressed. The stream has to be seekable
+      template <typename hsne_type, class output_stream_type>
+      void saveHSNEv2(const hsne_type& hsne, output_stream_type& stream, bool compress = false, utils::AbstractLog* log = nullptr);
+
+      //! Loads both the original (0.0) and the compact (2.0) format
       template <typename hsne_type, class input_stream_type>
       void loadHSNE(hsne_type& hsne, input_stream_type& stream, utils::AbstractLog* log = nullptr);
     }
@@ -43,6 +43,7 @@
 #include <unordered_set>
 #include <unordered_map>
 #include <numeric>
+#include <algorithm>
 #include "memory_utils.h"
 #include "map_mem_eff.h"
 #include "map_helpers.h"
@@ -55,6 +56,10 @@
 #define __block
 #endif
 
+#ifdef _OPENMP
+#include <omp.h>
+#endif
+
 #pragma warning( push )
 #pragma warning( disable : 4267)
 #pragma warning( push )
@@ -80,6 +85,7 @@ namespace hdi{
     template <typename scalar_type, typename sparse_scalar_matrix_type>
     HierarchicalSNE<scalar_type,sparse_scalar_matrix_type>::Parameters::Parameters():
       _seed(-1),
+      _num_threads(0),
       _num_neighbors(30),
       _aknn_num_trees(4),
       _aknn_num_checks(1024),
@@ -131,21 +137,21 @@ namespace hdi{
 
     template <typename scalar_type, typename sparse_scalar_matrix_type>
     void HierarchicalSNE<scalar_type,sparse_scalar_matrix_type>::Statistics::log(utils::AbstractLog* logger)const{
-      // // utils::secureLog(logger,"\n--------------- Hierarchical-SNE Statistics ------------------");
-      // // utils::secureLogValue(logger,"Total time",_total_time);
-      // if(_init_knn_time != -1){           // utils::secureLogValue(logger,"\tAKNN graph computation time", _init_knn_time,true,2);}
-      // if(_init_probabilities_time != -1){     // utils::secureLogValue(logger,"\tTransition probabilities computation time", _init_probabilities_time,true,1);}
-      // if(_init_fmc_time != -1){           // utils::secureLogValue(logger,"\tFMC computation time", _init_fmc_time,true,3);}
-      // if(_mcmc_sampling_time != -1){        // utils::secureLogValue(logger,"\tMarkov Chain Monte Carlo sampling time", _mcmc_sampling_time,true,1);}
-      // if(_landmarks_selection_time != -1){    // utils::secureLogValue(logger,"\tLandmark selection time", _landmarks_selection_time,true,2);}
-      // if(_landmarks_selection_num_walks != -1){   // utils::secureLogValue(logger,"\tLndks Slct #walks", _landmarks_selection_num_walks,true,3);}
-      // if(_aoi_time != -1){            // utils::secureLogValue(logger,"\tArea of Influence computation time", _aoi_time,true,1);}
-      // if(_fmc_time != -1){            // utils::secureLogValue(logger,"\tFMC computation time", _fmc_time,true,3);}
-      // if(_aoi_num_walks != -1){           // utils::secureLogValue(logger,"\tAoI #walks", _aoi_num_walks,true,4);}
-      // if(_aoi_sparsity != -1){          // utils::secureLogValue(logger,"\tIs sparsity (%)", _aoi_sparsity*100,true,3);}
-      // if(_fmc_sparsity != -1){          // utils::secureLogValue(logger,"\tTs sparsity (%)", _fmc_sparsity*100,true,3);}
-      // if(_fmc_effective_sparsity != -1){      // utils::secureLogValue(logger,"\tTs effective sparsity (%)", _fmc_effective_sparsity*100,true,2);}
-      // // utils::secureLog(logger,"--------------------------------------------------------------\n");
+      utils::secureLog(logger,"\n--------------- Hierarchical-SNE Statistics ------------------");
+      utils::secureLogValue(logger,"Total time",_total_time);
+      if(_init_knn_time != -1){utils::secureLogValue(logger,"\tAKNN graph computation time", _init_knn_time,true,2);}
+      if(_init_probabilities_time != -1){utils::secureLogValue(logger,"\tTransition probabilities computation time", _init_probabilities_time,true,1);}
+      if(_init_fmc_time != -1){utils::secureLogValue(logger,"\tFMC computation time", _init_fmc_time,true,3);}
+      if(_mcmc_sampling_time != -1){utils::secureLogValue(logger,"\tMarkov Chain Monte Carlo sampling time", _mcmc_sampling_time,true,1);}
+      if(_landmarks_selection_time != -1){utils::secureLogValue(logger,"\tLandmark selection time", _landmarks_selection_time,true,2);}
+      if(_landmarks_selection_num_walks != -1){utils::secureLogValue(logger,"\tLndks Slct #walks", _landmarks_selection_num_walks,true,3);}
+      if(_aoi_time != -1){utils::secureLogValue(logger,"\tArea of Influence computation time", _aoi_time,true,1);}
+      if(_fmc_time != -1){utils::secureLogValue(logger,"\tFMC computation time", _fmc_time,true,3);}
+      if(_aoi_num_walks != -1){utils::secureLogValue(logger,"\tAoI #walks", _aoi_num_walks,true,4);}
+      if(_aoi_sparsity != -1){utils::secureLogValue(logger,"\tIs sparsity (%)", _aoi_sparsity*100,true,3);}
+      if(_fmc_sparsity != -1){utils::secureLogValue(logger,"\tTs sparsity (%)", _fmc_sparsity*100,true,3);}
+      if(_fmc_effective_sparsity != -1){utils::secureLogValue(logger,"\tTs effective sparsity (%)", _fmc_effective_sparsity*100,true,2);}
+      utils::secureLog(logger,"--------------------------------------------------------------\n");
     }
     
   /////////////////////////////////////////////////////////////////////////
@@ -252,34 +258,49 @@ namespace hdi{
     template <typename scalar_type, typename sparse_scalar_matrix_type>
     void HierarchicalSNE<scalar_type,sparse_scalar_matrix_type>::computeNeighborhoodGraph(scalar_vector_type& distance_based_probabilities, std::vector<int>& neighborhood_graph){
       // utils::secureLog(_logger,"Computing the neighborhood graph...");
-      flann::Matrix<scalar_type> dataset  (_high_dimensional_data,_num_dps,_dimensionality);
-      flann::Matrix<scalar_type> query  (_high_dimensional_data,_num_dps,_dimensionality);
-      
-      flann::Index<flann::L2<scalar_type> > index(dataset, flann::KDTreeIndexParams(_params._aknn_num_trees));
       unsigned_int_type nn = _params._num_neighbors + 1;
       scalar_type perplexity = _params._num_neighbors / 3.;
-      neighborhood_graph.resize(_num_dps*nn);
-      distance_based_probabilities.resize(_num_dps*nn);
-      {
+      if(!_precomputed_neighborhood_graph.empty()){
+        checkAndThrowLogic(_precomputed_neighborhood_graph.size() == _num_dps*nn && _precomputed_distances.size() == _num_dps*nn,
+                           "computeNeighborhoodGraph: the precomputed graph must have num_neighbors+1 entries per data point");
+        neighborhood_graph.clear();
+        distance_based_probabilities.clear();
+        neighborhood_graph.swap(_precomputed_neighborhood_graph);
+        distance_based_probabilities.swap(_precomputed_distances);
+      }else{
+        flann::Matrix<scalar_type> dataset  (_high_dimensional_data,_num_dps,_dimensionality);
+        flann::Matrix<scalar_type> query  (_high_dimensional_data,_num_dps,_dimensionality);
+
+        flann::Index<flann::L2<scalar_type> > index(dataset, flann::KDTreeIndexParams(_params._aknn_num_trees));
+        neighborhood_graph.resize(_num_dps*nn);
+        distance_based_probabilities.resize(_num_dps*nn);
         // utils::secureLog(_logger,"\tBuilding the trees...");
         utils::ScopedTimer<scalar_type, utils::Seconds> timer(_statistics._init_knn_time);
+        //the search is parallelized by FLANN, only its start and end are reported
+        utils::CallbackProgress progress(progressCallback(),"knn",_num_dps);
+        progress.start();
+        // the kd-trees choose their split dimensions with rand()
+        flann::seed_random(seed());
         index.buildIndex();
         flann::Matrix<int> indices_mat(neighborhood_graph.data(), query.rows, nn);
         flann::Matrix<scalar_type> dists_mat(distance_based_probabilities.data(), query.rows, nn);
         flann::SearchParams params(_params._aknn_num_checks);
-        params.cores = 0; //all cores
+        params.cores = numThreads();
         // utils::secureLog(_logger,"\tAKNN queries...");
         index.knnSearch(query, indices_mat, dists_mat, nn, params);
+        progress.finish();
       }
       {
         // utils::secureLog(_logger,"\tFMC computation...");
         utils::ScopedTimer<scalar_type, utils::Seconds> timer(_statistics._init_probabilities_time);
-        
+        utils::CallbackProgress progress(progressCallback(),"probabilities",_num_dps);
+        progress.start();
+
 #ifdef __APPLE__
         std::cout << "GCD dispatch, hierarchical_sne_inl 253.\n";
         dispatch_apply(_num_dps, dispatch_get_global_queue(0, 0), ^(size_t d) {
 #else
-        #pragma omp parallel for
+        #pragma omp parallel for num_threads(numThreads())
         for(int_type d = 0; d < _num_dps; ++d){
 #endif //__APPLE__
           //It could be that the point itself is not the nearest one if two points are identical... I want the point itself to be the first one!
@@ -289,6 +310,12 @@ namespace hdi{
               if(neighborhood_graph[to_swap] == d)
                 break;
             }
+            //the approximated search can miss the point itself, it then replaces the farthest neighbor
+            if(to_swap == d*nn+nn){
+              to_swap = d*nn+nn-1;
+              neighborhood_graph[to_swap] = d;
+              distance_based_probabilities[to_swap] = 0;
+            }
             std::swap(neighborhood_graph[nn*d],neighborhood_graph[to_swap]);
             std::swap(distance_based_probabilities[nn*d],distance_based_probabilities[to_swap]);
           }
@@ -308,10 +335,12 @@ namespace hdi{
           for(unsigned_int_type n = 1; n < nn; ++n){
             distance_based_probabilities[d*nn+n] = temp_probability[n];
           }
+          progress.step();
         }
 #ifdef __APPLE__
         );
 #endif
+        progress.finish();
       }
     }
 
@@ -336,12 +365,14 @@ namespace hdi{
         scale._landmark_to_previous_scale_idx.resize(_num_dps);
         scale._landmark_weight.resize(_num_dps,1);
         scale._transition_matrix.resize(_num_dps);
+        utils::CallbackProgress progress(progressCallback(),"fmc",_num_dps);
+        progress.start();
 
 #ifdef __APPLE__
         std::cout << "GCD dispatch, hierarchical_sne_inl 253.\n";
         dispatch_apply(_num_dps, dispatch_get_global_queue(0, 0), ^(size_t i) {
 #else
-        #pragma omp parallel for
+        #pragma omp parallel for num_threads(numThreads())
         for(int i = 0; i < _num_dps; ++i){
 #endif //__APPLE__
           scalar_type sum = 0;
@@ -351,10 +382,12 @@ namespace hdi{
             sum += v;
             scale._transition_matrix[i][neighborhood_graph[idx]] = v;
           }
+          progress.step();
         }
 #ifdef __APPLE__
         );
 #endif
+        progress.finish();
 
         std::iota(scale._landmark_to_original_data_idx.begin(),scale._landmark_to_original_data_idx.end(),0);
         std::iota(scale._landmark_to_previous_scale_idx.begin(),scale._landmark_to_previous_scale_idx.end(),0);
@@ -387,7 +420,7 @@ namespace hdi{
     }
 
     template <typename scalar_type, typename sparse_scalar_matrix_type>
-    void HierarchicalSNE<scalar_type,sparse_scalar_matrix_type>::selectLandmarks(const Scale& previous_scale, Scale& scale, unsigned_int_type& selected_landmarks){
+    void HierarchicalSNE<scalar_type,sparse_scalar_matrix_type>::selectLandmarks(const Scale& previous_scale, const WalkTable& walk_table, Scale& scale, unsigned_int_type& selected_landmarks){
       utils::ScopedTimer<scalar_type, utils::Seconds> timer(_statistics._landmarks_selection_time);
       // utils::secureLog(_logger,"Landmark selection with fixed reduction...");
       const unsigned_int_type previous_scale_dp = previous_scale._transition_matrix.size();
@@ -413,7 +446,7 @@ namespace hdi{
         assert(idx < _num_dps);
 
         if(_params._rs_outliers_removal_jumps > 0){
-          idx = randomWalk(idx,_params._rs_outliers_removal_jumps,previous_scale._transition_matrix,distribution_real,generator);
+          idx = randomWalk(idx,_params._rs_outliers_removal_jumps,walk_table,distribution_real,generator);
         }
 
         if(scale._previous_scale_to_landmark_idx[idx] != -1){
@@ -430,7 +463,7 @@ namespace hdi{
     }
 
     template <typename scalar_type, typename sparse_scalar_matrix_type>
-    void HierarchicalSNE<scalar_type,sparse_scalar_matrix_type>::selectLandmarksWithStationaryDistribution(const Scale& previous_scale, Scale& scale, unsigned_int_type& selected_landmarks){
+    void HierarchicalSNE<scalar_type,sparse_scalar_matrix_type>::selectLandmarksWithStationaryDistribution(const Scale& previous_scale, const WalkTable& walk_table, Scale& scale, unsigned_int_type& selected_landmarks){
       // utils::secureLog(_logger,"Landmark selection...");
       const unsigned_int_type previous_scale_dp = previous_scale._transition_matrix.size();
       int count = 0;
@@ -440,31 +473,42 @@ namespace hdi{
       {
         utils::ScopedTimer<scalar_type, utils::Seconds> timer(_statistics._mcmc_sampling_time);
 
-        __block std::default_random_engine generator(seed());
-        __block std::uniform_real_distribution<double> distribution_real(0.0, 1.0);
+        const unsigned_int_type stream_seed = seed();
+        const unsigned_int_type scale_id = _hierarchy.size()-1;
         selected_landmarks = 0;
 
         // utils::secureLog(_logger,"Monte Carlo Approximation...");
         unsigned_int_type invalid = std::numeric_limits<unsigned_int_type>::max();
+        utils::CallbackProgress progress(progressCallback(),"mcmc_sampling",previous_scale_dp);
+        progress.start();
 
 #ifdef __APPLE__
         std::cout << "GCD dispatch, hierarchical_sne_inl 391.\n";
         dispatch_apply(previous_scale_dp, dispatch_get_global_queue(0, 0), ^(size_t d) {
 #else
-        #pragma omp parallel for
+        #pragma omp parallel for num_threads(numThreads())
         for(int d = 0; d < previous_scale_dp; ++d){
 #endif //__APPLE__
+          std::default_random_engine generator(itemGenerator(stream_seed,scale_id,0,d));
+          std::uniform_real_distribution<double> distribution_real(0.0, 1.0);
           for(int p = 0; p < _params._mcmcs_num_walks; ++p){
             int idx = d;
-            idx = randomWalk(idx,_params._mcmcs_walk_length,previous_scale._transition_matrix,distribution_real,generator);
+            idx = randomWalk(idx,_params._mcmcs_walk_length,walk_table,distribution_real,generator);
             if(idx != invalid){
+#ifdef __APPLE__
+              __sync_fetch_and_add(&importance_sampling[idx],1);
+#else
+              #pragma omp atomic
               ++importance_sampling[idx];
+#endif
             }
           }
+          progress.step();
         }
 #ifdef __APPLE__
         );
 #endif
+        progress.finish();
         _statistics._landmarks_selection_num_walks = previous_scale_dp*_params._mcmcs_num_walks;
 
         for(int i = 0; i < previous_scale_dp; ++i){
@@ -498,6 +542,10 @@ namespace hdi{
 
     template <typename scalar_type, typename sparse_scalar_matrix_type>
     bool HierarchicalSNE<scalar_type,sparse_scalar_matrix_type>::addScaleImpl(){
+      typedef typename sparse_scalar_matrix_type::value_type map_type;
+      typedef typename map_type::key_type key_type;
+      typedef typename map_type::mapped_type mapped_type;
+      typedef hdi::data::MapHelpers<key_type,mapped_type,map_type> map_helpers_type;
 
       utils::ScopedTimer<scalar_type, utils::Seconds> timer_tot(_statistics._total_time);
       // utils::secureLog(_logger,"Add a new scale ...");
@@ -508,36 +556,44 @@ namespace hdi{
 
       const unsigned_int_type previous_scale_dp = previous_scale._landmark_to_original_data_idx.size();
 
+      // The walks of landmark selection and area of influence share the frozen transition matrix of the previous scale
+      const WalkTable walk_table(previous_scale._transition_matrix,numThreads());
+
       // Landmark selection
       unsigned_int_type selected_landmarks = 0;
       if(_params._monte_carlo_sampling){
-        selectLandmarksWithStationaryDistribution(previous_scale,scale,selected_landmarks);
+        selectLandmarksWithStationaryDistribution(previous_scale,walk_table,scale,selected_landmarks);
       }else{
-        selectLandmarks(previous_scale,scale,selected_landmarks);
+        selectLandmarks(previous_scale,walk_table,scale,selected_landmarks);
       }
 
       // utils::secureLogValue(_logger,"\t#landmarks",selected_landmarks);
 
       {//Area of influence
-        __block std::default_random_engine generator(seed());
-        __block std::uniform_real_distribution<double> distribution_real(0.0, 1.0);
+        const unsigned_int_type stream_seed = seed();
+        const unsigned_int_type scale_id = _hierarchy.size()-1;
         const unsigned_int_type max_jumps = 100;//1000.*selected_landmarks/previous_scale_dp;
         const unsigned_int_type walks_per_dp = _params._num_walks_per_landmark;
         // utils::secureLog(_logger,"\tComputing area of influence...");
         {
           utils::ScopedTimer<scalar_type, utils::Seconds> timer(_statistics._aoi_time);
-          __block unsigned_int_type num_elem_in_Is(0);
+          unsigned_int_type num_elem_in_Is(0);
+          //landmarks reached by the walks of every data point, ordered by landmark
+          __block std::vector<std::vector<std::pair<unsigned_int_type,unsigned_int_type>>> reached_by_dp(previous_scale_dp);
+          utils::CallbackProgress aoi_progress(progressCallback(),"aoi",previous_scale_dp);
+          aoi_progress.start();
 #ifdef __APPLE__
           std::cout << "GCD dispatch, hierarchical_sne_inl 473.\n";
-          dispatch_queue_t criticalQueue = dispatch_queue_create("critical", NULL);
           dispatch_apply(previous_scale_dp, dispatch_get_global_queue(0, 0), ^(size_t d) {
 #else
-          #pragma omp parallel for
+          #pragma omp parallel for num_threads(numThreads())
           for(int d = 0; d < previous_scale_dp; ++d){
 #endif //__APPLE__
-            std::unordered_map<unsigned_int_type, unsigned_int_type> landmarks_reached;
+            std::default_random_engine generator(itemGenerator(stream_seed,scale_id,1,d));
+            std::uniform_real_distribution<double> distribution_real(0.0, 1.0);
+            std::map<unsigned_int_type, unsigned_int_type> landmarks_reached;
             for(int i = 0; i < walks_per_dp; ++i){
-              auto res = randomWalk(d,scale._previous_scale_to_landmark_idx,max_jumps,previous_scale._transition_matrix,distribution_real,generator);
+              auto res = randomWalk(d,scale._previous_scale_to_landmark_idx,max_jumps,walk_table,distribution_real,generator);
               if(res != -1){
                 ++landmarks_reached[scale._previous_scale_to_landmark_idx[res]];
               }else{
@@ -545,39 +601,62 @@ namespace hdi{
               }
             }
 
-            
+            for(auto l: landmarks_reached){
+              scale._area_of_influence[d][l.first] = scalar_type(l.second)/walks_per_dp;
+            }
+            reached_by_dp[d].assign(landmarks_reached.begin(),landmarks_reached.end());
+            aoi_progress.step();
+          }
 #ifdef __APPLE__
-            dispatch_sync(criticalQueue, ^
-#else
-            #pragma omp critical
+          );
 #endif
-            {
-              num_elem_in_Is += landmarks_reached.size();
-
-              for(auto l: landmarks_reached){
-                for(auto other_l: landmarks_reached){
-                  //to avoid that the sparsity of the matrix it is much different from the effective sparsity
-                  if(l.second <= _params._transition_matrix_prune_thresh || other_l.second <= _params._transition_matrix_prune_thresh)
-                    continue;
-                  if(l.first != other_l.first){
-                    scale._transition_matrix[l.first][other_l.first] += l.second * other_l.second * previous_scale._landmark_weight[d];
-                  }
-                }
-              }
+          aoi_progress.finish();
 
-              for(auto l: landmarks_reached){
-                const scalar_type prob = scalar_type(l.second)/walks_per_dp;
-                scale._area_of_influence[d][l.first] = prob;
-                scale._landmark_weight[l.first] += prob * previous_scale._landmark_weight[d];
-              }
+          //data points reaching every landmark, ordered by data point
+          __block std::vector<std::vector<std::pair<unsigned_int_type,unsigned_int_type>>> reaching_landmark(selected_landmarks);
+          for(int d = 0; d < previous_scale_dp; ++d){
+            num_elem_in_Is += reached_by_dp[d].size();
+            for(auto l: reached_by_dp[d]){
+              reaching_landmark[l.first].push_back(std::make_pair(unsigned_int_type(d),l.second));
             }
+          }
+
+          //Every row of the transition matrix and every landmark weight is accumulated by a single thread in the order
+          //of the data points, so no critical section is needed and the sums do not depend on the number of threads
+          utils::CallbackProgress fmc_progress(progressCallback(),"fmc",selected_landmarks);
+          fmc_progress.start();
 #ifdef __APPLE__
-            );
-#endif
+          std::cout << "GCD dispatch, hierarchical_sne_inl 520.\n";
+          dispatch_apply(selected_landmarks, dispatch_get_global_queue(0, 0), ^(size_t l) {
+#else
+          #pragma omp parallel for schedule(dynamic,64) num_threads(numThreads())
+          for(int l = 0; l < selected_landmarks; ++l){
+#endif //__APPLE__
+            std::map<unsigned_int_type, scalar_type> transitions;
+            scalar_type landmark_weight(0);
+            for(auto dp: reaching_landmark[l]){
+              const unsigned_int_type d = dp.first;
+              const scalar_type prob = scalar_type(dp.second)/walks_per_dp;
+              landmark_weight += prob * previous_scale._landmark_weight[d];
+              //to avoid that the sparsity of the matrix it is much different from the effective sparsity
+              if(dp.second <= _params._transition_matrix_prune_thresh)
+                continue;
+              for(auto other_l: reached_by_dp[d]){
+                if(other_l.second <= _params._transition_matrix_prune_thresh)
+                  continue;
+                if(l != other_l.first){
+                  transitions[other_l.first] += dp.second * other_l.second * previous_scale._landmark_weight[d];
+                }
+              }
+            }
+            scale._landmark_weight[l] = landmark_weight;
+            map_helpers_type::initialize(scale._transition_matrix[l],transitions.begin(),transitions.end());
+            fmc_progress.step();
           }
 #ifdef __APPLE__
           );
 #endif
+          fmc_progress.finish();
           _statistics._aoi_num_walks = previous_scale_dp * walks_per_dp;
           _statistics._aoi_sparsity = 1 - scalar_type(num_elem_in_Is) / (previous_scale_dp*selected_landmarks);
         }
@@ -625,19 +704,22 @@ namespace hdi{
 
       const unsigned_int_type previous_scale_dp = previous_scale._landmark_to_original_data_idx.size();
 
+      // The walks of landmark selection and area of influence share the frozen transition matrix of the previous scale
+      const WalkTable walk_table(previous_scale._transition_matrix,numThreads());
+
       // Landmark selection
       unsigned_int_type selected_landmarks = 0;
       if(_params._monte_carlo_sampling){
-        selectLandmarksWithStationaryDistribution(previous_scale,scale,selected_landmarks);
+        selectLandmarksWithStationaryDistribution(previous_scale,walk_table,scale,selected_landmarks);
       }else{
-        selectLandmarks(previous_scale,scale,selected_landmarks);
+        selectLandmarks(previous_scale,walk_table,scale,selected_landmarks);
       }
 
       // utils::secureLogValue(_logger,"\t#landmarks",selected_landmarks);
 
       {//Area of influence
-        std::default_random_engine generator(seed());
-        std::uniform_real_distribution<double> distribution_real(0.0, 1.0);
+        const unsigned_int_type stream_seed = seed();
+        const unsigned_int_type scale_id = _hierarchy.size()-1;
         const unsigned_int_type max_jumps = 200;//1000.*selected_landmarks/previous_scale_dp;
         const unsigned_int_type walks_per_dp = _params._num_walks_per_landmark;
         // utils::secureLog(_logger,"\tComputing area of influence...");
@@ -652,18 +734,22 @@ namespace hdi{
             progress.setNumTicks(previous_scale_dp/50000);
             progress.setName("Area of influence");
             progress.start();
+            utils::CallbackProgress callback_progress(progressCallback(),"aoi",previous_scale_dp);
+            callback_progress.start();
   #ifdef __APPLE__
             std::cout << "GCD dispatch, hierarchical_sne_inl 587.\n";
             dispatch_queue_t criticalQueue = dispatch_queue_create("critical", NULL);
             dispatch_apply(previous_scale_dp, dispatch_get_global_queue(0, 0), ^(size_t d) {
   #else
-          #pragma omp parallel for
+          #pragma omp parallel for num_threads(numThreads())
             for(int d = 0; d < previous_scale_dp; ++d){
   #endif //__APPLE__
+              std::default_random_engine generator(itemGenerator(stream_seed,scale_id,1,d));
+              std::uniform_real_distribution<double> distribution_real(0.0, 1.0);
               //map because it must be ordered for the initialization of the maps
               std::map<unsigned_int_type, scalar_type> landmarks_reached;
               for(int i = 0; i < walks_per_dp; ++i){
-                auto res = randomWalk(d,scale._previous_scale_to_landmark_idx,max_jumps,previous_scale._transition_matrix,distribution_real,generator);
+                auto res = randomWalk(d,scale._previous_scale_to_landmark_idx,max_jumps,walk_table,distribution_real,generator);
                 if(res != -1){
                   ++landmarks_reached[scale._previous_scale_to_landmark_idx[res]];
                 }else{
@@ -679,11 +765,13 @@ namespace hdi{
               map_helpers_type::initialize(scale._area_of_influence[d],landmarks_reached.begin(),landmarks_reached.end());
               map_helpers_type::shrinkToFit(scale._area_of_influence[d]);
               progress.step();
+              callback_progress.step();
             }
   #ifdef __APPLE__
             );
   #endif
             progress.finish();
+            callback_progress.finish();
           }
           // utils::secureLog(_logger,"\tCaching weights...");
           //caching of the weights
@@ -709,11 +797,13 @@ namespace hdi{
             progress.setNumTicks(scale._transition_matrix.size()/5000);
             progress.setName("Similarities");
             progress.start();
+            utils::CallbackProgress callback_progress(progressCallback(),"fmc",scale._transition_matrix.size());
+            callback_progress.start();
   #ifdef __APPLE__
             std::cout << "GCD dispatch, hierarchical_sne_inl 602.\n";
             dispatch_apply(scale._transition_matrix.size(), dispatch_get_global_queue(0, 0), ^(size_t l) {
   #else
-            #pragma omp parallel for
+            #pragma omp parallel for num_threads(numThreads())
             for(int l = 0; l < scale._transition_matrix.size(); ++l){
   #endif //__APPLE__
               //ordered for efficient initialization
@@ -738,11 +828,13 @@ namespace hdi{
               map_helpers_type::initialize(scale._transition_matrix[l],temp_trans_mat.begin(),temp_trans_mat.end(), 0.001);
               map_helpers_type::shrinkToFit(scale._transition_matrix[l]);
               progress.step();
+              callback_progress.step();
             }
   #ifdef __APPLE__
             );
   #endif
             progress.finish();
+            callback_progress.finish();
           }
           _statistics._aoi_num_walks = previous_scale_dp * walks_per_dp;
           _statistics._aoi_sparsity = 1 - scalar_type(num_elem_in_Is) / (previous_scale_dp*selected_landmarks);
@@ -778,6 +870,31 @@ namespace hdi{
       return(_params._seed>0)?static_cast<unsigned_int_type>(_params._seed):std::chrono::system_clock::now().time_since_epoch().count();
     }
 
+    template <typename scalar_type, typename sparse_scalar_matrix_type>
+    std::default_random_engine HierarchicalSNE<scalar_type,sparse_scalar_matrix_type>::itemGenerator(unsigned_int_type stream_seed, unsigned_int_type scale_id, unsigned_int_type stage, unsigned_int_type item){
+      std::seed_seq sequence{stream_seed,scale_id,stage,item};
+      return std::default_random_engine(sequence);
+    }
+
+    template <typename scalar_type, typename sparse_scalar_matrix_type>
+    std::function<void(const std::string&, uint64_t, uint64_t)> HierarchicalSNE<scalar_type,sparse_scalar_matrix_type>::progressCallback()const{
+      if(!_progress_callback){
+        return std::function<void(const std::string&, uint64_t, uint64_t)>();
+      }
+      const progress_callback_type callback = _progress_callback;
+      const unsigned_int_type scale_id = _hierarchy.size()-1;
+      return [callback,scale_id](const std::string& name, uint64_t done, uint64_t total){callback(name,scale_id,done,total);};
+    }
+
+    template <typename scalar_type, typename sparse_scalar_matrix_type>
+    int HierarchicalSNE<scalar_type,sparse_scalar_matrix_type>::numThreads()const{
+#ifdef _OPENMP
+      return (_params._num_threads>0)?_params._num_threads:omp_get_max_threads();
+#else
+      return 1;
+#endif
+    }
+
 
 ///////////////////////////////////////////////////////////////////
 
@@ -813,7 +930,7 @@ namespace hdi{
       std::cout << "GCD dispatch, hierarchical_sne_inl 724.\n";
       dispatch_apply(_num_dps, dispatch_get_global_queue(0, 0), ^(size_t i) {
 #else
-      #pragma omp parallel for
+      #pragma omp parallel for num_threads(numThreads())
       for(int i = 0; i < _num_dps; ++i){
 #endif //__APPLE__
         influence[i] = _hierarchy[1]._area_of_influence[i];
@@ -844,7 +961,7 @@ namespace hdi{
       std::cout << "GCD dispatch, hierarchical_sne_inl 755.\n";
       dispatch_apply(n, dispatch_get_global_queue(0, 0), ^(size_t i) {
 #else
-      #pragma omp parallel for
+      #pragma omp parallel for num_threads(numThreads())
       for(int i = 0; i < n; ++i){
 #endif //__APPLE__
         influence[i] = _hierarchy[1]._area_of_influence[data_points[i]];
@@ -921,7 +1038,7 @@ namespace hdi{
         std::cout << "GCD dispatch, hierarchical_sne_inl 854.\n";
         dispatch_apply(scale(0).size(), dispatch_get_global_queue(0, 0), ^(size_t i) {
 #else
-#pragma omp parallel for
+#pragma omp parallel for num_threads(numThreads())
         for(int i = 0; i < scale(0).size(); ++i){
 #endif //__APPLE__
 
@@ -989,22 +1106,85 @@ namespace hdi{
 /// RANDOM WALKS
 ///////////////////////////////////////////////////////////////////
 
+    template <typename sparse_matrix_type>
+    WalkTable::WalkTable(const sparse_matrix_type& transition_matrix, int num_threads):
+      _indptr(transition_matrix.size()+1,0)
+    {
+      for(size_t i = 0; i < transition_matrix.size(); ++i){
+        _indptr[i+1] = _indptr[i] + transition_matrix[i].size();
+      }
+      _entries.resize(_indptr.back());
+#ifdef __APPLE__
+      dispatch_apply(transition_matrix.size(), dispatch_get_global_queue(0, 0), ^(size_t i) {
+#else
+      #pragma omp parallel for num_threads(num_threads)
+      for(int64_t i = 0; i < static_cast<int64_t>(transition_matrix.size()); ++i){
+#endif //__APPLE__
+        //Vose's alias method: every entry holds a neighbor, the probability to keep it and the neighbor taken otherwise
+        const uint64_t begin = _indptr[i];
+        const uint64_t length = _indptr[i+1] - begin;
+        double total = 0;
+        for(auto& elem: transition_matrix[i]){
+          total += elem.second;
+        }
+        std::vector<double> scaled;
+        std::vector<unsigned_int_type> small, large;
+        scaled.reserve(length);
+        uint64_t pos = 0;
+        for(auto& elem: transition_matrix[i]){
+          //a row without probability keeps the walk in place, which ends it as disconnected
+          const unsigned_int_type neighbor = total > 0 ? elem.first : static_cast<unsigned_int_type>(i);
+          scaled.push_back(total > 0 ? elem.second * length / total : 1.);
+          _entries[begin+pos]._neighbor = neighbor;
+          _entries[begin+pos]._alias = neighbor;
+          (scaled.back() < 1 ? small : large).push_back(static_cast<unsigned_int_type>(pos));
+          ++pos;
+        }
+        while(!small.empty() && !large.empty()){
+          const unsigned_int_type s = small.back(); small.pop_back();
+          const unsigned_int_type l = large.back();
+          _entries[begin+s]._threshold = static_cast<float>(scaled[s]);
+          _entries[begin+s]._alias = _entries[begin+l]._neighbor;
+          scaled[l] = (scaled[l] + scaled[s]) - 1;
+          if(scaled[l] < 1){
+            large.pop_back();
+            small.push_back(l);
+          }
+        }
+        //left over entries are full up to rounding errors
+        for(auto l: large){
+          _entries[begin+l]._threshold = 1;
+        }
+        for(auto s: small){
+          _entries[begin+s]._threshold = 1;
+        }
+      }
+#ifdef __APPLE__
+      );
+#endif
+    }
+
+    inline WalkTable::unsigned_int_type WalkTable::step(unsigned_int_type row, double rnd_num)const{
+      const uint64_t begin = _indptr[row];
+      const uint64_t length = _indptr[row+1] - begin;
+      if(length == 0){
+        return row;
+      }
+      //the integer part of the scaled draw selects the entry, its fractional part decides between neighbor and alias
+      const double scaled = rnd_num * length;
+      const uint64_t column = std::min(static_cast<uint64_t>(scaled), length-1);
+      const Entry& entry = _entries[begin+column];
+      return (scaled - column < entry._threshold) ? entry._neighbor : entry._alias;
+    }
+
     //Compute a random walk using a transition matrix
     template <typename scalar_type, typename sparse_scalar_matrix_type>
-    typename HierarchicalSNE<scalar_type,sparse_scalar_matrix_type>::unsigned_int_type HierarchicalSNE<scalar_type,sparse_scalar_matrix_type>::randomWalk(unsigned_int_type starting_point, unsigned_int_type max_length, const sparse_scalar_matrix_type& transition_matrix, std::uniform_real_distribution<double>& distribution, std::default_random_engine& generator){
+    typename HierarchicalSNE<scalar_type,sparse_scalar_matrix_type>::unsigned_int_type HierarchicalSNE<scalar_type,sparse_scalar_matrix_type>::randomWalk(unsigned_int_type starting_point, unsigned_int_type max_length, const WalkTable& walk_table, std::uniform_real_distribution<double>& distribution, std::default_random_engine& generator){
       unsigned_int_type dp_idx = starting_point;
       int walk_length = 0;
       do{
         const double rnd_num = distribution(generator);
-        unsigned_int_type idx_knn = dp_idx;
-        double incremental_prob = 0;
-        for(auto& elem: transition_matrix[dp_idx]){
-          incremental_prob += elem.second;
-          if(rnd_num < incremental_prob){
-            idx_knn = elem.first;
-            break;
-          }
-        }
+        unsigned_int_type idx_knn = walk_table.step(dp_idx,rnd_num);
         //assert(idx_knn != dp_idx);
         if(idx_knn == dp_idx){
           return std::numeric_limits<unsigned_int_type>::max();
@@ -1018,24 +1198,15 @@ namespace hdi{
 
     //!Compute a random walk using a transition matrix
     template <typename scalar_type, typename sparse_scalar_matrix_type>
-    int HierarchicalSNE<scalar_type,sparse_scalar_matrix_type>::randomWalk(unsigned_int_type starting_point, const std::vector<int>& stopping_points, unsigned_int_type max_length, const sparse_scalar_matrix_type& transition_matrix, std::uniform_real_distribution<double>& distribution, std::default_random_engine& generator){
+    int HierarchicalSNE<scalar_type,sparse_scalar_matrix_type>::randomWalk(unsigned_int_type starting_point, const std::vector<int>& stopping_points, unsigned_int_type max_length, const WalkTable& walk_table, std::uniform_real_distribution<double>& distribution, std::default_random_engine& generator){
       unsigned_int_type dp_idx = starting_point;
       int walk_length = 0;
       do{
         const double rnd_num = distribution(generator);
-        unsigned_int_type idx_knn = dp_idx;
-        double incremental_prob = 0;
-        for(auto& elem: transition_matrix[dp_idx]){
-          incremental_prob += elem.second;
-          if(rnd_num < incremental_prob){
-            idx_knn = elem.first;
-            break;
-          }
-        }
+        unsigned_int_type idx_knn = walk_table.step(dp_idx,rnd_num);
         //assert(idx_knn != dp_idx);
         if(idx_knn == dp_idx){
           return -1;
-          std::cout << "42!" << std::endl;
         }
         dp_idx = idx_knn;
         ++walk_length;
@@ -1241,7 +1412,7 @@ namespace hdi{
       std::cout << "GCD dispatch, hierarchical_sne_inl 1227.\n";
       dispatch_apply(res.size(), dispatch_get_global_queue(0, 0), ^(size_t i) {
 #else
-#pragma omp parallel for
+#pragma omp parallel for num_threads(hsne.numThreads())
       for(int i = 0; i < res.size(); ++i){
 #endif //__APPLE__
         computePointToClusterAssociation(hsne,i,res[i]);
@@ -1308,6 +1479,83 @@ namespace hdi{
 
       ///////////////////////////////////////////////////////
 
+      // Layout of version 2.0, all integers little endian:
+      //   float32 major version (2), float32 minor version (0)  - same position as in version 0.0
+      //   uint64 flags (bit 0: LZ4 compressed blocks), uint64 number of scales
+      //   per scale: uint64 size, uint64 byte offset and uint64 number of bytes of the scale
+      //   per scale: the blocks (see data::IO::saveBlock) of the transition matrix as CSR arrays and, for the
+      //   subscales, landmarks to original data (uint32), landmarks to previous scale (uint32), landmark weights
+      //   (float32), previous scale to current scale (int32) and the area of influence as CSR arrays
+      template <typename hsne_type, class output_stream_type>
+      void saveHSNEv2(const hsne_type& hsne, output_stream_type& stream, bool compress, utils::AbstractLog* log){
+        checkAndThrowLogic(hsne.hierarchy().size(),"Cannot save an empty H-SNE hierarchy!!!");
+
+        float major_version = 2;
+        float minor_version = 0;
+        stream.write(reinterpret_cast<char*>(&major_version),sizeof(float));
+        stream.write(reinterpret_cast<char*>(&minor_version),sizeof(float));
+        uint64_t flags = compress ? 1 : 0;
+        uint64_t num_scales = hsne.hierarchy().size();
+        stream.write(reinterpret_cast<char*>(&flags),sizeof(uint64_t));
+        stream.write(reinterpret_cast<char*>(&num_scales),sizeof(uint64_t));
+        // the table is written once the offsets are known
+        const auto table_pos = stream.tellp();
+        std::vector<uint64_t> table(3*num_scales,0);
+        stream.write(reinterpret_cast<char*>(table.data()),table.size()*sizeof(uint64_t));
+        for(uint64_t s = 0; s < num_scales; ++s){
+          auto& scale = hsne.scale(s);
+          const auto begin = stream.tellp();
+          data::IO::saveSparseMatrixCSR(scale._transition_matrix,stream,compress);
+          if(s > 0){
+            data::IO::saveVectorBlock<uint32_t>(scale._landmark_to_original_data_idx,stream,compress);
+            data::IO::saveVectorBlock<uint32_t>(scale._landmark_to_previous_scale_idx,stream,compress);
+            data::IO::saveVectorBlock<float>(scale._landmark_weight,stream,compress);
+            data::IO::saveVectorBlock<int32_t>(scale._previous_scale_to_landmark_idx,stream,compress);
+            data::IO::saveSparseMatrixCSR(scale._area_of_influence,stream,compress);
+          }
+          table[3*s] = scale.size();
+          table[3*s+1] = static_cast<uint64_t>(begin);
+          table[3*s+2] = static_cast<uint64_t>(stream.tellp() - begin);
+        }
+        const auto end = stream.tellp();
+        stream.seekp(table_pos);
+        stream.write(reinterpret_cast<char*>(table.data()),table.size()*sizeof(uint64_t));
+        stream.seekp(end);
+      }
+
+      template <typename hsne_type, class input_stream_type>
+      void loadHSNEv2(hsne_type& hsne, input_stream_type& stream, utils::AbstractLog* log){
+        uint64_t flags, num_scales;
+        stream.read(reinterpret_cast<char*>(&flags),sizeof(uint64_t));
+        stream.read(reinterpret_cast<char*>(&num_scales),sizeof(uint64_t));
+        checkAndThrowRuntime(num_scales > 0 ,"Cannot load an empty hierarchy");
+        std::vector<uint64_t> table(3*num_scales);
+        stream.read(reinterpret_cast<char*>(table.data()),table.size()*sizeof(uint64_t));
+        hsne.hierarchy().clear();
+        for(uint64_t s = 0; s < num_scales; ++s){
+          hsne.hierarchy().push_back(typename hsne_type::Scale());
+          auto& scale = hsne.scale(s);
+          stream.seekg(table[3*s+1]);
+          data::IO::loadSparseMatrixCSR(scale._transition_matrix,stream);
+          if(s == 0){
+            const uint64_t n = table[0];
+            scale._landmark_to_original_data_idx.resize(n);
+            std::iota(scale._landmark_to_original_data_idx.begin(),scale._landmark_to_original_data_idx.end(),0);
+            scale._landmark_to_previous_scale_idx.resize(n);
+            std::iota(scale._landmark_to_previous_scale_idx.begin(),scale._landmark_to_previous_scale_idx.end(),0);
+            scale._landmark_weight.resize(n,1);
+          }else{
+            data::IO::loadVectorBlock<uint32_t>(scale._landmark_to_original_data_idx,stream);
+            data::IO::loadVectorBlock<uint32_t>(scale._landmark_to_previous_scale_idx,stream);
+            data::IO::loadVectorBlock<float>(scale._landmark_weight,stream);
+            data::IO::loadVectorBlock<int32_t>(scale._previous_scale_to_landmark_idx,stream);
+            data::IO::loadSparseMatrixCSR(scale._area_of_influence,stream);
+          }
+        }
+      }
+
+      ///////////////////////////////////////////////////////
+
       template <typename hsne_type, class input_stream_type>
       void loadHSNE(hsne_type& hsne, input_stream_type& stream, utils::AbstractLog* log){
         // utils::secureLog(log, "Loading H-SNE hierarchy from file");
@@ -1319,6 +1567,10 @@ namespace hdi{
         io_unsigned_int_type minor_version = 0;
         stream.read(reinterpret_cast<char*>(&major_version),sizeof(io_unsigned_int_type));
         stream.read(reinterpret_cast<char*>(&minor_version),sizeof(io_unsigned_int_type));
+        if(major_version == 2 && minor_version == 0){
+          loadHSNEv2(hsne,stream,log);
+          return;
+        }
         checkAndThrowRuntime(major_version == 0,"Invalid major version");
         checkAndThrowRuntime(minor_version == 0,"Invalid minor version");
 
@@ -33,6 +33,11 @@
 #ifndef IO_H
 #define IO_H
 
+#include <stdint.h>
+#include <vector>
+#include <lz4.h>
+#include "assert_by_exception.h"
+
 
 namespace hdi{
   namespace data{
@@ -137,6 +142,98 @@ namespace hdi{
         }
       }
 
+    ///////////////////////////////////////////////////////////////////////
+    // Blocks of the compact (v2) format: uint64 number of bytes, uint64 number of stored bytes and the stored bytes,
+    // padded to a multiple of 8 so that every uncompressed array starts 8-byte aligned in the file.
+    // A block is stored LZ4 compressed only if that makes it smaller, readers recognize it by stored < bytes.
+
+      template <class output_stream_type>
+      void saveBlock(const char* data, uint64_t num_bytes, bool compress, output_stream_type& stream){
+        std::vector<char> compressed;
+        uint64_t num_stored = num_bytes;
+        if(compress && num_bytes > 0 && num_bytes <= LZ4_MAX_INPUT_SIZE){
+          compressed.resize(LZ4_compressBound(static_cast<int>(num_bytes)));
+          int res = LZ4_compress_default(data,compressed.data(),static_cast<int>(num_bytes),static_cast<int>(compressed.size()));
+          if(res > 0 && static_cast<uint64_t>(res) < num_bytes){
+            num_stored = res;
+            data = compressed.data();
+          }
+        }
+        stream.write(reinterpret_cast<char*>(&num_bytes),sizeof(uint64_t));
+        stream.write(reinterpret_cast<char*>(&num_stored),sizeof(uint64_t));
+        stream.write(data,num_stored);
+        const char padding[8] = {0};
+        stream.write(padding,(8 - num_stored % 8) % 8);
+      }
+      template <class input_stream_type>
+      void loadBlock(std::vector<char>& data, input_stream_type& stream){
+        uint64_t num_bytes, num_stored;
+        stream.read(reinterpret_cast<char*>(&num_bytes),sizeof(uint64_t));
+        stream.read(reinterpret_cast<char*>(&num_stored),sizeof(uint64_t));
+        data.resize(num_bytes);
+        if(num_stored < num_bytes){
+          std::vector<char> compressed(num_stored);
+          stream.read(compressed.data(),num_stored);
+          int res = LZ4_decompress_safe(compressed.data(),data.data(),static_cast<int>(num_stored),static_cast<int>(num_bytes));
+          checkAndThrowRuntime(static_cast<uint64_t>(res) == num_bytes,"Corrupted LZ4 block");
+        }else{
+          stream.read(data.data(),num_bytes);
+        }
+        char padding[8];
+        stream.read(padding,(8 - num_stored % 8) % 8);
+      }
+
+      template <typename io_type, typename vector_type, class output_stream_type>
+      void saveVectorBlock(const vector_type& vector, output_stream_type& stream, bool compress){
+        std::vector<io_type> io_vector(vector.begin(),vector.end());
+        saveBlock(reinterpret_cast<const char*>(io_vector.data()),io_vector.size()*sizeof(io_type),compress,stream);
+      }
+      template <typename io_type, typename vector_type, class input_stream_type>
+      void loadVectorBlock(vector_type& vector, input_stream_type& stream){
+        std::vector<char> data;
+        loadBlock(data,stream);
+        const io_type* begin = reinterpret_cast<const io_type*>(data.data());
+        vector.assign(begin,begin+data.size()/sizeof(io_type));
+      }
+
+      //! Sparse matrix as three blocks of CSR arrays: uint64 row pointers, uint32 column indices and float values
+      template <typename sparse_scalar_matrix_type, class output_stream_type>
+      void saveSparseMatrixCSR(const sparse_scalar_matrix_type& matrix, output_stream_type& stream, bool compress){
+        std::vector<uint64_t> indptr(matrix.size()+1,0);
+        for(size_t j = 0; j < matrix.size(); ++j){
+          indptr[j+1] = indptr[j] + matrix[j].size();
+        }
+        std::vector<uint32_t> indices;
+        std::vector<float> values;
+        indices.reserve(indptr.back());
+        values.reserve(indptr.back());
+        for(auto& row: matrix){
+          for(auto& elem: row){
+            indices.push_back(static_cast<uint32_t>(elem.first));
+            values.push_back(static_cast<float>(elem.second));
+          }
+        }
+        saveVectorBlock<uint64_t>(indptr,stream,compress);
+        saveVectorBlock<uint32_t>(indices,stream,compress);
+        saveVectorBlock<float>(values,stream,compress);
+      }
+      template <typename sparse_scalar_matrix_type, class input_stream_type>
+      void loadSparseMatrixCSR(sparse_scalar_matrix_type& matrix, input_stream_type& stream){
+        std::vector<uint64_t> indptr;
+        std::vector<uint32_t> indices;
+        std::vector<float> values;
+        loadVectorBlock<uint64_t>(indptr,stream);
+        loadVectorBlock<uint32_t>(indices,stream);
+        loadVectorBlock<float>(values,stream);
+        matrix.clear();
+        matrix.resize(indptr.size()-1);
+        for(size_t j = 0; j+1 < indptr.size(); ++j){
+          for(uint64_t i = indptr[j]; i < indptr[j+1]; ++i){
+            matrix[j][indices[i]] = values[i];
+          }
+        }
+      }
+
     ///////////////////////////////////////////////////////////////////////
 
       template <typename sparse_scalar_matrix_type, class output_stream_type>
@@ -35,6 +35,9 @@
 
 #include "abstract_log.h"
 #include <string>
+#include <atomic>
+#include <functional>
+#include <stdint.h>
 #include <omp.h>
 
 namespace hdi{
@@ -81,6 +84,45 @@ namespace hdi{
       int _current_tick;
       std::string _name;
     };
+
+    //! reports the progress of a parallel loop to a callback with the name of the loop, the steps done and the total
+    //! \note the callback is invoked at most num_ticks times, by the thread that completes a tick. Threads that
+    //! complete a tick while the callback is running go on without waiting, their tick is reported by the next one
+    class CallbackProgress{
+    public:
+      typedef std::function<void(const std::string&, uint64_t, uint64_t)> callback_type;
+
+      CallbackProgress(const callback_type& callback, const std::string& name, uint64_t num_steps, uint64_t num_ticks = 100):
+        _callback(callback),_name(name),_num_steps(num_steps),_num_ticks(num_ticks),_current_step(0),_current_tick(0)
+      {_busy.clear();}
+      //! report the start of the loop
+      void start(){if(_callback){_callback(_name,0,_num_steps);}}
+      //! report the end of the loop
+      void finish(){if(_callback){_callback(_name,_num_steps,_num_steps);}}
+
+      //! make a step
+      inline void step(){
+        if(!_callback){return;}
+        const uint64_t current = ++_current_step;
+        const uint64_t tick = _num_steps?current*_num_ticks/_num_steps:0;
+        if(tick > _current_tick && tick < _num_ticks && !_busy.test_and_set()){
+          if(tick > _current_tick){
+            _current_tick = tick;
+            _callback(_name,current,_num_steps);
+          }
+          _busy.clear();
+        }
+      }
+
+    private:
+      callback_type _callback;
+      std::string _name;
+      uint64_t _num_steps;
+      uint64_t _num_ticks;
+      std::atomic<uint64_t> _current_step;
+      std::atomic<uint64_t> _current_tick;
+      std::atomic_flag _busy;
+    };
   }
 }
 
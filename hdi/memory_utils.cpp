@@ -30,8 +30,38 @@
  *
  */
 
+#include "memory_utils.h"
+
+#ifdef _WIN32
+#include <windows.h>
+#include <psapi.h>
+#else
+#include <sys/resource.h>
+#endif
+
 namespace hdi{
   namespace utils{
 
+    uint64_t peakResidentMemory(){
+#ifdef _WIN32
+      PROCESS_MEMORY_COUNTERS counters;
+      if(!GetProcessMemoryInfo(GetCurrentProcess(), &counters, sizeof(counters))){
+        return 0;
+      }
+      return counters.PeakWorkingSetSize;
+#else
+      struct rusage usage;
+      if(getrusage(RUSAGE_SELF, &usage) != 0){
+        return 0;
+      }
+#ifdef __APPLE__
+      return usage.ru_maxrss;
+#else
+      //kilobytes on Linux
+      return uint64_t(usage.ru_maxrss) * 1024;
+#endif
+#endif
+    }
+
   }
 }
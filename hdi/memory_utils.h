@@ -33,9 +33,14 @@
 #ifndef MEMORY_UTILS_H
 #define MEMORY_UTILS_H
 
+#include <stdint.h>
+
 namespace hdi{
   namespace utils{
 
+    //! Return the peak resident set size of the process in bytes, 0 if it is not available on the platform
+    uint64_t peakResidentMemory();
+
   }
 }
 #endif
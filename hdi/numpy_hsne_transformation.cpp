@@ -5,19 +5,202 @@
 #include "cout_log.h"
 #include "hierarchical_sne_inl.h"
 #include "map_mem_eff.h"
+#include "memory_utils.h"
 
 #include <iostream>
 #include <fstream>
 #include <string>
 #include <sstream>
 #include <map>
+#include <memory>
+#include <atomic>
+#include <exception>
 
 namespace py = pybind11;
 
-bool numpy_to_hsne(
-    py::array_t<float, py::array::c_style | py::array::forcecast> &X,
-    const std::string &filePath,
+typedef std::vector<hdi::data::MapMemEff<uint32_t, float>> sparse_matrix_type;
+typedef hdi::dr::HierarchicalSNE<float, sparse_matrix_type> hsne_type;
+
+// Hands a vector over to numpy without copying it, the array owns the memory through a capsule
+template <typename T>
+py::array_t<T> vector_to_array(std::vector<T>&& vector) {
+    auto* owned = new std::vector<T>(std::move(vector));
+    py::capsule free_when_done(owned, [](void* ptr) {
+        delete reinterpret_cast<std::vector<T>*>(ptr);
+    });
+    return py::array_t<T>(owned->size(), owned->data(), free_when_done);
+}
+
+// Converts a sparse matrix to CSR arrays and releases the memory of the original matrix
+void sparse_matrix_to_csr(sparse_matrix_type& matrix, py::dict& scale_dict, const std::string& prefix) {
+    std::vector<int64_t> indptr(matrix.size() + 1, 0);
+    for (size_t j = 0; j < matrix.size(); ++j) {
+        indptr[j + 1] = indptr[j] + matrix[j].size();
+    }
+    std::vector<int32_t> indices(indptr.back());
+    std::vector<float> data(indptr.back());
+    for (size_t j = 0; j < matrix.size(); ++j) {
+        int64_t i = indptr[j];
+        for (auto& elem : matrix[j]) {
+            indices[i] = static_cast<int32_t>(elem.first);
+            data[i] = elem.second;
+            ++i;
+        }
+    }
+    sparse_matrix_type().swap(matrix);
+    scale_dict[(prefix + "_indptr").c_str()] = vector_to_array(std::move(indptr));
+    scale_dict[(prefix + "_indices").c_str()] = vector_to_array(std::move(indices));
+    scale_dict[(prefix + "_data").c_str()] = vector_to_array(std::move(data));
+}
+
+// Builds a sparse matrix from CSR arrays, whose column indices have to be sorted within every row
+sparse_matrix_type csr_to_sparse_matrix(const int64_t* row_ptr, const int32_t* col_ptr, const float* data_ptr,
+                                        size_t num_points) {
+    sparse_matrix_type matrix(num_points);
+    std::vector<std::pair<uint32_t, float>> row;
+    for (size_t i = 0; i < num_points; ++i) {
+        row.clear();
+        for (int64_t j = row_ptr[i]; j < row_ptr[i + 1]; ++j) {
+            row.emplace_back(static_cast<uint32_t>(col_ptr[j]), data_ptr[j]);
+        }
+        matrix[i].initialize(row.begin(), row.end());
+    }
+    return matrix;
+}
+
+// Statistics of the computation of a scale, gathered while the GIL is released
+struct ScaleStatistics {
+    hsne_type::Statistics statistics;
+    size_t scale;
+    size_t size;
+    uint64_t tmatrix_nnz;
+    uint64_t area_of_influence_nnz;
+    uint64_t peak_rss_bytes;
+};
+
+uint64_t sparse_matrix_nnz(const sparse_matrix_type& matrix) {
+    uint64_t nnz = 0;
+    for (const auto& row : matrix) {
+        nnz += row.size();
+    }
+    return nnz;
+}
+
+void collect_statistics(hsne_type& hsne, std::vector<ScaleStatistics>& statistics) {
+    const size_t s = hsne.hierarchy().size() - 1;
+    const auto& scale = hsne.scale(s);
+    statistics.push_back({hsne.statistics(), s, scale.size(), sparse_matrix_nnz(scale._transition_matrix),
+                          sparse_matrix_nnz(scale._area_of_influence), hdi::utils::peakResidentMemory()});
+}
+
+// Times are in seconds, statistics that do not apply to the scale (-1 in HierarchicalSNE::Statistics) are left out
+py::list statistics_to_list(const std::vector<ScaleStatistics>& statistics) {
+    py::list result;
+    for (const auto& entry : statistics) {
+        const auto& stats = entry.statistics;
+        py::dict stats_dict;
+        stats_dict["scale"] = entry.scale;
+        stats_dict["size"] = entry.size;
+        stats_dict["tmatrix_nnz"] = entry.tmatrix_nnz;
+        if (entry.scale > 0) {
+            stats_dict["area_of_influence_nnz"] = entry.area_of_influence_nnz;
+        }
+        stats_dict["peak_rss_bytes"] = entry.peak_rss_bytes;
+        const std::pair<const char*, float> values[] = {
+            {"total_time", stats._total_time},
+            {"init_knn_time", stats._init_knn_time},
+            {"init_probabilities_time", stats._init_probabilities_time},
+            {"init_fmc_time", stats._init_fmc_time},
+            {"mcmc_sampling_time", stats._mcmc_sampling_time},
+            {"landmarks_selection_time", stats._landmarks_selection_time},
+            {"landmarks_selection_num_walks", stats._landmarks_selection_num_walks},
+            {"aoi_time", stats._aoi_time},
+            {"fmc_time", stats._fmc_time},
+            {"aoi_num_walks", stats._aoi_num_walks},
+            {"aoi_sparsity", stats._aoi_sparsity},
+            {"fmc_sparsity", stats._fmc_sparsity},
+            {"fmc_effective_sparsity", stats._fmc_effective_sparsity}};
+        for (const auto& value : values) {
+            if (value.second == -1) {
+                continue;
+            }
+            if (std::string(value.first).find("num_walks") != std::string::npos) {
+                stats_dict[value.first] = static_cast<uint64_t>(value.second);
+            } else {
+                stats_dict[value.first] = value.second;
+            }
+        }
+        result.append(stats_dict);
+    }
+    return result;
+}
+
+// Calls a Python progress callback from the worker threads of the computation, which runs without the GIL. The GIL
+// is taken only for the call itself. The first exception raised by the callback stops further calls and is raised
+// again once the computation is done
+class PythonProgress {
+public:
+    explicit PythonProgress(py::object callback) : _callback(std::move(callback)), _failed(false) {}
+
+    void attach(hsne_type& hsne) {
+        if (_callback.is_none()) {
+            return;
+        }
+        hsne.setProgressCallback([this](const std::string& stage, uint32_t scale, uint64_t done, uint64_t total) {
+            if (_failed) {
+                return;
+            }
+            py::gil_scoped_acquire acquire;
+            try {
+                _callback(stage, scale, done, total);
+            } catch (py::error_already_set&) {
+                if (!_failed.exchange(true)) {
+                    _error = std::current_exception();
+                }
+            }
+        });
+    }
+
+    void rethrow() const {
+        if (_error) {
+            std::rethrow_exception(_error);
+        }
+    }
+
+private:
+    py::object _callback;
+    std::atomic<bool> _failed;
+    std::exception_ptr _error;
+};
+
+void add_scales(hsne_type& hsne, int num_scales, std::vector<ScaleStatistics>& statistics) {
+    collect_statistics(hsne, statistics);
+    for (int s = 0; s < num_scales - 1; ++s) {
+        hsne.addScale();
+        collect_statistics(hsne, statistics);
+    }
+}
+
+// The buffer is requested by the caller so that the computation itself can run without the GIL
+void compute_hierarchy(
+    hsne_type& hsne,
+    const py::buffer_info& X_info,
     int num_scales,
+    const hsne_type::Parameters& params,
+    std::vector<ScaleStatistics>& statistics
+    ) {
+    if (X_info.ndim != 2) {
+        throw std::runtime_error("Expecting input data to have two dimensions, data point and values");
+    }
+    int _num_data_points = X_info.shape[0];
+    int _num_dimensions = X_info.shape[1];
+
+    hsne.setDimensionality(_num_dimensions);
+    hsne.initialize(static_cast<float *>(X_info.ptr), _num_data_points, params);
+    add_scales(hsne, num_scales, statistics);
+}
+
+hsne_type::Parameters make_parameters(
     int seed,
     float landmark_threshold,
     int num_neighbors,
@@ -27,20 +210,10 @@ bool numpy_to_hsne(
     int num_walks,
     int num_walks_per_landmark,
     bool monte_carlo_sampling,
-    bool out_of_core_computation
+    bool out_of_core_computation,
+    int num_threads
     ) {
-    
-    //hdi::utils::CoutLog log;
-    hdi::dr::HierarchicalSNE<float, std::vector<hdi::data::MapMemEff<uint32_t,float>>>::Parameters params;
-    std::vector< std::vector<float>* > _landmarkWeights;
-    hdi::dr::HierarchicalSNE<float, std::vector<hdi::data::MapMemEff<uint32_t,float>>> _hsne;
-
-    std::vector<hdi::data::MapMemEff<uint32_t, float>> *top_scale_matrix = nullptr;
-
-    std::vector<uint64_t> placeholder (X.request().shape[0]);
-    uint64_t *point_ids = placeholder.data();
-    int num_point_ids = X.request().shape[0];
-
+    hsne_type::Parameters params;
     params._seed = seed;
     params._mcmcs_landmark_thresh = landmark_threshold;
     params._num_neighbors = num_neighbors;
@@ -52,58 +225,406 @@ bool numpy_to_hsne(
 
     params._monte_carlo_sampling = monte_carlo_sampling;
     params._out_of_core_computation = out_of_core_computation;
+    params._num_threads = num_threads;
+    return params;
+}
 
-    if (nullptr == point_ids) {
-        std::cout << "No point ids\n";
+// Scales are moved out of the hierarchy one by one so that every matrix exists only once
+py::list scales_to_list(hsne_type& hsne, const std::vector<ScaleStatistics>& statistics) {
+    py::list scales;
+    py::list statistics_list = statistics_to_list(statistics);
+    for (size_t s = 0; s < hsne.hierarchy().size(); ++s) {
+        auto& scale = hsne.scale(s);
+        py::dict scale_dict;
+        scale_dict["size"] = scale.size();
+        scale_dict["statistics"] = statistics_list[s];
+        sparse_matrix_to_csr(scale._transition_matrix, scale_dict, "tmatrix");
+        if (s > 0) {
+            scale_dict["lm_to_original"] = vector_to_array(std::move(scale._landmark_to_original_data_idx));
+            scale_dict["lm_to_previous"] = vector_to_array(std::move(scale._landmark_to_previous_scale_idx));
+            scale_dict["lm_weights"] = vector_to_array(std::move(scale._landmark_weight));
+            scale_dict["previous_to_current"] = vector_to_array(std::move(scale._previous_scale_to_landmark_idx));
+            sparse_matrix_to_csr(scale._area_of_influence, scale_dict, "area_of_influence");
+        }
+        scales.append(scale_dict);
     }
+    return scales;
+}
 
-    try {
-        auto X_loc = X;
-        py::buffer_info X_info = X_loc.request();
-        if (X_info.ndim != 2) {
-            throw std::runtime_error("Expecting input data to have two dimensions, data point and values");
+// Version 0 is the original format of the HDI library, version 2 the compact format with random access to the scales
+void save_hierarchy(const hsne_type& hsne, const std::string &filePath, int file_version, bool compress) {
+    hdi::checkAndThrowRuntime(file_version == 0 || file_version == 2, "Unsupported .hsne file version");
+    std::ofstream filebin (filePath, std::ios::binary); // binary format
+    if (file_version == 2) {
+        hdi::dr::IO::saveHSNEv2(hsne, filebin, compress, nullptr);
+    } else {
+        hdi::dr::IO::saveHSNE(hsne, filebin, nullptr);
+    }
+}
+
+// Returns the statistics of every scale, None if the computation failed
+py::object numpy_to_hsne(
+    py::array_t<float, py::array::c_style | py::array::forcecast> &X,
+    const std::string &filePath,
+    int num_scales,
+    int seed,
+    float landmark_threshold,
+    int num_neighbors,
+    int num_trees,
+    int num_checks,
+    float transition_matrix_prune_thresh,
+    int num_walks,
+    int num_walks_per_landmark,
+    bool monte_carlo_sampling,
+    bool out_of_core_computation,
+    int num_threads,
+    int file_version,
+    bool compress,
+    py::object progress
+    ) {
+    hsne_type::Parameters params = make_parameters(seed, landmark_threshold, num_neighbors, num_trees, num_checks,
+        transition_matrix_prune_thresh, num_walks, num_walks_per_landmark, monte_carlo_sampling, out_of_core_computation,
+        num_threads);
+
+    PythonProgress progress_callback(progress);
+    std::vector<ScaleStatistics> statistics;
+    bool success = true;
+    {
+        py::buffer_info X_info = X.request();
+        py::gil_scoped_release release;
+        try {
+            hsne_type _hsne;
+            progress_callback.attach(_hsne);
+            compute_hierarchy(_hsne, X_info, num_scales, params, statistics);
+            save_hierarchy(_hsne, filePath, file_version, compress);
+        }
+        catch (const std::exception& e) {
+            std::cout << "Fatal error: " << e.what() << std::endl;
+            success = false;
         }
-        int _num_data_points = X_info.shape[0];
-        int _num_dimensions = X_info.shape[1];
+    }
+    progress_callback.rethrow();
+    if (!success) {
+        return py::none();
+    }
+    return statistics_to_list(statistics);
+}
 
-        hdi::dr::HierarchicalSNE<float, std::vector<hdi::data::MapMemEff<uint32_t,float>>> _hsne;
-        //_hsne.setLogger(&log);
-        _hsne.setDimensionality(_num_dimensions);
+// C-contiguous float32 input, np.memmap included, is used in place without a copy
+py::list numpy_to_hsne_scales(
+    py::array_t<float, py::array::c_style | py::array::forcecast> &X,
+    int num_scales,
+    int seed,
+    float landmark_threshold,
+    int num_neighbors,
+    int num_trees,
+    int num_checks,
+    float transition_matrix_prune_thresh,
+    int num_walks,
+    int num_walks_per_landmark,
+    bool monte_carlo_sampling,
+    bool out_of_core_computation,
+    const std::string &filePath,
+    int num_threads,
+    py::object knn_indices,
+    py::object knn_distances,
+    int file_version,
+    bool compress,
+    py::object progress
+    ) {
+    hsne_type::Parameters params = make_parameters(seed, landmark_threshold, num_neighbors, num_trees, num_checks,
+        transition_matrix_prune_thresh, num_walks, num_walks_per_landmark, monte_carlo_sampling, out_of_core_computation,
+        num_threads);
 
-        if (top_scale_matrix == nullptr) {
-            _hsne.initialize(static_cast<float *>(X_info.ptr), _num_data_points, params);
-            //std::cout << _hsne.hierarchy().size() << std::endl;
-            //_hsne.statistics().log(&log);
+    hsne_type _hsne;
+    PythonProgress progress_callback(progress);
+    progress_callback.attach(_hsne);
+    std::vector<ScaleStatistics> statistics;
+    py::buffer_info X_info = X.request();
+    if (!knn_indices.is_none()) {
+        // Copied because the graph is turned into transition probabilities in place
+        auto indices = knn_indices.cast<py::array_t<int32_t, py::array::c_style | py::array::forcecast>>();
+        auto distances = knn_distances.cast<py::array_t<float, py::array::c_style | py::array::forcecast>>();
+        _hsne.setNeighborhoodGraph(std::vector<int>(indices.data(), indices.data() + indices.size()),
+                                   hsne_type::scalar_vector_type(distances.data(), distances.data() + distances.size()));
+    }
+    {
+        py::gil_scoped_release release;
+        compute_hierarchy(_hsne, X_info, num_scales, params, statistics);
+        if (!filePath.empty()) {
+            save_hierarchy(_hsne, filePath, file_version, compress);
+        }
+    }
+    progress_callback.rethrow();
 
-            _landmarkWeights.resize(num_scales);
+    return scales_to_list(_hsne, statistics);
+}
 
-            for (int s = 0; s < num_scales; ++s) {
-                _landmarkWeights[s] = NULL;
-            }
+// The first scale is given by a row-stochastic transition matrix in CSR layout with sorted column indices
+py::list similarities_to_hsne_scales(
+    py::array_t<int64_t, py::array::c_style | py::array::forcecast> &indptr,
+    py::array_t<int32_t, py::array::c_style | py::array::forcecast> &indices,
+    py::array_t<float, py::array::c_style | py::array::forcecast> &data,
+    int num_scales,
+    int seed,
+    float landmark_threshold,
+    float transition_matrix_prune_thresh,
+    int num_walks,
+    int num_walks_per_landmark,
+    bool monte_carlo_sampling,
+    bool out_of_core_computation,
+    const std::string &filePath,
+    int num_threads,
+    int file_version,
+    bool compress,
+    py::object progress
+    ) {
+    hsne_type::Parameters params = make_parameters(seed, landmark_threshold, 0, 0, 0,
+        transition_matrix_prune_thresh, num_walks, num_walks_per_landmark, monte_carlo_sampling, out_of_core_computation,
+        num_threads);
+    const int64_t *row_ptr = indptr.data();
+    const int32_t *col_ptr = indices.data();
+    const float *data_ptr = data.data();
+    const size_t num_points = indptr.size() - 1;
 
-            for (int s = 0; s < num_scales - 1; ++s) {
-                _hsne.addScale();
-            }
-            
-            hdi::utils::AbstractLog* logger;
-            std::ofstream filebin (filePath, std::ios::binary); // binary format
-            hdi::dr::IO::saveHSNE(_hsne, filebin, logger);
-        } else {
-            _hsne.initialize(*top_scale_matrix, params);
+    hsne_type _hsne;
+    PythonProgress progress_callback(progress);
+    progress_callback.attach(_hsne);
+    std::vector<ScaleStatistics> statistics;
+    {
+        py::gil_scoped_release release;
+        sparse_matrix_type similarities = csr_to_sparse_matrix(row_ptr, col_ptr, data_ptr, num_points);
+        _hsne.initialize(similarities, params);
+        sparse_matrix_type().swap(similarities);
+        add_scales(_hsne, num_scales, statistics);
+        if (!filePath.empty()) {
+            save_hierarchy(_hsne, filePath, file_version, compress);
         }
     }
-    catch (const std::exception& e) {
-        std::cout << "Fatal error: " << e.what() << std::endl;
-        return false;
+    progress_callback.rethrow();
+    return scales_to_list(_hsne, statistics);
+}
+
+// Random walks of a fixed length from every point, as taken by the Monte Carlo landmark selection.
+// Every step either samples the alias table of a WalkTable or, with linear_scan, sums the probabilities of the row
+// until they exceed the draw, as HSNE did before. Both sample the neighbors with the same probabilities.
+py::dict random_walks(
+    py::array_t<int64_t, py::array::c_style | py::array::forcecast> &indptr,
+    py::array_t<int32_t, py::array::c_style | py::array::forcecast> &indices,
+    py::array_t<float, py::array::c_style | py::array::forcecast> &data,
+    int num_walks,
+    int walk_length,
+    int seed,
+    int num_threads,
+    bool linear_scan
+    ) {
+    const int64_t num_points = static_cast<int64_t>(indptr.size()) - 1;
+    std::vector<uint32_t> counts(num_points, 0);
+    float build_seconds = 0;
+    float walk_seconds = 0;
+    uint64_t table_bytes = 0;
+#ifdef _OPENMP
+    const int threads = num_threads > 0 ? num_threads : omp_get_max_threads();
+#else
+    const int threads = 1;
+#endif
+    {
+        py::gil_scoped_release release;
+        const sparse_matrix_type matrix = csr_to_sparse_matrix(indptr.data(), indices.data(), data.data(), num_points);
+        std::unique_ptr<hdi::dr::WalkTable> table;
+        if (!linear_scan) {
+            hdi::utils::ScopedTimer<float, hdi::utils::Seconds> timer(build_seconds);
+            table.reset(new hdi::dr::WalkTable(matrix, threads));
+            table_bytes = table->memory();
+        }
+        hdi::utils::ScopedTimer<float, hdi::utils::Seconds> timer(walk_seconds);
+        #pragma omp parallel for num_threads(threads)
+        for (int64_t d = 0; d < num_points; ++d) {
+            std::seed_seq stream{static_cast<uint32_t>(seed), static_cast<uint32_t>(d)};
+            std::default_random_engine generator(stream);
+            std::uniform_real_distribution<double> distribution(0.0, 1.0);
+            for (int w = 0; w < num_walks; ++w) {
+                uint32_t idx = static_cast<uint32_t>(d);
+                int length = 0;
+                for (; length <= walk_length; ++length) {
+                    const double rnd_num = distribution(generator);
+                    uint32_t next = idx;
+                    if (linear_scan) {
+                        double incremental_prob = 0;
+                        for (auto& elem : matrix[idx]) {
+                            incremental_prob += elem.second;
+                            if (rnd_num < incremental_prob) {
+                                next = elem.first;
+                                break;
+                            }
+                        }
+                    } else {
+                        next = table->step(idx, rnd_num);
+                    }
+                    if (next == idx) {
+                        break;
+                    }
+                    idx = next;
+                }
+                if (length > walk_length) {
+                    #pragma omp atomic
+                    ++counts[idx];
+                }
+            }
+        }
     }
+    py::dict result;
+    result["counts"] = vector_to_array(std::move(counts));
+    result["build_seconds"] = build_seconds;
+    result["walk_seconds"] = walk_seconds;
+    result["table_bytes"] = table_bytes;
+    return result;
+}
 
-    return true;
+py::tuple flann_knn(
+    py::array_t<float, py::array::c_style | py::array::forcecast> &X,
+    int num_neighbors,
+    int num_trees,
+    int num_checks,
+    int seed,
+    int num_threads
+    ) {
+    py::buffer_info X_info = X.request();
+    if (X_info.ndim != 2) {
+        throw std::runtime_error("Expecting input data to have two dimensions, data point and values");
+    }
+    const size_t num_points = X_info.shape[0];
+    const size_t nn = num_neighbors + 1;
+    std::vector<int32_t> indices(num_points * nn);
+    std::vector<float> distances(num_points * nn);
+    {
+        py::gil_scoped_release release;
+        flann::Matrix<float> dataset(static_cast<float *>(X_info.ptr), num_points, X_info.shape[1]);
+        flann::Index<flann::L2<float>> index(dataset, flann::KDTreeIndexParams(num_trees));
+        flann::seed_random(seed > 0 ? seed : std::random_device()());
+        index.buildIndex();
+        flann::Matrix<int> indices_mat(indices.data(), num_points, nn);
+        flann::Matrix<float> dists_mat(distances.data(), num_points, nn);
+        flann::SearchParams params(num_checks);
+        params.cores = num_threads;
+        index.knnSearch(dataset, indices_mat, dists_mat, nn, params);
+    }
+    py::array indices_array = vector_to_array(std::move(indices));
+    py::array distances_array = vector_to_array(std::move(distances));
+    return py::make_tuple(indices_array.attr("reshape")(num_points, nn), distances_array.attr("reshape")(num_points, nn));
 }
 
+// kd-trees of a reference data set that answer nearest neighbor queries of new points. The reference array is
+// held by the index, FLANN searches it in place
+class FlannIndex {
+public:
+    FlannIndex(
+        py::array_t<float, py::array::c_style | py::array::forcecast> X,
+        int num_trees,
+        int num_checks,
+        int seed,
+        int num_threads
+        ) : _data(X), _num_checks(num_checks), _num_threads(num_threads) {
+        py::buffer_info X_info = _data.request();
+        if (X_info.ndim != 2) {
+            throw std::runtime_error("Expecting input data to have two dimensions, data point and values");
+        }
+        _num_points = X_info.shape[0];
+        _dimensionality = X_info.shape[1];
+        py::gil_scoped_release release;
+        flann::Matrix<float> dataset(static_cast<float *>(X_info.ptr), _num_points, _dimensionality);
+        _index.reset(new flann::Index<flann::L2<float>>(dataset, flann::KDTreeIndexParams(num_trees)));
+        flann::seed_random(seed > 0 ? seed : std::random_device()());
+        _index->buildIndex();
+    }
+
+    py::tuple query(py::array_t<float, py::array::c_style | py::array::forcecast> &Q, int num_neighbors) {
+        py::buffer_info Q_info = Q.request();
+        if (Q_info.ndim != 2 || static_cast<size_t>(Q_info.shape[1]) != _dimensionality) {
+            throw std::runtime_error("Expecting query points with the dimensionality of the indexed data");
+        }
+        const size_t num_queries = Q_info.shape[0];
+        const size_t nn = std::min(static_cast<size_t>(num_neighbors), _num_points);
+        std::vector<int32_t> indices(num_queries * nn);
+        std::vector<float> distances(num_queries * nn);
+        {
+            py::gil_scoped_release release;
+            flann::Matrix<float> queries(static_cast<float *>(Q_info.ptr), num_queries, _dimensionality);
+            flann::Matrix<int> indices_mat(indices.data(), num_queries, nn);
+            flann::Matrix<float> dists_mat(distances.data(), num_queries, nn);
+            flann::SearchParams params(_num_checks);
+            params.cores = _num_threads;
+            _index->knnSearch(queries, indices_mat, dists_mat, nn, params);
+        }
+        py::array indices_array = vector_to_array(std::move(indices));
+        py::array distances_array = vector_to_array(std::move(distances));
+        return py::make_tuple(indices_array.attr("reshape")(num_queries, nn),
+                              distances_array.attr("reshape")(num_queries, nn));
+    }
+
+private:
+    py::array_t<float, py::array::c_style | py::array::forcecast> _data;
+    std::unique_ptr<flann::Index<flann::L2<float>>> _index;
+    size_t _num_points;
+    size_t _dimensionality;
+    int _num_checks;
+    int _num_threads;
+};
+
 PYBIND11_MODULE(numpy_to_hsne, m) {
-    m.def("run", &numpy_to_hsne, "function which converts numpy array to HSNE hierarchy in form of .hsne file",
+    m.def("run", &numpy_to_hsne, "function which converts numpy array to HSNE hierarchy in form of .hsne file. "
+    "Returns a list with the statistics of every scale (see compute), None if the computation failed",
     py::arg("X"), py::arg("filepath"), py::arg("num_scales"), py::arg("seeds"), py::arg("landmark_threshold"), 
     py::arg("num_neighbors"), py::arg("num_trees"), py::arg("num_checks"), py::arg("trans_matrix_prune_threshold"),
     py::arg("num_walks"), py::arg("num_walks_per_landmark"), py::arg("monte_carlo_sampling"), 
-    py::arg("out_of_core_computation"));
-}
\ No newline at end of file
+    py::arg("out_of_core_computation"), py::arg("num_threads") = 0, py::arg("file_version") = 0,
+    py::arg("compress") = false, py::arg("progress") = py::none());
+    m.def("compute", &numpy_to_hsne_scales,
+    "function which converts numpy array to HSNE hierarchy and returns every scale as a dict of numpy arrays (CSR for sparse matrices). "
+    "The hierarchy is additionally saved as .hsne file when filepath is not empty, in the compact format "
+    "(file_version 2, optionally LZ4 compressed) or in the original one (file_version 0). "
+    "num_threads limits the OpenMP threads (all if 0), the result does not depend on it. "
+    "knn_indices and knn_distances, (points x num_neighbors+1) arrays with squared euclidean distances and every point "
+    "as its own first neighbor, replace the FLANN neighborhood graph. "
+    "The 'statistics' entry of every scale is a dict with its size, the nonzeros of its sparse matrices, the peak "
+    "resident memory of the process in bytes after its computation and the times in seconds and sparsities of "
+    "HierarchicalSNE::Statistics. progress, if given, is called as progress(stage, scale, done, total) during the "
+    "parallel loops of the stages knn, probabilities, fmc, mcmc_sampling and aoi, from the worker threads; the GIL is "
+    "held only during the call and an exception raised by it is raised again once the computation is done",
+    py::arg("X"), py::arg("num_scales"), py::arg("seeds"), py::arg("landmark_threshold"),
+    py::arg("num_neighbors"), py::arg("num_trees"), py::arg("num_checks"), py::arg("trans_matrix_prune_threshold"),
+    py::arg("num_walks"), py::arg("num_walks_per_landmark"), py::arg("monte_carlo_sampling"),
+    py::arg("out_of_core_computation"), py::arg("filepath") = "", py::arg("num_threads") = 0,
+    py::arg("knn_indices") = py::none(), py::arg("knn_distances") = py::none(), py::arg("file_version") = 2,
+    py::arg("compress") = false, py::arg("progress") = py::none());
+    m.def("compute_from_similarities", &similarities_to_hsne_scales,
+    "function which builds the HSNE hierarchy on top of a sparse transition matrix given as CSR arrays (rows summing "
+    "to one, sorted column indices, no diagonal) and returns every scale like compute",
+    py::arg("indptr"), py::arg("indices"), py::arg("data"), py::arg("num_scales"), py::arg("seeds"),
+    py::arg("landmark_threshold"), py::arg("trans_matrix_prune_threshold"), py::arg("num_walks"),
+    py::arg("num_walks_per_landmark"), py::arg("monte_carlo_sampling"), py::arg("out_of_core_computation"),
+    py::arg("filepath") = "", py::arg("num_threads") = 0, py::arg("file_version") = 2, py::arg("compress") = false,
+    py::arg("progress") = py::none());
+    m.def("random_walks", &random_walks,
+    "random walks of walk_length steps from every point of a transition matrix given as CSR arrays (rows summing to "
+    "one, sorted column indices), returns a dict with the number of walks ending in every point and the seconds "
+    "taken to build the walk table and to walk. linear_scan takes the steps like HSNE did before the alias tables",
+    py::arg("indptr"), py::arg("indices"), py::arg("data"), py::arg("num_walks") = 200, py::arg("walk_length") = 10,
+    py::arg("seed") = 0, py::arg("num_threads") = 0, py::arg("linear_scan") = false);
+    m.def("peak_memory", &hdi::utils::peakResidentMemory,
+    "peak resident memory of the process in bytes, as in the statistics of compute, 0 if not available");
+    m.def("knn", &flann_knn,
+    "approximated k nearest neighbors of every point with the FLANN kd-trees used by compute, "
+    "returns (indices, squared euclidean distances) with num_neighbors+1 columns, the point itself included",
+    py::arg("X"), py::arg("num_neighbors"), py::arg("num_trees") = 6, py::arg("num_checks") = 1024,
+    py::arg("seed") = -1, py::arg("num_threads") = 0);
+    py::class_<FlannIndex>(m, "FlannIndex",
+    "kd-tree index of a float32 reference data set, kept for repeated nearest neighbor queries of new points")
+    .def(py::init<py::array_t<float, py::array::c_style | py::array::forcecast>, int, int, int, int>(),
+    py::arg("X"), py::arg("num_trees") = 6, py::arg("num_checks") = 1024, py::arg("seed") = -1,
+    py::arg("num_threads") = 0)
+    .def("query", &FlannIndex::query,
+    "nearest indexed points of every query point, returns (indices, squared euclidean distances) with "
+    "num_neighbors columns",
+    py::arg("Q"), py::arg("num_neighbors"));
+}
@@ -1,14 +1,12 @@
-from numpy import genfromtxt
+from schnel.Data_Prep.stream import stream_to_numpy
 
 
 def csv_to_numpy(file_path, csv_header=False):
     """
-    Translates a csv file into a numpy array.
+    Translates a csv file into a float32 numpy array, reading it in chunks.
 
     :param csv_header: make true if there are column names in the data
     :param file_path: path to file
     :return: numpy array
     """
-    if csv_header:
-        return genfromtxt(file_path, delimiter=',', dtype=float, skip_header=True)
-    return genfromtxt(file_path, delimiter=',', names=None, dtype=float)
+    return stream_to_numpy([file_path], csv_header=csv_header, check_finite=False)[0]
@@ -1,51 +1,70 @@
 import os
-from schnel.Data_Prep.csv_to_numpy import csv_to_numpy as ctn
-from schnel.Data_Prep.fcs_to_numpy import fcs_to_numpy as ftn
-from schnel.Data_Prep.h5ad_to_numpy import h5ad_to_numpy as htn
-from schnel.Data_Prep.pca import pca
-import scanpy as sc
+import sys
+from schnel.Data_Prep.h5ad_to_numpy import h5ad_to_numpy as htn, stored_embedding
+from schnel.Data_Prep.pca import apply_pca, pca, fit_pca_stream
+from schnel.Data_Prep.out_of_core import load_npy, scratch_array, transform_array
+from schnel.Data_Prep.stream import CHUNK_ROWS, STREAMABLE_EXTENSIONS, data_shape, file_shapes, stream_to_numpy, \
+    read_h5ad
 import numpy as np
-import anndata as ad
 
 
-def parse_to_numpy(source, transformation=None, cofactor=5, features_after_pca=50, csv_header=False):
+def parse_to_numpy(source, transformation=None, cofactor=5, features_after_pca=50, csv_header=False,
+                   scratch_dir=None, pca_method=None, pca_fit_rows=None, seed=None, projection=None):
     """
-    The main data parsing method that accepts files of type: .csv, .fcs, .h5ad as wel as objects of type: np.ndarray and h5ad object.
+    The main data parsing method that accepts files of type: .csv, .fcs, .h5ad, .npy as wel as objects of type: np.ndarray and h5ad object.
     It can also transforms the input data with a log or arcsinh transformations, and can perform pca analysis on it.
+    .npy files are memory mapped, and with scratch_dir set pca and the transformation write their results to
+    memory-mapped scratch files, so data sets larger than memory can be prepared.
+    h5ad files are opened in backed mode and an embedding in obsm['X_pca'] with at least features_after_pca
+    components is reused, otherwise the pca is computed on X in chunks, without densifying a sparse X.
 
     :param csv_header: set to true if there are column names in the data
     :param source: file/object to become an ndarray
     :param transformation: one of two can be applied 'log' - logistic, 'arcsinh' - arcsine, Default is set to None
     :param cofactor: only use when applying the arcsinh transformation, Default is set to 5
     :param features_after_pca: the amount of features to keep after performing pca on given data, default is 50
+    :param scratch_dir: directory for memory-mapped intermediate results, in memory if None
+    :param pca_method: pca engine, 'auto', 'exact', 'randomized' or 'incremental', see pca.pca
+    :param pca_fit_rows: fit the pca on a random subsample of this many rows, all rows if None
+    :param seed: seed of the pca subsample and the randomized solver
+    :param projection: fitted PCA to project on instead of fitting one, e.g. to prepare new points like the data
+        it was fitted on
     :return: an np.ndarray ready to be clustered
     """
     #pylint: disable=unused-variable
 
     if cofactor == 0:
         print("scale cannot be 0")
-    elif isinstance(source, sc.AnnData):
-        np_arr = htn(source, features_after_pca)
+    elif is_anndata(source):
+        np_arr = htn(source, features_after_pca, scratch_dir=scratch_dir, pca_method=pca_method,
+                     pca_fit_rows=pca_fit_rows, seed=seed)
     elif isinstance(source, np.ndarray):
         np_arr = source
     else:
         file_name, file_extension = os.path.splitext(source)
-        np_arr = None
-        if file_extension == ".csv":
-            np_arr = ctn(source, csv_header=csv_header)
-        elif file_extension == ".fcs":
-            np_arr = ftn(source)
-        elif file_extension == ".h5ad":
-            np_arr = htn(source, features_after_pca)
-        else:
+        np_arr = h5ad_embedding([source], features_after_pca) if projection is None else None
+        if np_arr is None and can_stream([source]):
+            return stream_files([source], transformation=transformation, cofactor=cofactor,
+                                features_after_pca=features_after_pca, csv_header=csv_header, check_finite=False,
+                                pca_method=pca_method, pca_fit_rows=pca_fit_rows, seed=seed,
+                                projection=projection)[0]
+        if file_extension == ".npy":
+            np_arr = load_npy(source)
+        elif np_arr is None:
             print("file type: " + file_extension + " not recognized by parser.\n "
-                                                   "Acceptable types are: .csv, .fcs, .h5ad")
+                                                   "Acceptable types are: .csv, .fcs, .h5ad, .npy")
     print("ndim: ", np_arr.shape[1])
-    if np_arr.shape[1] > features_after_pca:
-        np_arr = pca(np_arr, features_after_pca)
+    if projection is not None and np_arr.shape[1] > features_after_pca:
+        np_arr = apply_pca(projection, np_arr, scratch_array((len(np_arr), projection.n_components_), scratch_dir))
+    elif np_arr.shape[1] > features_after_pca:
+        np_arr = pca(np_arr, features_after_pca, scratch_dir=scratch_dir, method=pca_method,
+                     fit_rows=pca_fit_rows, seed=seed)
 
     transformed = np_arr
-    if transformation == "arcsinh":
+    if scratch_dir is not None or isinstance(np_arr, np.memmap):
+        if transformation in ("arcsinh", "log"):
+            transformed = transform_array(np_arr, transformation, cofactor, scratch_dir=scratch_dir)
+    elif transformation == "arcsinh":
         divided = np.true_divide(np_arr, cofactor)
         transformed = np.arcsinh(divided)
     elif transformation == "log":
@@ -54,6 +73,138 @@ def parse_to_numpy(source, transformation=None, cofactor=5, features_after_pca=5
     return transformed
 
 
+def is_anndata(source):
+    """
+    :param source: input of parse_to_numpy
+    :return: true if source is an AnnData object, without importing anndata if it was not imported before
+    """
+    return 'anndata' in sys.modules and isinstance(source, sys.modules['anndata'].AnnData)
+
+
+def h5ad_embedding(sources, features_after_pca=50):
+    """
+    Embedding stored in obsm['X_pca'] of a single .h5ad file, read without loading X. Several files are not
+    combined this way, since their embeddings are not in the same basis.
+
+    :param sources: list of files
+    :param features_after_pca: the amount of features to keep
+    :return: float32 array, None if sources is not a single .h5ad file with an embedding of at least
+        features_after_pca components
+    """
+    if len(sources) != 1 or not isinstance(sources[0], str) or os.path.splitext(sources[0])[1] != '.h5ad':
+        return None
+    data = read_h5ad(sources[0])
+    try:
+        return stored_embedding(data, features_after_pca)
+    finally:
+        data.file.close()
+
+
+def can_stream(sources):
+    """
+    Checks whether files can be streamed straight into the final array, which is the case for .csv, .fcs and .h5ad
+    files.
+
+    :param sources: list of files
+    :return: bool
+    """
+    return all(isinstance(source, str) and os.path.splitext(source)[1] in STREAMABLE_EXTENSIONS
+               for source in sources)
+
+
+def fit_projection(sources, features_after_pca=50, csv_header=False, pca_method=None, pca_fit_rows=None, seed=None,
+                   shapes=None):
+    """
+    Fits a single pca across .csv, .fcs and .h5ad files in a pass over the files, if they have more features than
+    features_after_pca. The pca is fitted on all columns, feature_ids select its components afterwards.
+
+    :param sources: list of files
+    :param features_after_pca: the amount of features to keep after performing pca on given data
+    :param csv_header: set to true if there are column names in the data
+    :param pca_method: pca engine, 'auto' if None, see pca.fit_pca_stream
+    :param pca_fit_rows: fit the pca on a random subsample of about this many rows, all rows if None
+    :param seed: seed of the pca subsample and the randomized solver
+    :param shapes: shapes of the files as returned by file_shapes, computed if None
+    :return: fitted estimator, None if no pca is needed
+    """
+    if shapes is None:
+        shapes = file_shapes(sources, csv_header)
+    if shapes[0][1] <= features_after_pca:
+        return None
+    return fit_pca_stream(sources, features_after_pca, method=pca_method, fit_rows=pca_fit_rows,
+                          csv_header=csv_header, seed=seed, shapes=shapes)
+
+
+def stream_files(sources, feature_ids=None, transformation=None, cofactor=5, features_after_pca=50,
+                 csv_header=False, check_finite=True, pca_method=None, pca_fit_rows=None, seed=None, projection=None,
+                 num_threads=1, shapes=None):
+    """
+    Streams .csv, .fcs and .h5ad files into one float32 array, reading num_threads files at once.
+    Files with more features than features_after_pca are projected on a single pca fitted across all of them
+    in a first pass over the files, see fit_projection. The shapes of the files are determined once, which for
+    csv files takes a pass over every file, and shared by both passes.
+
+    :param sources: list of files
+    :param feature_ids: columns to keep after the projection, all if None
+    :param transformation: 'log', 'arcsinh' or None
+    :param cofactor: cofactor of the arcsinh transformation
+    :param features_after_pca: the amount of features to keep after performing pca on given data
+    :param csv_header: set to true if there are column names in the data
+    :param check_finite: raise a ValueError when the data contains NaN or Inf
+    :param pca_method: pca engine, 'auto' if None, see pca.fit_pca_stream
+    :param pca_fit_rows: fit the pca on a random subsample of about this many rows, all rows if None
+    :param seed: seed of the pca subsample and the randomized solver
+    :param projection: fitted pca to project on instead of fitting one
+    :param num_threads: number of files read in parallel, all cores if 0
+    :param shapes: shapes of the files as returned by file_shapes, computed if None
+    :return: (np.ndarray with the rows of all files, list with the number of rows per file)
+    """
+    if shapes is None:
+        shapes = file_shapes(sources, csv_header, num_threads)
+    if projection is None:
+        projection = fit_projection(sources, features_after_pca, csv_header, pca_method, pca_fit_rows, seed, shapes)
+    return stream_to_numpy(sources, feature_ids=feature_ids, transformation=transformation, cofactor=cofactor,
+                           csv_header=csv_header, check_finite=check_finite, projection=projection,
+                           num_threads=num_threads, shapes=shapes)
+
+
+def transpose_files(sources, csv_header=False, scratch_dir=None, chunk_cols=CHUNK_ROWS):
+    """
+    Reads feature by cell .csv, .fcs, .h5ad and .npy files into one cell by feature float32 array, without
+    pca or transformation. The cells of a file are its columns, so every file is read completely before its
+    columns are copied to the rows of the result; .npy files are memory mapped.
+
+    :param sources: list of files, all with the same number of features (rows)
+    :param csv_header: set to true if there are column names in the data
+    :param scratch_dir: directory for the scratch file holding the result, in memory if None
+    :param chunk_cols: number of cells copied at once
+    :return: (np.ndarray with the cells of all files, list with the number of cells per file), raises a
+        ValueError for other input or files with different numbers of features
+    """
+    if not all(isinstance(source, str) and os.path.splitext(source)[1] in STREAMABLE_EXTENSIONS + ('.npy',)
+               for source in sources):
+        raise ValueError("Feature by cell input must be given as arrays or .csv, .fcs, .h5ad and .npy files")
+    lengths = [load_npy(source).shape[1] if os.path.splitext(source)[1] == '.npy' else
+               data_shape(source, csv_header)[1] for source in sources]
+    out = None
+    filled = 0
+    for source, cells in zip(sources, lengths):
+        if os.path.splitext(source)[1] == '.npy':
+            data = load_npy(source)
+        else:
+            data = stream_to_numpy([source], csv_header=csv_header)[0]
+        if out is None:
+            out = scratch_array((sum(lengths), data.shape[0]), scratch_dir)
+        elif data.shape[0] != out.shape[1]:
+            raise ValueError("%s has %i features (rows), the first file has %i" % (source, data.shape[0],
+                                                                                  out.shape[1]))
+        for start in range(0, cells, chunk_cols):
+            out[filled + start:filled + min(start + chunk_cols, cells)] = data[:, start:start + chunk_cols].T
+        filled += cells
+    return out, lengths
+
+
 if __name__ == "__main__":
+    import anndata as ad
     data = ad.read_h5ad('../data/pbmc3k.h5ad')
     parse_to_numpy(data)
\ No newline at end of file
@@ -1,11 +1,11 @@
-import fcsparser as fcs
+from schnel.Data_Prep.stream import stream_to_numpy
+
 
 def fcs_to_numpy(file_path):
     """
-    Translate an .fcs extension file data into a numpy array
+    Translate an .fcs extension file data into a float32 numpy array, reading it in chunks
 
     :param file_path: path to the file
     :return: numpy.ndarray
     """
-    meta, data = fcs.parse(file_path, reformat_meta=True, meta_data_only=False)
-    return data
+    return stream_to_numpy([file_path], check_finite=False)[0]
@@ -1,24 +1,65 @@
-import anndata as ad
-import scanpy as sc
+import numpy as np
+from scipy.sparse import issparse
+from schnel.Data_Prep.out_of_core import scratch_array
+from schnel.Data_Prep.pca import fit_pca_sampled, project_chunks, pca as dense_pca
+from schnel.Data_Prep.stream import iter_anndata, read_h5ad
 
 
-def h5ad_to_numpy(source, pca=50, previous_pca=False):
+def stored_embedding(data, comps, use_rep='X_pca'):
+    """
+    Embedding of the cells stored in obsm, e.g. the PCA of a previous scanpy run.
+
+    :param data: AnnData, in memory or backed
+    :param comps: number of dimensions to keep
+    :param use_rep: key of the embedding in obsm
+    :return: C-contiguous float32 array with the first comps columns, None if there is no embedding with at least
+        comps columns
+    """
+    if use_rep not in data.obsm.keys() or data.obsm[use_rep].shape[1] < comps:
+        return None
+    return np.ascontiguousarray(np.asarray(data.obsm[use_rep])[:, :comps], dtype=np.float32)
+
+
+def h5ad_to_numpy(source, pca=50, previous_pca=True, use_rep='X_pca', scratch_dir=None, pca_method=None,
+                  pca_fit_rows=None, seed=None):
     """
     Takes in a h5ad source, performs pca if specified and returns a numpy array of results.
+    Files are opened in backed mode and an embedding stored in obsm is reused if it has enough components.
+    Otherwise X, dense or sparse, is read in bounded chunks: the pca is fitted on densified chunks and the
+    chunks are projected without densifying them, so only the float32 result is held in memory.
 
-    :param source: file path the h5ad file
+    :param source: file path the h5ad file or AnnData object
     :param pca: desired PC's. Default 50.
-    :param previous_pca: True to use objects previously computed PCA. Default false.
-    :return: numpy.ndarray
+    :param previous_pca: True to use objects previously computed PCA, if it has at least pca components. Default true.
+    :param use_rep: key of the previously computed embedding in obsm
+    :param scratch_dir: directory for the scratch file holding the result, in memory if None
+    :param pca_method: pca engine, see pca.pca. Sparse or backed X defaults to 'incremental', since the other
+        engines hold the densified rows they are fitted on in memory
+    :param pca_fit_rows: fit the pca on a random subsample of about this many rows, all rows if None
+    :param seed: seed of the pca subsample and the randomized solver
+    :return: float32 numpy.ndarray, or np.memmap if scratch_dir is set
     """
-    if isinstance(source, str):
-        data = ad.read_h5ad(source)
-    else:
-        data = source
-    if previous_pca:
-        try:
-            return data.obsm['X_pca']
-        except KeyError:
-            print("Previous PCA not computed, set previous_pca to false")
-    sc.tl.pca(data, n_comps=pca)
-    return data.obsm['X_pca']
+    data = read_h5ad(source) if isinstance(source, str) else source
+    try:
+        if previous_pca:
+            embedding = stored_embedding(data, pca, use_rep)
+            if embedding is not None:
+                return embedding
+        rows, cols = data.shape
+        if cols <= pca:
+            out = scratch_array((rows, cols), scratch_dir)
+            start = 0
+            for chunk in iter_anndata(data):
+                out[start:start + len(chunk)] = chunk
+                start += len(chunk)
+            return out
+        if not data.isbacked and not issparse(data.X):
+            return dense_pca(np.asarray(data.X), pca, scratch_dir=scratch_dir, method=pca_method,
+                             fit_rows=pca_fit_rows, seed=seed)
+        estimator = fit_pca_sampled(iter_anndata(data), pca, cols, method=pca_method or 'incremental',
+                                    fit_rows=pca_fit_rows, total_rows=rows, seed=seed)
+        out = scratch_array((rows, estimator.n_components_), scratch_dir)
+        return project_chunks(estimator, iter_anndata(data, dense=False), out)
+    finally:
+        if isinstance(source, str):
+            data.file.close()
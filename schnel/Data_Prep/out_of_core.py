@@ -0,0 +1,99 @@
+import os
+import tempfile
+import numpy as np
+from numpy.lib.format import open_memmap
+from schnel.Data_Prep.stream import transform_chunk, CHUNK_ROWS
+
+
+def load_npy(file_path):
+    """
+    Opens a .npy file as a read-only memory map, nothing is read until the rows are accessed.
+
+    :param file_path: path to a .npy file
+    :return: np.memmap
+    """
+    return np.load(file_path, mmap_mode='r')
+
+
+def scratch_array(shape, scratch_dir=None, dtype=np.float32):
+    """
+    Allocates an array backed by a temporary .npy file in scratch_dir. The file is unlinked right away,
+    its space is released together with the last reference to the array.
+
+    :param shape: shape of the array
+    :param scratch_dir: directory for the scratch file, the array is held in memory if None
+    :param dtype: dtype of the array
+    :return: np.memmap, or np.ndarray if scratch_dir is None
+    """
+    if scratch_dir is None:
+        return np.empty(shape, dtype=dtype)
+    handle, path = tempfile.mkstemp(suffix='.npy', dir=scratch_dir)
+    os.close(handle)
+    array = open_memmap(path, mode='w+', dtype=dtype, shape=shape)
+    try:
+        os.remove(path)
+    except OSError:
+        # Windows does not allow removing mapped files, the file stays in scratch_dir
+        pass
+    return array
+
+
+def _check_finite(chunk):
+    if not np.isfinite(chunk).all():
+        raise ValueError("Some of the fields in the data set are NaN or Inf")
+
+
+def prepare_array(data, feature_ids=None, transpose=False, scratch_dir=None, chunk_rows=CHUNK_ROWS):
+    """
+    Turns data into the C-contiguous float32 matrix the hierarchy is computed on, working in chunks of rows.
+    Arrays that already have this layout are passed on without a copy, so memory-mapped input reaches the
+    C++ code directly. Otherwise the result is written to a scratch file when scratch_dir is set or the
+    input is memory mapped, and to memory else.
+
+    :param data: cell by feature array or np.memmap
+    :param feature_ids: columns to keep, all if None
+    :param transpose: true if data is feature by cell
+    :param scratch_dir: directory for the scratch file
+    :param chunk_rows: number of rows processed at once
+    :return: float32 array, raises a ValueError when data contains NaN or Inf
+    """
+    if feature_ids is None and not transpose and data.dtype == np.float32 and data.flags.c_contiguous:
+        for start in range(0, len(data), chunk_rows):
+            _check_finite(data[start:start + chunk_rows])
+        return data
+    cols = np.arange(data.shape[1])
+    if feature_ids is not None:
+        cols = cols[feature_ids]
+    shape = (len(cols), data.shape[0]) if transpose else (data.shape[0], len(cols))
+    if scratch_dir is None and isinstance(data, np.memmap):
+        scratch_dir = tempfile.gettempdir()
+    out = scratch_array(shape, scratch_dir)
+    for start in range(0, shape[0], chunk_rows):
+        target = out[start:start + chunk_rows]
+        if transpose:
+            target[...] = data[:, cols[start:start + chunk_rows]].T
+        elif feature_ids is None:
+            target[...] = data[start:start + chunk_rows]
+        else:
+            target[...] = data[start:start + chunk_rows][:, cols]
+        _check_finite(target)
+    return out
+
+
+def transform_array(data, transformation=None, cofactor=5, scratch_dir=None, chunk_rows=CHUNK_ROWS):
+    """
+    Applies the log or arcsinh transformation chunk by chunk into a new float32 array.
+
+    :param data: array to transform, left unchanged
+    :param transformation: 'log', 'arcsinh' or None
+    :param cofactor: cofactor of the arcsinh transformation
+    :param scratch_dir: directory for the scratch file backing the result, in memory if None
+    :param chunk_rows: number of rows processed at once
+    :return: transformed array
+    """
+    out = scratch_array(data.shape, scratch_dir)
+    for start in range(0, len(data), chunk_rows):
+        target = out[start:start + chunk_rows]
+        target[...] = data[start:start + chunk_rows]
+        transform_chunk(target, transformation, cofactor)
+    return out
@@ -1,13 +1,225 @@
-import sklearn.decomposition as sk
+#pylint: disable=import-outside-toplevel
+import numpy as np
+from schnel.Data_Prep.out_of_core import scratch_array
+from schnel.Data_Prep.stream import file_shapes, iter_sources, CHUNK_ROWS
 
+PCA_METHODS = ('auto', 'exact', 'randomized', 'incremental')
 
-def pca(data, comps):
+
+def _num_components(shape, comps):
+    return min(shape[0], min(shape[1], comps))
+
+
+def _estimator(method, n_components, seed=None):
+    """
+    Creates the scikit-learn estimator of a PCA engine.
+
+    :param method: one of PCA_METHODS
+    :param n_components: number of PC's
+    :param seed: random state of the randomized solver
+    :return: unfitted estimator
+    """
+    import sklearn.decomposition as sk
+    if method == 'incremental':
+        return sk.IncrementalPCA(n_components=n_components)
+    if method not in PCA_METHODS:
+        raise ValueError("Unknown pca method '%s', use one of %s" % (method, ', '.join(PCA_METHODS)))
+    solver = {'auto': 'auto', 'exact': 'full', 'randomized': 'randomized'}[method]
+    return sk.PCA(n_components=n_components, svd_solver=solver, random_state=seed)
+
+
+def _subsample(num_rows, fit_rows, seed=None):
+    """
+    Sorted random selection of rows the components are fitted on.
+
+    :param num_rows: number of rows of the data
+    :param fit_rows: number of rows to select, all rows if None
+    :param seed: seed of the selection
+    :return: slice or index array
+    """
+    if fit_rows is None or fit_rows >= num_rows:
+        return slice(None)
+    return np.sort(np.random.default_rng(seed).choice(num_rows, fit_rows, replace=False))
+
+
+def fit_pca(data, comps, method='auto', fit_rows=None, batch_size=CHUNK_ROWS, seed=None):
+    """
+    Fits the principal components of data in float32.
+
+    :param data: array or np.memmap to fit on
+    :param comps: number of PC's
+    :param method: 'auto' (scikit-learn's choice), 'exact', 'randomized' or 'incremental'
+    :param fit_rows: fit on a random subsample of this many rows, all rows if None
+    :param batch_size: number of rows per batch of the incremental engine
+    :param seed: seed of the subsample and of the randomized solver
+    :return: fitted estimator
+    """
+    from sklearn.utils import gen_batches
+    rows = _subsample(len(data), fit_rows, seed)
+    num_rows = len(data) if isinstance(rows, slice) else len(rows)
+    n_components = _num_components((num_rows, data.shape[1]), comps)
+    estimator = _estimator(method, n_components, seed)
+    if method == 'incremental':
+        # partial_fit centers its input in place, so batches are copied out of the (read-only) map
+        for batch in gen_batches(num_rows, batch_size, min_batch_size=n_components):
+            index = batch if isinstance(rows, slice) else rows[batch]
+            estimator.partial_fit(np.array(data[index], dtype=np.float32))
+    else:
+        estimator.fit(np.asarray(data[rows], dtype=np.float32))
+    return estimator
+
+
+def fit_pca_chunks(chunks, comps, num_features):
+    """
+    Fits the principal components incrementally on a stream of chunks, as yielded by stream.iter_chunks.
+    Chunks are merged until they hold at least as many rows as components.
+
+    :param chunks: iterable of 2d arrays
+    :param comps: number of PC's
+    :param num_features: number of columns of the chunks
+    :return: fitted IncrementalPCA
+    """
+    n_components = min(comps, num_features)
+    estimator = _estimator('incremental', n_components)
+    held, pending = None, []
+    for chunk in chunks:
+        pending.append(np.array(chunk, dtype=np.float32))
+        if sum(len(part) for part in pending) >= n_components:
+            # The last full batch is held back so that a short remainder can be merged into it
+            if held is not None:
+                estimator.partial_fit(held)
+            held, pending = np.concatenate(pending), []
+    if pending:
+        held = np.concatenate(([] if held is None else [held]) + pending)
+    if held is None:
+        raise ValueError("Cannot fit pca on empty data")
+    if len(held) < n_components:
+        estimator.n_components = len(held)
+    estimator.partial_fit(held)
+    return estimator
+
+
+def _sample_chunks(chunks, fraction, seed=None):
+    """
+    Keeps every row of a stream of chunks with the given probability.
+
+    :param chunks: iterable of 2d arrays
+    :param fraction: probability of keeping a row
+    :param seed: seed of the selection
+    :return: generator of 2d arrays
+    """
+    rng = np.random.default_rng(seed)
+    for chunk in chunks:
+        yield chunk[rng.random(len(chunk)) < fraction]
+
+
+def fit_pca_stream(sources, comps, method=None, fit_rows=None, csv_header=False, seed=None, chunk_rows=CHUNK_ROWS,
+                   shapes=None):
+    """
+    Fits one set of principal components across .csv, .fcs and .h5ad files while reading them chunk by chunk.
+    The default engine is the one of in-memory data, scikit-learn's automatic choice, fitted on the rows
+    collected from the stream; for data larger than memory these should be limited with fit_rows, or the
+    'incremental' engine selected, which sees every chunk once.
+
+    :param sources: list of file paths
+    :param comps: number of PC's
+    :param method: 'auto', 'exact', 'randomized' or 'incremental', defaults to 'auto'
+    :param fit_rows: approximate number of randomly selected rows to fit on, all rows if None
+    :param csv_header: true if the first line of the csv files holds column names
+    :param seed: seed of the selection and of the randomized solver
+    :param chunk_rows: number of rows read at once
+    :param shapes: shapes of the files as returned by stream.file_shapes, computed if None
+    :return: fitted estimator, to be passed to stream.stream_to_numpy as projection
+    """
+    if shapes is None:
+        shapes = file_shapes(sources, csv_header)
+    num_features = shapes[0][1]
+    total_rows = sum(rows for rows, _ in shapes)
+    return fit_pca_sampled(iter_sources(sources, csv_header=csv_header, chunk_rows=chunk_rows), comps, num_features,
+                           method=method, fit_rows=fit_rows, total_rows=total_rows, seed=seed)
+
+
+def fit_pca_sampled(chunks, comps, num_features, method=None, fit_rows=None, total_rows=None, seed=None):
+    """
+    Fits the principal components on a stream of dense chunks with any engine, optionally on a random selection
+    of about fit_rows of its rows, see fit_pca_stream.
+
+    :param chunks: iterable of 2d arrays
+    :param comps: number of PC's
+    :param num_features: number of columns of the chunks
+    :param method: 'auto', 'exact', 'randomized' or 'incremental', defaults to 'auto'
+    :param fit_rows: approximate number of randomly selected rows to fit on, all rows if None
+    :param total_rows: number of rows of the stream, needed for fit_rows
+    :param seed: seed of the selection and of the randomized solver
+    :return: fitted estimator
+    """
+    method = method or 'auto'
+    if fit_rows is not None and fit_rows < total_rows:
+        chunks = _sample_chunks(chunks, fit_rows / total_rows, seed)
+    if method == 'incremental':
+        return fit_pca_chunks(chunks, comps, num_features)
+    sample = np.concatenate([np.asarray(chunk, dtype=np.float32) for chunk in chunks])
+    return fit_pca(sample, comps, method=method, seed=seed)
+
+
+def apply_pca(estimator, data, out=None, batch_size=CHUNK_ROWS):
+    """
+    Projects data on fitted components in batches of rows.
+
+    :param estimator: fitted PCA or IncrementalPCA
+    :param data: array or np.memmap to project
+    :param out: float32 array receiving the projection, allocated in memory if None
+    :param batch_size: number of rows per batch
+    :return: out
+    """
+    from sklearn.utils import gen_batches
+    if out is None:
+        out = np.empty((len(data), estimator.n_components_), dtype=np.float32)
+    for batch in gen_batches(len(data), batch_size):
+        out[batch] = estimator.transform(np.asarray(data[batch], dtype=np.float32))
+    return out
+
+
+def project_chunks(estimator, chunks, out):
+    """
+    Projects a stream of dense or sparse chunks on fitted components, written one after the other into out.
+    The mean is subtracted after the product with the components, so sparse chunks are not densified.
+
+    :param estimator: fitted PCA or IncrementalPCA, without whitening
+    :param chunks: iterable of 2d arrays or scipy sparse matrices
+    :param out: float32 array with a row per row of the stream
+    :return: out
+    """
+    components = estimator.components_.T.astype(np.float32)
+    offset = estimator.mean_.astype(np.float32) @ components
+    start = 0
+    for chunk in chunks:
+        target = out[start:start + chunk.shape[0]]
+        target[...] = chunk @ components
+        target -= offset
+        start += chunk.shape[0]
+    return out
+
+
+def pca(data, comps, scratch_dir=None, batch_size=CHUNK_ROWS, method=None, fit_rows=None, seed=None):
     """
-    Returns pca of data with a desired number of components.
+    Returns pca of data with a desired number of components as float32 array.
+    The components are fitted with the selected engine, optionally on a random subsample of rows,
+    after which all rows are projected in batches. If scratch_dir is set the projection is written
+    to a memory-mapped scratch file, so data can be larger than memory.
 
     :param data: numpy array to perform PCA on
     :param comps: number of PC's
+    :param scratch_dir: directory for the scratch file holding the result, in memory if None
+    :param batch_size: number of rows per batch
+    :param method: 'auto', 'exact', 'randomized' or 'incremental'. Defaults to 'incremental' when
+        scratch_dir is set and to 'auto' otherwise
+    :param fit_rows: fit on a random subsample of this many rows, all rows if None
+    :param seed: seed of the subsample and of the randomized solver
     :return: array with PCA transformation
     """
-    pca_trans = sk.PCA(n_components=min(data.shape[0], min(data.shape[1], comps)))
-    return pca_trans.fit_transform(data)
+    if method is None:
+        method = 'auto' if scratch_dir is None else 'incremental'
+    estimator = fit_pca(data, comps, method=method, fit_rows=fit_rows, batch_size=batch_size, seed=seed)
+    out = scratch_array((len(data), estimator.n_components_), scratch_dir)
+    return apply_pca(estimator, data, out, batch_size)
@@ -0,0 +1,281 @@
+#pylint: disable=import-outside-toplevel
+import os
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from scipy.sparse import issparse
+
+STREAMABLE_EXTENSIONS = ('.csv', '.fcs', '.h5ad')
+CHUNK_ROWS = 1 << 17
+# Dense chunks of wide (e.g. gene expression) data are limited to this many elements
+_CHUNK_ELEMENTS = 1 << 24
+_FCS_TYPES = {'F': 'f4', 'D': 'f8'}
+
+
+def _count_csv_rows(file_path, csv_header=False):
+    """
+    Counts the lines of a csv file without parsing it. Blank lines are counted as well,
+    so the result is an upper bound of the number of data rows.
+
+    :param file_path: path to file
+    :param csv_header: true if the first line holds column names
+    :return: number of rows
+    """
+    rows = 0
+    last = b'\n'
+    with open(file_path, 'rb') as handle:
+        for block in iter(lambda: handle.read(1 << 24), b''):
+            rows += block.count(b'\n')
+            last = block[-1:]
+    if last != b'\n':
+        rows += 1
+    return max(rows - int(csv_header), 0)
+
+
+def _csv_columns(file_path, csv_header=False):
+    """
+    Number of columns of a csv file, taken from its first data row.
+
+    :param file_path: path to file
+    :param csv_header: true if the first line holds column names
+    :return: number of columns
+    """
+    with open(file_path, 'r') as handle:
+        if csv_header:
+            handle.readline()
+        for line in handle:
+            if line.strip():
+                return line.count(',') + 1
+    return 0
+
+
+def _fcs_layout(file_path):
+    """
+    Reads the TEXT segment of an .fcs file.
+
+    :param file_path: path to the file
+    :return: (number of events, number of parameters, dtype and offset of the DATA segment or None
+              when the segment cannot be memory mapped)
+    """
+    from fcsparser.api import FCSParser
+    parser = FCSParser(file_path, read_data=False)
+    meta = parser.annotation
+    rows, cols = int(meta['$TOT']), int(meta['$PAR'])
+    byteord = str(meta.get('$BYTEORD', '')).strip()
+    endian = {'1,2,3,4': '<', '1,2': '<', '4,3,2,1': '>', '2,1': '>'}.get(byteord)
+    datatype = _FCS_TYPES.get(str(meta.get('$DATATYPE', '')).strip())
+    bits = {int(meta['$P%iB' % (par + 1)]) for par in range(cols)}
+    if endian is None or datatype is None or bits != {8 * int(datatype[1])} or meta.get('$NEXTDATA', 0):
+        return rows, cols, None
+    offset = int(meta['__header__']['data start']) or int(meta['$BEGINDATA'])
+    return rows, cols, (np.dtype(endian + datatype), offset)
+
+
+def read_h5ad(file_path):
+    """
+    Opens an .h5ad file in backed mode, X stays on disk until its rows are accessed.
+
+    :param file_path: path to the file
+    :return: AnnData, whose file has to be closed by the caller
+    """
+    import anndata as ad
+    return ad.read_h5ad(file_path, backed='r')
+
+
+def iter_anndata(data, chunk_rows=CHUNK_ROWS, dense=True):
+    """
+    Reads X of an AnnData object, in memory or backed, in chunks of rows. Chunks of wide data are limited to
+    _CHUNK_ELEMENTS elements, so a sparse X is never densified as a whole.
+
+    :param data: AnnData
+    :param chunk_rows: maximal number of rows per chunk
+    :param dense: densify sparse chunks, they are yielded as CSR matrices otherwise
+    :return: generator of 2d arrays
+    """
+    rows, cols = data.shape
+    chunk_rows = max(1, min(chunk_rows, _CHUNK_ELEMENTS // max(cols, 1)))
+    for start in range(0, rows, chunk_rows):
+        chunk = data.X[start:start + chunk_rows]
+        if issparse(chunk):
+            yield chunk.toarray() if dense else chunk.tocsr()
+        else:
+            yield np.asarray(chunk)
+
+
+def data_shape(file_path, csv_header=False):
+    """
+    Shape of the data in a .csv, .fcs or .h5ad file without reading the data itself.
+    For csv files the number of rows is an upper bound, blank lines are included.
+
+    :param file_path: path to file
+    :param csv_header: true if the first line of a csv file holds column names
+    :return: (rows, columns)
+    """
+    extension = os.path.splitext(file_path)[1]
+    if extension == '.fcs':
+        rows, cols, _ = _fcs_layout(file_path)
+        return rows, cols
+    if extension == '.h5ad':
+        data = read_h5ad(file_path)
+        try:
+            return data.shape
+        finally:
+            data.file.close()
+    return _count_csv_rows(file_path, csv_header), _csv_columns(file_path, csv_header)
+
+
+def iter_chunks(file_path, csv_header=False, chunk_rows=CHUNK_ROWS):
+    """
+    Reads a .csv, .fcs or .h5ad file in chunks of rows. Sparse X of .h5ad files is densified chunk by chunk.
+
+    :param file_path: path to file
+    :param csv_header: true if the first line of a csv file holds column names
+    :param chunk_rows: maximal number of rows per chunk
+    :return: generator of 2d arrays
+    """
+    extension = os.path.splitext(file_path)[1]
+    if extension == '.h5ad':
+        data = read_h5ad(file_path)
+        try:
+            yield from iter_anndata(data, chunk_rows)
+        finally:
+            data.file.close()
+    elif extension == '.fcs':
+        rows, cols, layout = _fcs_layout(file_path)
+        if layout is None:
+            # Integer or mixed width channels need the bit masks applied by fcsparser
+            import fcsparser as fcs
+            _, data = fcs.parse(file_path, reformat_meta=True, meta_data_only=False)
+            data = data.values
+        else:
+            dtype, offset = layout
+            data = np.memmap(file_path, dtype=dtype, mode='r', offset=offset, shape=(rows, cols))
+        for start in range(0, rows, chunk_rows):
+            yield data[start:start + chunk_rows]
+    else:
+        import pandas as pd
+        reader = pd.read_csv(file_path, header=None, skiprows=int(csv_header), dtype=np.float32,
+                             chunksize=chunk_rows)
+        for chunk in reader:
+            yield chunk.values
+
+
+def iter_sources(sources, feature_ids=None, csv_header=False, chunk_rows=CHUNK_ROWS):
+    """
+    Reads several .csv, .fcs and .h5ad files one after the other in chunks of rows.
+
+    :param sources: list of file paths
+    :param feature_ids: columns to keep, all if None
+    :param csv_header: true if the first line of the csv files holds column names
+    :param chunk_rows: maximal number of rows per chunk
+    :return: generator of 2d arrays
+    """
+    for source in sources:
+        for chunk in iter_chunks(source, csv_header, chunk_rows):
+            yield chunk if feature_ids is None else chunk[:, feature_ids]
+
+
+def transform_chunk(chunk, transformation=None, cofactor=5):
+    """
+    Applies the log or arcsinh transformation in place.
+
+    :param chunk: float array
+    :param transformation: 'log', 'arcsinh' or None
+    :param cofactor: cofactor of the arcsinh transformation
+    :return: the transformed chunk
+    """
+    if transformation == "arcsinh":
+        np.true_divide(chunk, cofactor, out=chunk)
+        np.arcsinh(chunk, out=chunk)
+    elif transformation == "log":
+        np.add(chunk, 1, out=chunk)
+        np.log(chunk, out=chunk)
+    return chunk
+
+
+def _map(func, items, num_threads=1):
+    """
+    Applies func to every item, in a pool of threads if num_threads is not 1.
+
+    :param func: function of one argument
+    :param items: list of arguments
+    :param num_threads: number of threads, all cores if 0
+    :return: list of results in the order of items
+    """
+    num_threads = num_threads if num_threads > 0 else os.cpu_count() or 1
+    if num_threads == 1 or len(items) < 2:
+        return [func(item) for item in items]
+    with ThreadPoolExecutor(min(num_threads, len(items))) as pool:
+        return list(pool.map(func, items))
+
+
+def file_shapes(sources, csv_header=False, num_threads=1):
+    """
+    Shapes of several files, see data_shape. Counting the rows of a csv file takes a pass over the file, so the
+    shapes are computed once and passed on to the functions reading the files.
+
+    :param sources: list of file paths
+    :param csv_header: true if the first line of the csv files holds column names
+    :param num_threads: number of files inspected in parallel, all cores if 0
+    :return: list of (rows, columns)
+    """
+    return _map(lambda source: data_shape(source, csv_header), sources, num_threads)
+
+
+def stream_to_numpy(sources, feature_ids=None, transformation=None, cofactor=5, csv_header=False,
+                    check_finite=True, chunk_rows=CHUNK_ROWS, projection=None, num_threads=1, shapes=None):
+    """
+    Streams .csv, .fcs and .h5ad files chunk by chunk into a single preallocated, C-contiguous float32 array.
+    Projection, feature selection, transformation and the NaN/Inf check are applied per chunk, so only
+    the final matrix is held in memory. Every file is written at its own row offset, known from the shapes of
+    the files, so that several files can be read at once by a pool of threads; parsing, projection and
+    transformation release the GIL for most of their work.
+
+    :param sources: list of file paths
+    :param feature_ids: columns to keep, all if None. With a projection these are principal components, as for
+        data prepared in memory
+    :param transformation: 'log', 'arcsinh' or None
+    :param cofactor: cofactor of the arcsinh transformation
+    :param csv_header: true if the first line of the csv files holds column names
+    :param check_finite: raise a ValueError when a chunk contains NaN or Inf
+    :param chunk_rows: number of rows read at once
+    :param projection: fitted PCA applied to all columns of the files, see pca.fit_pca_stream
+    :param num_threads: number of files read in parallel, all cores if 0
+    :param shapes: shapes of the files as returned by file_shapes, computed if None
+    :return: (np.ndarray with the rows of all files, list with the number of rows per file)
+    """
+    if shapes is None:
+        shapes = file_shapes(sources, csv_header, num_threads)
+    num_cols = {cols for _, cols in shapes}
+    if len(num_cols) > 1:
+        raise ValueError("Files have different numbers of columns: %s" % sorted(num_cols))
+    num_cols = num_cols.pop() if num_cols else 0
+    if projection is not None:
+        num_cols = projection.n_components_
+    if feature_ids is not None:
+        num_cols = len(np.arange(num_cols)[feature_ids])
+    offsets = np.cumsum([0] + [rows for rows, _ in shapes]).tolist()
+    out = np.empty((offsets[-1], num_cols), dtype=np.float32)
+
+    def fill(num):
+        source, filled = sources[num], offsets[num]
+        for chunk in iter_chunks(source, csv_header, chunk_rows):
+            if projection is not None:
+                chunk = projection.transform(np.asarray(chunk, dtype=np.float32))
+            if feature_ids is not None:
+                chunk = chunk[:, feature_ids]
+            target = out[filled:filled + len(chunk)]
+            target[...] = chunk
+            transform_chunk(target, transformation, cofactor)
+            if check_finite and not np.isfinite(target).all():
+                raise ValueError("Some of the fields in %s are NaN or Inf" % source)
+            filled += len(chunk)
+        return filled - offsets[num]
+
+    lengths = _map(fill, list(range(len(sources))), num_threads)
+    # Row counts of csv files include blank lines, the rows of later files are moved up over the gaps
+    filled = 0
+    for offset, length in zip(offsets, lengths):
+        if offset != filled:
+            out[filled:filled + length] = out[offset:offset + length]
+        filled += length
+    return out[:filled], lengths
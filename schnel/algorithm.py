@@ -1,99 +1,601 @@
-#pylint: disable=import-error
+#pylint: disable=import-error,import-outside-toplevel
 
-from schnel.clustering.HSNE_parser import read_HSNE_binary
+from schnel.clustering.HSNE import _argmax_rows, check_n_jobs
+from schnel.clustering.HSNE_parser import read_HSNE_buffers
+from schnel.clustering.cache import HierarchyCache, hierarchy_key
+from schnel.clustering.knn import KnnIndex, as_knn_graph, knn_graph
 import math
+import time
 import schnel.Data_Prep.dataprep as dp
-import numpy_to_hsne
+from schnel.Data_Prep.out_of_core import prepare_array
+from schnel.Data_Prep.pca import fit_pca
 import numpy as np
-import os
+from scipy.sparse import coo_matrix, csr_matrix, issparse
 
 
 def cluster(source, feature_ids=None, num_of_scales=0, num_of_neighbours=30, transformation_method=None, cofactor=5,
-            p_comps=None, cell_by_feature=True, csv_header=False):
+            p_comps=None, cell_by_feature=True, csv_header=False, hsne_file=None, n_jobs=1, seed=None,
+            scratch_dir=None, pca_method=None, pca_fit_rows=None, cache_dir=None, cache_size=None, num_threads=0,
+            knn_method='flann', knn=None, hsne_compress=False, prop_method='cluster', progress=None,
+            return_stats=False, warm_start=False, resolution=None):
     """
 
     This method is responsible for running the whole SCHNEL algorithm pipeline.
     Input data is parsed and transferred into a numpy array. Afterwards, the numpy array is processed with the help of C++ code
-    wrapped with pybind11. The output is a hsne binary file containing the generated HSNE hierarchy.
-    The HSNE hierarchy file is read by the HSNE parser, after which it is clustered with the Leiden algorithm.
+    wrapped with pybind11, which hands the generated HSNE hierarchy back as numpy arrays.
+    The HSNE hierarchy is built from these arrays, after which it is clustered with the Leiden algorithm.
     The output of this function is a list of matrices with columns as scales and rows as cluster classifications.
 
-    :param source: file path, ndarray, h5ad object or list of file paths
+    :param source: file path, ndarray, np.memmap, h5ad object or list of file paths. A single file is prepared
+        like a list holding it, with parse_to_numpy. .npy files are memory mapped, and a single one holding a
+        C-contiguous float32 matrix that needs no pca or transformation is handed to the hierarchy computation
+        without a copy.
+        .h5ad files are opened in backed mode; their obsm['X_pca'], or that of an h5ad object, is used if it has at
+        least p_comps components, otherwise the pca is computed on X in chunks, without densifying a sparse X.
+        A square scipy.sparse matrix is taken as the similarities between the points, e.g. a precomputed kNN graph
+        or a Jaccard/SNN graph. It replaces the data preparation and neighbour search and, with its rows normalized,
+        becomes the transition matrix of the first scale
     :param feature_ids: array of components on which the data should be clustered
     :param num_of_scales: number of scales used for creating an HSNE hierarchy structure
     :param num_of_neighbours: number of neighbours used in clustering
     :param transformation_method: type of transformation used (log, arch or None)
     :param cofactor: if arcsinh was specified you can pass the cofactor for thistransformation
     :param p_comps: Number of principal componenets after PCA
-    :param cell_by_feature: true if input data is cell by feature, false if feature by cell
+    :param cell_by_feature: true if input data is cell by feature, false if feature by cell. Feature by cell files
+        are read into memory, or scratch_dir, and transposed before the pca
+    :param hsne_file: optional path to which the hierarchy is additionally exported as a .hsne binary file in the
+        compact v2 format, whose scales can be read one by one with HSNE_parser.read_HSNE_scale
+    :param n_jobs: number of worker processes clustering the scales in parallel, -1 uses all cores. Other than
+        num_threads it follows the joblib convention of scikit-learn, 0 is not a valid number of processes
+    :param seed: positive integer seed for the hierarchy and the per-scale Leiden runs, random if None
+    :param scratch_dir: directory for memory-mapped intermediate arrays (feature selection, transposition, pca,
+        transformation), used for data sets larger than memory
+    :param pca_method: pca engine, 'auto', 'exact', 'randomized' or 'incremental'. Defaults to scikit-learn's
+        automatic choice, which holds the rows the pca is fitted on in memory; select 'incremental' or set
+        pca_fit_rows for streamed .csv, .fcs and .h5ad files larger than memory
+    :param pca_fit_rows: fit the pca on a random subsample of this many rows and project all rows in batches
+    :param cache_dir: directory of a HierarchyCache. A hierarchy computed before on the same data with the same
+        parameters and seed is loaded from it and only the clustering is redone, see also recluster.
+        The cache is bypassed when hsne_file is set or no seed is given, since an unseeded hierarchy is random
+    :param cache_size: maximal size of the cache directory in bytes, least recently used hierarchies are removed
+    :param num_threads: number of threads reading input files and computing the hierarchy, all cores if 0 (the
+        OpenMP convention of numpy_to_hsne). For a given seed the hierarchy is identical for any number of threads
+    :param knn_method: backend of the k nearest neighbour graph: 'flann' (approximated kd-trees), 'exact' (brute force),
+        'hnsw' or 'nndescent', see clustering.knn
+    :param knn: precomputed neighbour graph as tuple of (points x neighbours) arrays of indices and euclidean
+        distances of the prepared data, replaces knn_method
+    :param hsne_compress: compress the arrays of hsne_file with LZ4
+    :param prop_method: how the clusters of a scale are propagated to the data points. 'cluster' assigns every
+        point the cluster with the largest area of influence on it, 'label' the cluster of its best representative
+        landmark, which is cheaper
+    :param progress: function called as progress(stage, scale, done, total) while the hierarchy is computed, from
+        the threads of the computation, see numpy_to_hsne.compute
+    :param return_stats: also return the statistics of the run, see _run_stats
+    :param warm_start: cluster the scales from the coarsest down, starting the Leiden algorithm on every scale from
+        the membership of the coarser one instead of from singletons, see HSNE.cluster_scales. The scales are then
+        clustered one after the other and n_jobs is ignored
+    :param resolution: optimize the RBConfigurationVertexPartition with this resolution instead of modularity
+    :return: list of matrices equal to the size of the points/cells (rows)by the number of hierarchy scales (columns),
+        and the statistics of the run if return_stats is set
+    """
+    #pylint: disable=too-many-arguments,too-many-locals
+    tic = time.perf_counter()
+    try:
+        check_n_jobs(n_jobs)
+        np_arr, ret_lens, _ = _prepare_input(source, feature_ids, transformation_method, cofactor, p_comps,
+                                             cell_by_feature, csv_header, scratch_dir, pca_method, pca_fit_rows,
+                                             seed, num_threads=num_threads)
+    except ValueError as error:
+        print(error)
+        return
+    times = [time.perf_counter()]
+    hsne, key = _build_hierarchy(np_arr, num_of_scales, num_of_neighbours, seed, hsne_file, cache_dir, cache_size,
+                                 num_threads, knn_method, knn, hsne_compress, progress)
+    times.append(time.perf_counter())
+    labels = _label_matrix(hsne, seed, n_jobs, prop_method, warm_start, resolution)
+    times.append(time.perf_counter())
+    clusters = _split_by_file(labels, ret_lens)
+    if return_stats:
+        return clusters, _run_stats(hsne, tic, *times, cache_key=key)
+    return clusters
+
+
+def recluster(key, cache_dir, lengths=None, seed=None, n_jobs=1, prop_method='cluster', warm_start=False,
+              resolution=None):
+    """
+    Clusters a hierarchy stored in a HierarchyCache again, without recomputing it.
+
+    :param key: key of the hierarchy, the 'cache_key' of the statistics of cluster, Schnel.cache_key_ or one of
+        HierarchyCache.keys
+    :param cache_dir: directory of the cache
+    :param lengths: number of points per input file, all points are returned as one block if None
+    :param seed: positive integer seed for the per-scale Leiden runs, random if None
+    :param n_jobs: number of worker processes clustering the scales in parallel, -1 uses all cores
+    :param prop_method: 'cluster' or 'label', see cluster
+    :param warm_start: start every scale from the membership of the coarser one, see cluster
+    :param resolution: resolution of the RBConfigurationVertexPartition, modularity if None
     :return: list of matrices equal to the size of the points/cells (rows)by the number of hierarchy scales (columns)
     """
-    #pylint: disable=too-many-arguments
+    scales = HierarchyCache(cache_dir).load(key)
+    if scales is None:
+        raise KeyError("No hierarchy with key %s in %s" % (key, cache_dir))
+    ret_lens = np.cumsum(lengths if lengths is not None else [scales[0]['size']]).tolist()
+    return _split_by_file(_label_matrix(read_HSNE_buffers(scales), seed, n_jobs, prop_method, warm_start, resolution),
+                          ret_lens)
 
-    #private parameters
-    seeds = -1
-    landmark_treshold = 1.5
-    num_trees = 6
-    num_checks = 1024
-    trans_matrix_prune_treshold = 1.5
-    num_walks = 200
-    num_walks_per_landmark = 200
-    monte_carlo_sampling = True
-    out_of_core_computation = True
 
+class Schnel:
+    """
+    Estimator interface to the SCHNEL pipeline. Other than cluster, it keeps the HSNE hierarchy after fitting,
+    together with the igraph graphs cached on its scales, so single scales can be clustered again cheaply.
+    It also keeps the prepared reference data, so that new points can be assigned to the clusters of the fitted
+    hierarchy without rebuilding it, see assign.
+    """
+
+    def __init__(self, num_of_scales=0, num_of_neighbours=30, transformation_method=None, cofactor=5, p_comps=None,
+                 seed=None, n_jobs=1, scratch_dir=None, pca_method=None, pca_fit_rows=None, cache_dir=None,
+                 cache_size=None, num_threads=0, knn_method='flann', prop_method='cluster', warm_start=False,
+                 resolution=None):
+        """
+        Initialization function for the Schnel estimator, the parameters are those of cluster.
+        """
+        #pylint: disable=too-many-arguments
+        self.num_of_scales = num_of_scales
+        self.num_of_neighbours = num_of_neighbours
+        self.transformation_method = transformation_method
+        self.cofactor = cofactor
+        self.p_comps = p_comps
+        self.seed = seed
+        self.n_jobs = n_jobs
+        self.scratch_dir = scratch_dir
+        self.pca_method = pca_method
+        self.pca_fit_rows = pca_fit_rows
+        self.cache_dir = cache_dir
+        self.cache_size = cache_size
+        self.num_threads = num_threads
+        self.knn_method = knn_method
+        self.prop_method = prop_method
+        self.warm_start = warm_start
+        self.resolution = resolution
+        # HSNE hierarchy, labels of the data points (rows) on every subscale (columns) and rows per input file
+        self.hsne_ = None
+        self.labels_ = None
+        self.lengths_ = None
+        # Prepared reference data, the pca it was projected on (None if it was not) and its neighbour index,
+        # which is built by the first call of assign
+        self.reference_ = None
+        self.projection_ = None
+        self.knn_index_ = None
+        # Statistics of the last fit, see _run_stats, and the key of its hierarchy in the cache for recluster
+        self.stats_ = None
+        self.cache_key_ = None
+
+    def fit(self, source, feature_ids=None, cell_by_feature=True, csv_header=False, hsne_file=None, knn=None,
+            hsne_compress=False, progress=None):
+        """
+        Computes the hierarchy of source and clusters all of its subscales.
+
+        :param source: file path, ndarray, np.memmap, h5ad object, list of file paths or sparse similarity matrix
+        :param feature_ids: array of components on which the data should be clustered
+        :param cell_by_feature: true if input data is cell by feature, false if feature by cell
+        :param csv_header: set to true if there are column names in csv files
+        :param hsne_file: optional path to which the hierarchy is additionally exported as a .hsne binary file
+        :param knn: precomputed neighbour graph as tuple of indices and euclidean distances, see cluster
+        :param hsne_compress: compress the arrays of hsne_file with LZ4
+        :param progress: function called as progress(stage, scale, done, total) while the hierarchy is computed,
+            see cluster
+        :return: self
+        """
+        check_n_jobs(self.n_jobs)
+        tic = time.perf_counter()
+        np_arr, ret_lens, self.projection_ = _prepare_input(source, feature_ids, self.transformation_method,
+                                                            self.cofactor, self.p_comps, cell_by_feature, csv_header,
+                                                            self.scratch_dir, self.pca_method, self.pca_fit_rows,
+                                                            self.seed, num_threads=self.num_threads)
+        self.reference_ = None if issparse(np_arr) else np_arr
+        self.knn_index_ = None
+        times = [time.perf_counter()]
+        self.hsne_, self.cache_key_ = _build_hierarchy(np_arr, self.num_of_scales, self.num_of_neighbours, self.seed,
+                                                       hsne_file, self.cache_dir, self.cache_size, self.num_threads,
+                                                       self.knn_method, knn, hsne_compress, progress)
+        times.append(time.perf_counter())
+        self.lengths_ = np.diff([0] + ret_lens).tolist()
+        self.labels_ = _label_matrix(self.hsne_, self.seed, self.n_jobs, self.prop_method, self.warm_start,
+                                     self.resolution)
+        times.append(time.perf_counter())
+        self.stats_ = _run_stats(self.hsne_, tic, *times, cache_key=self.cache_key_)
+        return self
+
+    def fit_predict(self, source, **kwargs):
+        """
+        Fits the estimator, see fit for the arguments.
+
+        :return: labels_
+        """
+        return self.fit(source, **kwargs).labels_
+
+    def cluster_scale(self, scalenumber, seed=None, symmetrize=False):
+        """
+        Clusters a single scale again and stores the propagated labels in labels_.
+        The graph of the scale is built once and reused by later calls.
+
+        :param scalenumber: subscale to cluster
+        :param seed: seed of the Leiden algorithm, random if None
+        :param symmetrize: cluster the undirected graph in which the weights of (i, j) and (j, i) are summed
+        :return: labels of the data points
+        """
+        self._check_subscale(scalenumber)
+        labels = np.asarray(self.hsne_.cluster_scale(scalenumber, prop_method=self.prop_method, symmetrize=symmetrize,
+                                                     seed=seed, resolution=self.resolution))
+        self.labels_[:, scalenumber - 1] = labels
+        return labels
 
-    #todo:
-    #multiple files
+    def _check_subscale(self, scalenumber):
+        """
+        Raises a ValueError unless the estimator is fitted and scalenumber is one of its subscales, 1 up to
+        the number of scales excluded; the data scale 0 has no column in labels_.
+        """
+        if self.hsne_ is None:
+            raise ValueError("The estimator has to be fitted first")
+        if not 1 <= scalenumber < self.hsne_.num_scales:
+            raise ValueError("Scale %s is not a subscale, use 1 to %i" % (scalenumber, self.hsne_.num_scales - 1))
+
+    def resolution_sweep(self, scalenumber, resolutions, seed=None, symmetrize=False):
+        """
+        Clusters a single scale with the RBConfigurationVertexPartition at several resolutions, every resolution
+        starting from the partition of the one before, see HSNE.resolution_sweep. labels_ is left unchanged.
+
+        :param scalenumber: subscale to cluster
+        :param resolutions: resolution parameters in the order they are run, e.g. ascending
+        :param seed: seed of the Leiden algorithm, random if None
+        :param symmetrize: cluster the undirected graph in which the weights of (i, j) and (j, i) are summed
+        :return: matrix of the labels of the data points (rows) at every resolution (columns)
+        """
+        self._check_subscale(scalenumber)
+        sweep = self.hsne_.resolution_sweep(scalenumber, resolutions, prop_method=self.prop_method,
+                                            symmetrize=symmetrize, seed=seed)
+        return np.column_stack([np.asarray(labels, dtype=np.int64) for labels in sweep])
+
+    def assign(self, source, feature_ids=None, cell_by_feature=True, csv_header=False, num_of_neighbours=None,
+               batch_size=1 << 16):
+        """
+        Assigns new points to the clusters of the fitted hierarchy on every subscale, without rebuilding it.
+        The new points are prepared like the reference data and, if it was projected, projected on the same pca.
+        Their nearest reference points are looked up in batches with the index of knn_method, built once and kept
+        in knn_index_. Weighted by distance, the neighbours pass their area of influence on the landmarks of the
+        first scale on to the new points, and from there they are labeled like the reference points, see
+        prop_method. New points have to be given in the feature space the reference was fitted in: as arrays
+        prepared the same way, or as files projected on the single pca of streamed .csv, .fcs and .h5ad files.
+
+        :param source: file path, ndarray, np.memmap or list of file paths of new points
+        :param feature_ids: array of components on which the data was clustered
+        :param cell_by_feature: true if input data is cell by feature, false if feature by cell
+        :param csv_header: set to true if there are column names in csv files
+        :param num_of_neighbours: number of reference neighbours per new point, the num_of_neighbours of the
+            estimator if None
+        :param batch_size: number of new points queried and labeled at once
+        :return: matrix of the labels of the new points (rows) on every subscale (columns), like labels_
+        """
+        if self.hsne_ is None:
+            raise ValueError("The estimator has to be fitted first")
+        if self.reference_ is None:
+            raise ValueError("New points can't be assigned to a hierarchy fitted on a similarity matrix")
+        if not isinstance(source, (str, list, np.ndarray)):
+            raise ValueError("New points must be given as arrays or files")
+        # Without a fitted pca the new points must not be projected on one of their own
+        p_comps = self.p_comps if self.projection_ is not None else math.inf
+        new_points, _, _ = _prepare_input(source, feature_ids, self.transformation_method, self.cofactor, p_comps,
+                                          cell_by_feature, csv_header, self.scratch_dir, projection=self.projection_,
+                                          num_threads=self.num_threads)
+        if new_points.shape[1] != self.reference_.shape[1]:
+            raise ValueError("New points have %i features after preparation, the reference data has %i"
+                             % (new_points.shape[1], self.reference_.shape[1]))
+        if self.knn_index_ is None:
+            self.knn_index_ = KnnIndex(self.reference_, method=self.knn_method, seed=self.seed,
+                                       num_threads=self.num_threads)
+        num_of_neighbours = num_of_neighbours or self.num_of_neighbours
+        first_scale = self.hsne_[1]
+        landmark_labels = self.labels_[first_scale.lm_to_original]
+        labels = np.empty((len(new_points), self.labels_.shape[1]), dtype=self.labels_.dtype)
+        for start in range(0, len(new_points), batch_size):
+            indices, distances = self.knn_index_.query(new_points[start:start + batch_size], num_of_neighbours,
+                                                       batch_size)
+            influence = _neighbour_weights(indices, distances, len(self.reference_)) @ first_scale.area_of_influence
+            labels[start:start + len(indices)] = _influence_to_labels(influence, landmark_labels, self.prop_method)
+        return labels
+
+    def predict(self, source, **kwargs):
+        """
+        Assigns new points to the clusters of the fitted hierarchy, see assign for the arguments.
+
+        :return: label matrix of the new points
+        """
+        return self.assign(source, **kwargs)
+
+    def labels_by_file(self):
+        """
+        :return: labels_ split into one matrix per input file, like the result of cluster
+        """
+        return _split_by_file(self.labels_, np.cumsum(self.lengths_).tolist())
+
+
+def _prepare_input(source, feature_ids=None, transformation_method=None, cofactor=5, p_comps=None,
+                   cell_by_feature=True, csv_header=False, scratch_dir=None, pca_method=None, pca_fit_rows=None,
+                   seed=None, projection=None, num_threads=0):
+    """
+    Parses and preprocesses the input of cluster into the float32 matrix the hierarchy is computed on.
+    Lists of .csv, .fcs and .h5ad files are read by num_threads threads into one array and projected on a single
+    pca fitted across all of them. Given a fitted projection, files are projected on it instead. A single .h5ad
+    file whose obsm holds a pca with at least p_comps components is represented by that pca. feature_ids select
+    columns after the pca, as for arrays.
+
+    :return: (matrix, cumulative number of points per input file, pca fitted across streamed files or None),
+        raises a ValueError on invalid data. For a sparse similarity matrix the matrix is the CSR transition matrix
+        of the first scale
+    """
+    #pylint: disable=too-many-arguments
+    if issparse(source):
+        return _transition_matrix(source), [source.shape[0]], None
     src_list = []
     ret_lens = []
     curr_len = 0
     if p_comps is None:
         p_comps = 50
+    prepared = False
+    transpose = cell_by_feature is False
     if isinstance(source, np.ndarray):
         np_arr = source
         ret_lens.append(len(np_arr))
     else:
-        if isinstance(source, str):
+        if isinstance(source, str) or dp.is_anndata(source):
             source = [source]
-        for elem in source:
-            np_elem = dp.parse_to_numpy(elem, transformation=transformation_method, cofactor=cofactor,
-                                        features_after_pca=p_comps, csv_header=csv_header)
-            ret_lens.append(len(np_elem) + curr_len)
-            curr_len = curr_len + len(np_elem)
-            src_list.append(np_elem)
-
-        np_arr = np.vstack(src_list)
-    if feature_ids is not None:
-        np_arr = np_arr[:, feature_ids]
-    check_num = int(math.log10(len(np_arr)/100))
+        embedding = None
+        if projection is None and not transpose:
+            embedding = dp.h5ad_embedding(source, p_comps)
+        if transpose:
+            np_arr, ret_lens, projection = _prepare_transposed(source, transformation_method, cofactor, p_comps,
+                                                               csv_header, scratch_dir, pca_method, pca_fit_rows,
+                                                               seed, projection)
+            transpose = False
+        elif embedding is not None:
+            np_arr = prepare_array(dp.parse_to_numpy(embedding, transformation=transformation_method,
+                                                     cofactor=cofactor, features_after_pca=p_comps),
+                                   feature_ids=feature_ids, scratch_dir=scratch_dir)
+            ret_lens.append(len(np_arr))
+            prepared = True
+        elif dp.can_stream(source):
+            shapes = dp.file_shapes(source, csv_header, num_threads)
+            if projection is None:
+                projection = dp.fit_projection(source, features_after_pca=p_comps, csv_header=csv_header,
+                                               pca_method=pca_method, pca_fit_rows=pca_fit_rows, seed=seed,
+                                               shapes=shapes)
+            np_arr, lengths = dp.stream_files(source, feature_ids=feature_ids,
+                                              transformation=transformation_method, cofactor=cofactor,
+                                              features_after_pca=p_comps, csv_header=csv_header,
+                                              projection=projection, num_threads=num_threads, shapes=shapes)
+            ret_lens = np.cumsum(lengths).tolist()
+            prepared = True
+        else:
+            for elem in source:
+                np_elem = dp.parse_to_numpy(elem, transformation=transformation_method, cofactor=cofactor,
+                                            features_after_pca=p_comps, csv_header=csv_header,
+                                            scratch_dir=scratch_dir, pca_method=pca_method,
+                                            pca_fit_rows=pca_fit_rows, seed=seed, projection=projection)
+                ret_lens.append(len(np_elem) + curr_len)
+                curr_len = curr_len + len(np_elem)
+                src_list.append(np_elem)
+
+            np_arr = src_list[0] if len(src_list) == 1 else np.vstack(src_list)
+    if not prepared:
+        np_arr = prepare_array(np_arr, feature_ids=feature_ids, transpose=transpose, scratch_dir=scratch_dir)
+    return np_arr, ret_lens, projection
+
+
+def _prepare_transposed(sources, transformation_method=None, cofactor=5, p_comps=50, csv_header=False,
+                        scratch_dir=None, pca_method=None, pca_fit_rows=None, seed=None, projection=None):
+    """
+    Prepares feature by cell files. Their cells are their columns, so the files are transposed before the pca is
+    fitted, which therefore is fitted in memory on the transposed files, or on a subsample of pca_fit_rows cells.
+
+    :return: (cell by feature matrix, cumulative number of cells per input file, fitted pca or None)
+    """
+    #pylint: disable=too-many-arguments
+    np_arr, lengths = dp.transpose_files(sources, csv_header, scratch_dir)
+    if projection is None and np_arr.shape[1] > p_comps:
+        projection = fit_pca(np_arr, p_comps, method=pca_method or 'auto', fit_rows=pca_fit_rows, seed=seed)
+    np_arr = dp.parse_to_numpy(np_arr, transformation=transformation_method, cofactor=cofactor,
+                               features_after_pca=p_comps, scratch_dir=scratch_dir, projection=projection)
+    return np_arr, np.cumsum(lengths).tolist(), projection
+
+
+def _build_hierarchy(np_arr, num_of_scales=0, num_of_neighbours=30, seed=None, hsne_file=None, cache_dir=None,
+                     cache_size=None, num_threads=0, knn_method='flann', knn=None, hsne_compress=False,
+                     progress=None):
+    """
+    Computes the HSNE hierarchy of a float32 matrix, or of a CSR transition matrix as returned by _transition_matrix,
+    or loads it from the hierarchy cache.
+
+    :return: (HSNE object, key of the hierarchy in the cache or None if the cache was not used)
+    """
+    #pylint: disable=too-many-arguments
+    # The compiled module is only needed here and in _run_stats, fitted hierarchies are used without it
+    import numpy_to_hsne
+
+    #private parameters
+    seeds = seed if seed is not None else -1
+    landmark_treshold = 1.5
+    num_trees = 6
+    num_checks = 1024
+    trans_matrix_prune_treshold = 1.5
+    num_walks = 200
+    num_walks_per_landmark = 200
+    monte_carlo_sampling = True
+    out_of_core_computation = True
+
+    similarities = issparse(np_arr)
+    check_num = int(math.log10(np_arr.shape[0]/100))
     if num_of_scales < 2 and check_num > 1:
         num_of_scales = check_num
     elif num_of_scales < 2 and check_num < 2:
         print("The specified number of scales is below 2. The default value (2) will be used")
         num_of_scales = 2
-    if cell_by_feature is False:
-        np_arr = np_arr.transpose()
-    if np.isnan(np_arr).any() or np.isinf(np_arr).any():
-        print("Some of the fields in the data set are NaN or Inf")
-        return
-    numpy_to_hsne.run(np_arr, 'values.hsne', num_of_scales, seeds, landmark_treshold, num_of_neighbours,
-                      num_trees, num_checks, trans_matrix_prune_treshold, num_walks, num_walks_per_landmark,
-                      monte_carlo_sampling, out_of_core_computation)
-    hsne = read_HSNE_binary('values.hsne')
-    scaled_clusters = []
-    for i in range(hsne.num_scales - 1):
-        elem_clusters = hsne.cluster_scale(i + 1)
-        elem_clusters = np.asarray(elem_clusters)
-        scaled_clusters.append(elem_clusters.tolist())
-
-    scaled_clusters = np.transpose(np.array(scaled_clusters))
+    params = dict(num_of_scales=num_of_scales, num_of_neighbours=num_of_neighbours, seed=seeds,
+                  landmark_treshold=landmark_treshold, num_trees=num_trees, num_checks=num_checks,
+                  trans_matrix_prune_treshold=trans_matrix_prune_treshold, num_walks=num_walks,
+                  num_walks_per_landmark=num_walks_per_landmark, monte_carlo_sampling=monte_carlo_sampling,
+                  out_of_core_computation=out_of_core_computation,
+                  knn_method='similarities' if similarities else knn_method if knn is None else 'precomputed')
+    knn_indices = knn_distances = None
+    if knn is not None:
+        knn_indices, knn_distances = as_knn_graph(knn[0], knn[1], num_of_neighbours)
+    cache = key = scales = None
+    if cache_dir is not None and hsne_file is None and seed is not None:
+        cache = HierarchyCache(cache_dir) if cache_size is None else HierarchyCache(cache_dir, cache_size)
+        if knn is not None:
+            params['knn'] = (hierarchy_key(knn_indices), hierarchy_key(knn_distances))
+        if similarities:
+            params['similarities'] = (hierarchy_key(np_arr.indptr), hierarchy_key(np_arr.indices))
+        key = hierarchy_key(np_arr.data if similarities else np_arr, **params)
+        scales = cache.load(key)
+    if scales is None and similarities:
+        scales = numpy_to_hsne.compute_from_similarities(np_arr.indptr, np_arr.indices, np_arr.data, num_of_scales,
+                                                         seeds, landmark_treshold, trans_matrix_prune_treshold,
+                                                         num_walks, num_walks_per_landmark, monte_carlo_sampling,
+                                                         out_of_core_computation,
+                                                         hsne_file if hsne_file is not None else "",
+                                                         num_threads=num_threads, compress=hsne_compress,
+                                                         progress=progress)
+        if cache is not None:
+            cache.store(key, scales)
+    elif scales is None:
+        if knn is None and knn_method != 'flann':
+            knn_indices, knn_distances = knn_graph(np_arr, num_of_neighbours, method=knn_method, seed=seed,
+                                                   num_threads=num_threads)
+        scales = numpy_to_hsne.compute(np_arr, num_of_scales, seeds, landmark_treshold, num_of_neighbours,
+                                       num_trees, num_checks, trans_matrix_prune_treshold, num_walks,
+                                       num_walks_per_landmark, monte_carlo_sampling, out_of_core_computation,
+                                       hsne_file if hsne_file is not None else "", num_threads=num_threads,
+                                       knn_indices=knn_indices, knn_distances=knn_distances,
+                                       compress=hsne_compress, progress=progress)
+        if cache is not None:
+            cache.store(key, scales)
+    return read_HSNE_buffers(scales), key
+
+
+def _run_stats(hsne, start, prepared, built, clustered, cache_key=None):
+    """
+    Statistics of a run of the pipeline, from the perf_counter times at the start and at the end of every stage.
+
+    :return: dict with the seconds of the stages prepare (parsing, preprocessing and pca), hierarchy and clustering
+        (Leiden and propagation on every subscale), the peak resident memory of the process in bytes and, under
+        'scales', the statistics of every scale of the hierarchy computation (see numpy_to_hsne.compute), None if
+        the hierarchy was loaded from the cache, and under 'cache_key' the key of the hierarchy in the cache, to be
+        passed to recluster, or None if the cache was not used
+    """
+    import numpy_to_hsne
+    return {'prepare_time': prepared - start, 'hierarchy_time': built - prepared, 'clustering_time': clustered - built,
+            'total_time': clustered - start, 'peak_rss_bytes': numpy_to_hsne.peak_memory(), 'scales': hsne.statistics,
+            'cache_key': cache_key}
+
+
+def _transition_matrix(similarities):
+    """
+    Turns a sparse similarity matrix into the transition matrix of the first scale: CSR with sorted column indices,
+    without diagonal and duplicate entries, and with every row normalized to sum to one.
+
+    :param similarities: square scipy.sparse matrix with non-negative entries
+    :return: float32 scipy.sparse.csr_matrix, raises a ValueError on invalid input
+    """
+    if similarities.shape[0] != similarities.shape[1]:
+        raise ValueError("The similarity matrix must be square, got shape %s" % (similarities.shape,))
+    coo = coo_matrix(similarities)
+    keep = coo.row != coo.col
+    if (coo.data[keep] < 0).any() or not np.isfinite(coo.data[keep]).all():
+        raise ValueError("The similarity matrix must have finite, non-negative entries")
+    # the conversion sums duplicates and sorts the column indices
+    matrix = csr_matrix((coo.data[keep].astype(np.float32), (coo.row[keep], coo.col[keep])), shape=coo.shape)
+    matrix.eliminate_zeros()
+    sums = np.asarray(matrix.sum(axis=1), dtype=np.float32).ravel()
+    sums[sums == 0] = 1
+    matrix.data /= np.repeat(sums, np.diff(matrix.indptr))
+    return matrix
+
+
+def _label_matrix(hsne, seed=None, n_jobs=1, prop_method='cluster', warm_start=False, resolution=None):
+    """
+    Clusters all subscales of a hierarchy.
+
+    :param hsne: HSNE object
+    :param seed: positive integer seed for the per-scale Leiden runs, random if None
+    :param n_jobs: number of worker processes clustering the scales in parallel
+    :param prop_method: 'cluster' or 'label', see cluster
+    :param warm_start: start every scale from the membership of the coarser one, see cluster
+    :param resolution: resolution of the RBConfigurationVertexPartition, modularity if None
+    :return: matrix of the labels of the data points (rows) on every subscale (columns)
+    """
+    scaled_clusters = hsne.cluster_scales(range(1, hsne.num_scales), prop_method=prop_method, seed=seed,
+                                          n_jobs=n_jobs, warm_start=warm_start, resolution=resolution)
+
+    print("Clustering done")
+    print("Created clusters on ", hsne.num_scales, " scales..")
+    return np.column_stack([np.asarray(elem_clusters, dtype=np.int64) for elem_clusters in scaled_clusters])
+
+
+def _neighbour_weights(indices, distances, num_points):
+    """
+    Sparse matrix of the weights of the reference neighbours of new points. Every neighbour is weighted with a
+    Gaussian kernel of its squared distance, whose bandwidth is the mean squared distance of the row, and every
+    row sums to one.
+
+    :param indices: new points by neighbours array of reference point indices
+    :param distances: squared euclidean distances of the same shape
+    :param num_points: number of reference points
+    :return: scipy.sparse.csr_matrix of new points by reference points
+    """
+    distances = distances.astype(np.float64)
+    distances -= distances[:, :1]
+    bandwidth = distances.mean(axis=1, keepdims=True)
+    bandwidth[bandwidth == 0] = 1
+    weights = np.exp(-distances / bandwidth)
+    weights /= weights.sum(axis=1, keepdims=True)
+    num_rows, num_cols = indices.shape
+    return csr_matrix((weights.ravel(), indices.ravel(), np.arange(0, num_rows * num_cols + 1, num_cols)),
+                      shape=(num_rows, num_points))
+
+
+def _influence_to_labels(influence, landmark_labels, prop_method='cluster'):
+    """
+    Labels points by their area of influence on the landmarks of the first scale, like the data points are
+    labeled by HSNE.cluster_scale.
+
+    :param influence: sparse matrix of points by landmarks of the first scale
+    :param landmark_labels: matrix of the labels of the landmarks (rows) on every subscale (columns)
+    :param prop_method: 'cluster' assigns the label with the largest influence on the point, 'label' the labels
+        of the landmark with the largest influence
+    :return: matrix of the labels of the points (rows) on every subscale (columns)
+    """
+    if prop_method == 'label':
+        return landmark_labels[_argmax_rows(influence)]
+    if prop_method != 'cluster':
+        raise ValueError("Invalid method, options are 'label' or 'cluster'")
+    labels = np.empty((influence.shape[0], landmark_labels.shape[1]), dtype=landmark_labels.dtype)
+    for col in range(landmark_labels.shape[1]):
+        values, label_idx = np.unique(landmark_labels[:, col], return_inverse=True)
+        indicator = csr_matrix((np.ones(len(label_idx)), label_idx.ravel(), np.arange(len(label_idx) + 1)),
+                               shape=(len(label_idx), len(values)))
+        labels[:, col] = values[_argmax_rows(influence @ indicator)]
+    return labels
+
+
+def _split_by_file(scaled_clusters, ret_lens):
+    """
+    :param scaled_clusters: label matrix of all data points
+    :param ret_lens: cumulative number of points per input file
+    :return: list of label matrices, one per file
+    """
     clusters_by_file = []
     prev = 0
     for length in ret_lens:
         clusters_by_file.append(scaled_clusters[prev:length][:])
         prev = length
-
-    print("Clustering done")
-    os.remove('values.hsne')
-    print("Created clusters on ", hsne.num_scales, " scales..")
-    return clusters_by_file
\ No newline at end of file
+    return clusters_by_file
@@ -0,0 +1,128 @@
+#pylint: disable=import-outside-toplevel
+import argparse
+import json
+import os
+import sys
+from schnel.Data_Prep.read_dir import read_directory
+
+INPUT_EXTENSIONS = ('.csv', '.fcs', '.h5ad', '.npy')
+
+
+def expand_inputs(paths, ext=None):
+    """
+    Replaces directories by the files they contain, in sorted order.
+
+    :param paths: list of file and directory paths
+    :param ext: extension of the files taken from directories, all of INPUT_EXTENSIONS if None
+    :return: list of file paths, raises a ValueError for missing paths and empty directories
+    """
+    files = []
+    for path in paths:
+        if os.path.isdir(path):
+            extensions = (ext,) if ext else INPUT_EXTENSIONS
+            found = sorted(name for name in read_directory(path, ext or '')
+                           if os.path.splitext(name)[1] in extensions and os.path.isfile(name))
+            if not found:
+                raise ValueError("No input files in directory %s" % path)
+            files += found
+        elif os.path.isfile(path):
+            files.append(path)
+        else:
+            raise ValueError("No such file or directory: %s" % path)
+    return files
+
+
+def label_paths(files, out_dir, fmt='csv'):
+    """
+    Output path of the labels of every input file: <out_dir>/<name of the file>.labels.<fmt>.
+
+    :param files: list of input files
+    :param out_dir: output directory
+    :param fmt: 'csv' or 'npy'
+    :return: list of paths, raises a ValueError if two input files share a name
+    """
+    names = [os.path.splitext(os.path.basename(path))[0] for path in files]
+    if len(set(names)) != len(names):
+        raise ValueError("Input files with the same name would overwrite each other's labels")
+    return [os.path.join(out_dir, name + '.labels.' + fmt) for name in names]
+
+
+def _parser():
+    parser = argparse.ArgumentParser(
+        prog='schnel', description="Clusters .csv, .fcs, .h5ad and .npy files with SCHNEL and writes the labels of "
+                                   "every file on every subscale (columns) to <out>/<name>.labels.csv or .npy. "
+                                   "All inputs are clustered together, as one data set.")
+    parser.add_argument('inputs', nargs='+', help="input files or directories")
+    parser.add_argument('-o', '--out', default='.', help="output directory, created if needed (default: .)")
+    parser.add_argument('--ext', help="extension of the files read from directories, e.g. .fcs (default: all of %s)"
+                        % ', '.join(INPUT_EXTENSIONS))
+    parser.add_argument('--format', choices=('csv', 'npy'), default='csv', help="format of the label files")
+    parser.add_argument('--scales', type=int, default=0, help="number of scales, chosen from the data size if 0")
+    parser.add_argument('--neighbours', type=int, default=30, help="number of nearest neighbours")
+    parser.add_argument('--pca', type=int, help="number of principal components (default: 50)")
+    parser.add_argument('--pca-method', choices=('auto', 'exact', 'randomized', 'incremental'), help="pca engine")
+    parser.add_argument('--pca-fit-rows', type=int, help="fit the pca on a random subsample of this many rows")
+    parser.add_argument('--transformation', choices=('log', 'arcsinh'), help="transformation of the data")
+    parser.add_argument('--cofactor', type=float, default=5, help="cofactor of the arcsinh transformation")
+    parser.add_argument('--feature-by-cell', action='store_true', help="inputs are feature by cell")
+    parser.add_argument('--csv-header', action='store_true', help="the first line of csv files holds column names")
+    parser.add_argument('--knn-method', choices=('flann', 'exact', 'hnsw', 'nndescent'), default='flann',
+                        help="nearest neighbour search")
+    parser.add_argument('--prop-method', choices=('cluster', 'label'), default='cluster',
+                        help="propagation of the landmark clusters to the data points")
+    parser.add_argument('--warm-start', action='store_true',
+                        help="start every scale from the clusters of the coarser one")
+    parser.add_argument('--resolution', type=float, help="resolution of the RBConfigurationVertexPartition")
+    parser.add_argument('--seed', type=int, help="seed of the hierarchy and of Leiden")
+    parser.add_argument('--jobs', type=int, default=1, help="worker processes clustering the scales, -1 for all cores")
+    parser.add_argument('--threads', type=int, default=0, help="threads of the hierarchy computation, 0 for all cores")
+    parser.add_argument('--scratch-dir', help="directory for memory-mapped intermediate results")
+    parser.add_argument('--cache-dir', help="directory of the hierarchy cache, used when --seed is given")
+    parser.add_argument('--hsne-file', help="path the hierarchy is written to")
+    parser.add_argument('--stats', help="JSON file the run statistics are written to")
+    return parser
+
+
+def main(argv=None):
+    """
+    Entry point of the schnel command: clusters the input files with algorithm.cluster and writes their labels.
+    The pipeline is only imported after the arguments are parsed, and its heavy dependencies only when the
+    inputs need them.
+
+    :param argv: command line arguments, sys.argv[1:] if None
+    :return: exit status
+    """
+    args = _parser().parse_args(argv)
+    try:
+        files = expand_inputs(args.inputs, args.ext)
+        outputs = label_paths(files, args.out, args.format)
+    except ValueError as error:
+        print(error, file=sys.stderr)
+        return 2
+    import numpy as np
+    from schnel.algorithm import cluster
+    result = cluster(files[0] if len(files) == 1 else files, num_of_scales=args.scales,
+                     num_of_neighbours=args.neighbours, transformation_method=args.transformation,
+                     cofactor=args.cofactor, p_comps=args.pca, cell_by_feature=not args.feature_by_cell,
+                     csv_header=args.csv_header, hsne_file=args.hsne_file, n_jobs=args.jobs, seed=args.seed,
+                     scratch_dir=args.scratch_dir, pca_method=args.pca_method, pca_fit_rows=args.pca_fit_rows,
+                     cache_dir=args.cache_dir, num_threads=args.threads, knn_method=args.knn_method,
+                     prop_method=args.prop_method, return_stats=True, warm_start=args.warm_start,
+                     resolution=args.resolution)
+    if result is None:
+        return 1
+    clusters, stats = result
+    os.makedirs(args.out, exist_ok=True)
+    for labels, path in zip(clusters, outputs):
+        if args.format == 'npy':
+            np.save(path, labels)
+        else:
+            np.savetxt(path, labels, fmt='%d', delimiter=',')
+    if args.stats:
+        with open(args.stats, 'w') as handle:
+            json.dump(stats, handle, indent=1)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,33 +1,52 @@
 # pylint:disable-all
 
-from scipy.sparse import csc_matrix, lil_matrix
+from scipy.sparse import csc_matrix, csr_matrix
 import numpy as _np
+import os
 import warnings
-import igraph as ig
-import leidenalg
 
 
 class HSNE:
-    def __init__(self, num_scales):
+    def __init__(self, num_scales, loader=None, sizes=None, closer=None):
         """
         Initialization function for HSNE class.
 
         :param num_scales: number of scales
+        :param loader: function that loads a scale by its number. If given, scales are loaded on first access and
+            can be released again with unload. It may be called from several threads at once
+        :param sizes: number of points of every scale, if known without loading the scales
+        :param closer: function releasing the file the loader reads from, called by close
         """
         # Number of scales in hierarchy including datascale
         self.num_scales = num_scales
-        # Scales which are at index 0 a datascale and the rest are subscales
+        # Scales which are at index 0 a datascale and the rest are subscales, None if not loaded (yet)
         self.scales = [None] * num_scales
         self._index = -1
+        self._loader = loader
+        self._sizes = sizes
+        self._closer = closer
+        # Composed data scale mappings by scale, see get_datascale_mappings
+        self._datascale_maps = {}
+        # Statistics of the computation of every scale as returned by numpy_to_hsne.compute, None if the hierarchy
+        # was not computed in this process
+        self.statistics = None
 
     def __str__(self):
         return "HSNE hierarchy with %i scales" % self.num_scales
 
     def __getitem__(self, index):
-        return self.scales[index]
+        if isinstance(index, slice):
+            return [self[idx] for idx in range(*index.indices(self.num_scales))]
+        scale = self.scales[index]
+        if scale is None and self._loader is not None:
+            index = range(self.num_scales)[index]
+            scale = self._loader(index)
+            self.scales[index] = scale
+        return scale
 
     def __setitem__(self, index, value):
         self.scales[index] = value
+        self._datascale_maps.clear()
 
     def __iter__(self):
         return self
@@ -37,7 +56,45 @@ class HSNE:
             self._index = -1
             raise StopIteration
         self._index += 1
-        return self.scales[self._index]
+        return self[self._index]
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def unload(self, scalenumber):
+        """
+        Releases a scale that was loaded on demand, together with the graphs cached on it.
+        It is loaded again on the next access.
+
+        :param scalenumber: scale to release
+        """
+        if self._loader is None:
+            raise ValueError("The scales of this hierarchy are not loaded on demand")
+        self.scales[scalenumber] = None
+
+    def close(self):
+        """
+        Releases the file of a hierarchy whose scales are loaded on demand. Scales that were loaded stay usable,
+        the others can't be loaded anymore.
+        """
+        if self._closer is not None:
+            self._closer()
+        self._closer = None
+        self._loader = None
+
+    def scale_size(self, scalenumber):
+        """
+        Number of points of a scale, without loading it if the size is known.
+
+        :param scalenumber: scale
+        :return: int
+        """
+        if self._sizes is not None:
+            return int(self._sizes[scalenumber])
+        return self[scalenumber].size
 
     def get_topscale(self):
         """
@@ -45,90 +102,348 @@ class HSNE:
 
         :return: first scale
         """
-        return self.scales[0]
+        return self[0]
 
     def get_datascale_mappings(self, scalenumber):
         """
         Generates data scale mappings between the most representative landmarks and data vectors at a given scale.
+        The best representatives of the scales are composed by indexing one with the other, starting from the
+        highest scale mapped before, and every composed map is cached so that mapping all scales takes a single
+        pass per scale.
 
         :param scalenumber: scale of desired mapping
-        :return: dictionary of mappings, keys are enumerated and values are respective representative landmarks
+        :return: int32 array with the representative landmark of every data point, to be treated as read-only
         """
         if scalenumber <= 0:
             raise ValueError("Can't generate mapping for complete dataset, only scales get clustered")
-        if scalenumber > self.num_scales:
+        if scalenumber >= self.num_scales:
             raise ValueError("Scale doesn't exist, object has %i scales" % self.num_scales)
-        maps = None
-        for scale in self.scales[1:scalenumber + 1]:  # Don't include datascale
-            if maps is None:
-                maps = dict.fromkeys(range(self.get_topscale().size))
-                for idx, value in enumerate(scale.best_representatives):
-                    maps[idx] = value
-            else:
-                for key in maps:
-                    maps[key] = scale.best_representatives[maps[key]]
-        return maps
+        if scalenumber not in self._datascale_maps:
+            start = max([num for num in self._datascale_maps if num < scalenumber], default=0)
+            maps = self._datascale_maps.get(start)
+            for num in range(start + 1, scalenumber + 1):  # Don't include datascale
+                representatives = _np.asarray(self[num].best_representatives, dtype=_np.int32)
+                maps = representatives if maps is None else representatives[maps]
+                self._datascale_maps[num] = maps
+        return self._datascale_maps[scalenumber]
 
     def get_map_by_cluster(self, scalenumber, clustering):
         """
         Maps a given cluster at a given scale.
+        At every scale the labels are encoded once as a one-hot indicator matrix, so that a single product with the
+        area of influence gives the influence of every cluster on every point of the previous scale.
 
         :param scalenumber: scale to create map at
         :param clustering: membership results of clustering
         :return: map between data and cluster assignment
         """
-        if len(clustering) != self.scales[scalenumber].area_of_influence.shape[1]:
+        if len(clustering) != self[scalenumber].area_of_influence.shape[1]:
             raise ValueError("Number of labels does not match number of landmarks in scale")
         if scalenumber <= 0:
             raise ValueError("Can't generate mapping for complete dataset, only scales get clustered")
-        for scale in self.scales[scalenumber:0:-1]:  # Don't include datascale
-            new_aoi = lil_matrix((scale.area_of_influence.shape[0],
-                                  len(set(clustering))))
-            for i, label in enumerate(_np.unique(clustering)):
-                new_aoi[:, i] = scale.area_of_influence * [[1] if label == x else [0] for x in clustering]
-            clustering = csc_matrix(new_aoi).argmax(axis=1).A1
+        for scale in self[scalenumber:0:-1]:  # Don't include datascale
+            clustering = _influence_step(scale, clustering)
         return clustering
 
-    def cluster_scale(self, scalenumber, prop_method='cluster'):
+    def project_membership(self, scalenumber, membership, target_scale):
+        """
+        Projects the membership of the landmarks of a scale down to the landmarks of a finer scale. Every landmark
+        gets the cluster with the largest area of influence on it, one scale at a time as in get_map_by_cluster.
+        The cluster ids of membership are kept.
+
+        :param scalenumber: scale of membership
+        :param membership: cluster of every landmark of the scale
+        :param target_scale: finer scale, below scalenumber
+        :return: np.ndarray with the cluster of every landmark of target_scale
+        """
+        if not 0 <= target_scale < scalenumber < self.num_scales:
+            raise ValueError("Memberships can only be projected to a finer scale of the hierarchy")
+        membership = _np.asarray(membership)
+        if len(membership) != self.scale_size(scalenumber):
+            raise ValueError("Number of labels does not match number of landmarks in scale")
+        for num in range(scalenumber, target_scale, -1):
+            membership = _np.unique(membership)[_influence_step(self[num], membership)]
+        return membership
+
+    def cluster_scale(self, scalenumber, prop_method='cluster', symmetrize=False, seed=None, initial_membership=None,
+                      resolution=None):
         """
         Clusters data using the Leiden algorithm on a given scale.
 
         :param scalenumber: scale that clustering should be applied to
         :param prop_method: label or cluster. Cluster returns cluster labels and label labels data scale mapping.
+        :param symmetrize: cluster the undirected graph in which the weights of (i, j) and (j, i) are summed
+        :param seed: seed of the Leiden algorithm, random if None
+        :param initial_membership: membership of the landmarks the Leiden algorithm starts from, see run_louvain
+        :param resolution: resolution of the RBConfigurationVertexPartition, modularity if None
         :return: Clustering results. Either label or cluster.
         """
         if scalenumber == 0:
             warnings.warn("Warning: You are about to cluster the full dataset, this might take a very long time")
-            return self.run_louvain(scalenumber)
+            return self.run_louvain(scalenumber, symmetrize=symmetrize, seed=seed,
+                                    initial_membership=initial_membership, resolution=resolution)
         elif scalenumber >= self.num_scales:
             raise ValueError("Scale doesn't exist, object has %i scales" % self.num_scales)
+        if prop_method not in ('cluster', 'label'):
+            raise ValueError("Invalid method, options are 'label' or 'cluster'")
+        membership = self.run_louvain(scalenumber, symmetrize=symmetrize, seed=seed,
+                                      initial_membership=initial_membership, resolution=resolution)
+        return self._propagate(scalenumber, membership, prop_method)
+
+    def cluster_scales(self, scalenumbers=None, prop_method='cluster', symmetrize=False, seed=None, n_jobs=1,
+                       warm_start=False, resolution=None):
+        """
+        Clusters data on several scales, optionally in parallel worker processes.
+        Every scale gets its own seed derived from seed, so the results do not depend on n_jobs or scheduling.
+        With warm_start the scales are clustered one after the other from the coarsest down, and the Leiden
+        algorithm starts on every scale from the membership of the coarser scale clustered before it, projected
+        with project_membership, instead of from singletons. n_jobs is then ignored.
+
+        :param scalenumbers: scales that clustering should be applied to, all subscales if None
+        :param prop_method: label or cluster. Cluster returns cluster labels and label labels data scale mapping.
+        :param symmetrize: cluster the undirected graph in which the weights of (i, j) and (j, i) are summed
+        :param seed: base seed of the Leiden algorithm, random if None
+        :param n_jobs: number of worker processes, -1 uses all cores
+        :param warm_start: seed every scale with the projected membership of the next coarser one
+        :param resolution: resolution of the RBConfigurationVertexPartition, modularity if None
+        :return: list of clustering results in the order of scalenumbers
+        """
+        check_n_jobs(n_jobs)
+        if scalenumbers is None:
+            scalenumbers = range(1, self.num_scales)
+        scalenumbers = list(scalenumbers)
+        seeds = [_scale_seed(seed, scalenumber) for scalenumber in scalenumbers]
+        if warm_start:
+            return self._cluster_scales_warm(scalenumbers, prop_method, symmetrize, seeds, resolution)
+        if n_jobs == -1:
+            n_jobs = os.cpu_count() or 1
+        if n_jobs == 1 or len(scalenumbers) < 2:
+            return [self.cluster_scale(scalenumber, prop_method=prop_method, symmetrize=symmetrize, seed=scale_seed,
+                                       resolution=resolution)
+                    for scalenumber, scale_seed in zip(scalenumbers, seeds)]
+        # Imported here, the workers rebuild HSNE objects and import this module themselves
+        from schnel.clustering.parallel import cluster_scales_in_processes
+        return cluster_scales_in_processes(self, scalenumbers, prop_method, symmetrize, seeds,
+                                           min(n_jobs, len(scalenumbers)), resolution)
+
+    def _cluster_scales_warm(self, scalenumbers, prop_method, symmetrize, seeds, resolution):
+        """
+        Clusters the scales from the coarsest down, starting every scale from the projected membership of the
+        scale clustered before it, see cluster_scales.
+
+        :return: list of clustering results in the order of scalenumbers
+        """
+        if prop_method not in ('cluster', 'label'):
+            raise ValueError("Invalid method, options are 'label' or 'cluster'")
+        results = [None] * len(scalenumbers)
+        coarser = membership = None
+        for pos in sorted(range(len(scalenumbers)), key=lambda pos: scalenumbers[pos], reverse=True):
+            scalenumber = scalenumbers[pos]
+            if scalenumber >= self.num_scales:
+                raise ValueError("Scale doesn't exist, object has %i scales" % self.num_scales)
+            initial = None
+            if coarser is not None and coarser > scalenumber:
+                initial = self.project_membership(coarser, membership, scalenumber)
+            elif coarser == scalenumber:
+                initial = membership
+            membership = self.run_louvain(scalenumber, symmetrize=symmetrize, seed=seeds[pos],
+                                          initial_membership=initial, resolution=resolution)
+            coarser = scalenumber
+            if scalenumber == 0:
+                warnings.warn("Warning: You are about to cluster the full dataset, this might take a very long time")
+                results[pos] = membership
+            else:
+                results[pos] = self._propagate(scalenumber, membership, prop_method)
+        return results
+
+    def resolution_sweep(self, scalenumber, resolutions, prop_method='cluster', symmetrize=False, seed=None,
+                         initial_membership=None):
+        """
+        Clusters a scale with the RBConfigurationVertexPartition at several resolutions. The Leiden algorithm
+        starts at every resolution from the partition found at the one before, the first resolution from
+        initial_membership or singletons.
+
+        :param scalenumber: subscale to cluster
+        :param resolutions: resolution parameters in the order they are run, e.g. ascending
+        :param prop_method: label or cluster, see cluster_scale. None returns the memberships of the landmarks
+        :param symmetrize: cluster the undirected graph in which the weights of (i, j) and (j, i) are summed
+        :param seed: seed of the Leiden algorithm, random if None
+        :param initial_membership: membership of the landmarks the first resolution starts from
+        :return: list of clustering results, one per resolution
+        """
+        if not 0 < scalenumber < self.num_scales:
+            raise ValueError("Scale doesn't exist or isn't a subscale, object has %i scales" % self.num_scales)
+        if prop_method not in ('cluster', 'label', None):
+            raise ValueError("Invalid method, options are 'label', 'cluster' or None")
+        results = []
+        membership = initial_membership
+        for resolution in resolutions:
+            membership = self.run_louvain(scalenumber, symmetrize=symmetrize, seed=seed,
+                                          initial_membership=membership, resolution=resolution)
+            results.append(_np.asarray(membership) if prop_method is None
+                           else self._propagate(scalenumber, membership, prop_method))
+        return results
+
+    def _propagate(self, scalenumber, membership, prop_method):
+        """
+        Labels of the data points from the membership of the landmarks of a subscale.
+
+        :param scalenumber: subscale of membership
+        :param membership: cluster of every landmark
+        :param prop_method: 'cluster' (get_map_by_cluster) or 'label' (get_datascale_mappings)
+        :return: label of every data point
+        """
         if prop_method == 'cluster':
-            membership = self.run_louvain(scalenumber)
             return self.get_map_by_cluster(scalenumber, membership)
-        elif prop_method == 'label':
-            membership = self.run_louvain(scalenumber)
-            mapping = self.get_datascale_mappings(scalenumber)
-            return _np.asarray(membership)[list(mapping.values())]
+        return _np.asarray(membership)[self.get_datascale_mappings(scalenumber)]
 
+    def get_graph(self, scalenumber, symmetrize=False):
+        """
+        Weighted igraph Graph of the transition matrix of a given scale.
+        The graph is built once per scale and construction option and cached on the scale.
 
-        else:
-            raise ValueError("Invalid method, options are 'label' or 'cluster'")
+        :param scalenumber: scale of the graph
+        :param symmetrize: sum the weights of (i, j) and (j, i) into a single undirected edge
+        :return: igraph.Graph with edge attribute 'weight'
+        """
+        scale = self[scalenumber]
+        if symmetrize not in scale.graphs:
+            scale.graphs[symmetrize] = _tmatrix_to_graph(scale.tmatrix, symmetrize)
+        return scale.graphs[symmetrize]
 
-    def run_louvain(self, scalenumber):
+    def run_louvain(self, scalenumber, symmetrize=False, seed=None, initial_membership=None, resolution=None):
         """
         Runs the Leiden algorithm on a given scale.
 
         :param scalenumber: scale to cluster on
+        :param symmetrize: cluster the undirected graph in which the weights of (i, j) and (j, i) are summed
+        :param seed: seed of the Leiden algorithm, random if None
+        :param initial_membership: cluster of every landmark the algorithm starts from, e.g. the membership of a
+            coarser scale projected with project_membership, singletons if None
+        :param resolution: resolution parameter of the RBConfigurationVertexPartition, the
+            ModularityVertexPartition is optimized if None
         :return: membership of data
         """
-        sources, targets = self.scales[scalenumber].tmatrix.nonzero()
-        edgelist = list(zip(sources.tolist(), targets.tolist()))
-        G = ig.Graph(edgelist)
-        G.es['weight'] = self.scales[scalenumber].tmatrix.data
-        return leidenalg.find_partition(G, leidenalg.ModularityVertexPartition, weights=G.es['weight']).membership
+        import leidenalg
+        G = self.get_graph(scalenumber, symmetrize=symmetrize)
+        if initial_membership is not None:
+            # leidenalg expects consecutive community ids starting at 0
+            initial_membership = _np.unique(initial_membership, return_inverse=True)[1].ravel().tolist()
+            if len(initial_membership) != G.vcount():
+                raise ValueError("Number of labels does not match number of landmarks in scale")
+        if resolution is None:
+            return leidenalg.find_partition(G, leidenalg.ModularityVertexPartition, weights='weight', seed=seed,
+                                            initial_membership=initial_membership).membership
+        return leidenalg.find_partition(G, leidenalg.RBConfigurationVertexPartition, weights='weight', seed=seed,
+                                        initial_membership=initial_membership,
+                                        resolution_parameter=resolution).membership
+
+
+def check_n_jobs(n_jobs):
+    """
+    Checks a number of worker processes. Like in scikit-learn, -1 stands for all cores; the number of threads of
+    the hierarchy computation instead uses 0 for all cores, following OpenMP.
+
+    :param n_jobs: number of worker processes
+    :return: None, raises a ValueError unless n_jobs is -1 or positive
+    """
+    if n_jobs != -1 and n_jobs < 1:
+        raise ValueError("n_jobs must be a positive number of worker processes or -1 for all cores, got %s" % n_jobs)
+
+
+def _scale_seed(seed, scalenumber):
+    """
+    Seed of the Leiden algorithm for a single scale.
+
+    :param seed: base seed, None for a random seed
+    :param scalenumber: scale to cluster on
+    :return: int or None
+    """
+    if seed is None:
+        return None
+    return seed + scalenumber
+
+
+def _influence_step(scale, clustering):
+    """
+    Clusters of the points of the previous scale with the largest area of influence of the landmarks of scale.
+    The labels are encoded once as a one-hot indicator matrix, so that a single product with the area of influence
+    gives the influence of every cluster on every point.
+
+    :param scale: subscale
+    :param clustering: cluster of every landmark of scale
+    :return: np.ndarray with the index into the sorted unique labels of clustering for every point of the
+        previous scale
+    """
+    labels, label_idx = _np.unique(clustering, return_inverse=True)
+    num_landmarks = len(label_idx)
+    indicator = csr_matrix((_np.ones(num_landmarks), label_idx.ravel(), _np.arange(num_landmarks + 1)),
+                           shape=(num_landmarks, len(labels)))
+    return _argmax_rows(scale.area_of_influence @ indicator)
+
+
+def _tmatrix_to_graph(tmatrix, symmetrize=False):
+    """
+    Build an igraph Graph from a sparse transition matrix.
+    Edges are passed to igraph as one contiguous (edges x 2) integer array, with weights taken from the same
+    entries so that both stay aligned. Entries with zero weight are not turned into edges.
+
+    :param tmatrix: scipy sparse transition matrix
+    :param symmetrize: sum the weights of (i, j) and (j, i) into a single undirected edge
+    :return: igraph.Graph with edge attribute 'weight'
+    """
+    import igraph as ig
+    tmatrix = tmatrix.tocsr(copy=True)
+    tmatrix.sum_duplicates()
+    if symmetrize:
+        tmatrix = (tmatrix + tmatrix.T).tocsr()
+        tmatrix.sum_duplicates()
+    tmatrix.eliminate_zeros()
+    tmatrix = tmatrix.tocoo(copy=False)
+    if symmetrize:
+        upper = tmatrix.row <= tmatrix.col
+        sources, targets, weights = tmatrix.row[upper], tmatrix.col[upper], tmatrix.data[upper]
+    else:
+        sources, targets, weights = tmatrix.row, tmatrix.col, tmatrix.data
+    edges = _np.empty((len(sources), 2), dtype=_np.int64)
+    edges[:, 0] = sources
+    edges[:, 1] = targets
+    return ig.Graph(n=tmatrix.shape[0], edges=edges, edge_attrs={'weight': weights.astype(_np.float64)})
+
+
+def _argmax_rows(matrix):
+    """
+    Column index of the largest entry of every row of a non-negative sparse matrix.
+    Equivalent to matrix.argmax(axis=1).A1, ties resolve to the lowest column and empty rows to 0,
+    but without a Python loop over the rows.
+
+    :param matrix: scipy sparse matrix with non-negative entries
+    :return: np.ndarray with a column index per row
+    """
+    matrix = csr_matrix(matrix)
+    if not matrix.has_canonical_format or not matrix.data.all():
+        matrix = matrix.copy()
+        matrix.sum_duplicates()
+        matrix.eliminate_zeros()
+    result = _np.zeros(matrix.shape[0], dtype=_np.int64)
+    starts = matrix.indptr[:-1]
+    row_lengths = _np.diff(matrix.indptr)
+    nonempty = row_lengths > 0
+    if not nonempty.any():
+        return result
+    row_max = _np.maximum.reduceat(matrix.data, starts[nonempty])
+    is_max = matrix.data == _np.repeat(row_max, row_lengths[nonempty])
+    max_pos = _np.flatnonzero(is_max)
+    rows = _np.repeat(_np.arange(matrix.shape[0]), row_lengths)[max_pos]
+    # Indices are sorted within rows, so the first maximum of a row has the lowest column
+    first = _np.flatnonzero(_np.r_[True, rows[1:] != rows[:-1]])
+    result[rows[first]] = matrix.indices[max_pos[first]]
+    return result
 
 
 class DataScale:
+    __slots__ = ('tmatrix', 'size', 'datapoints', 'scalenum', 'num_scales', 'graphs')
+
     def __init__(self, num_scales, tmatrix=None):
         """
         Initialization function for DataScale class.
@@ -139,9 +454,11 @@ class DataScale:
         """
         self.tmatrix = tmatrix
         self.size = tmatrix.shape[0]
-        self.datapoints = [idx for idx in range(self.size)]
+        self.datapoints = range(self.size)
         self.scalenum = 0
         self.num_scales = num_scales
+        # igraph Graphs of the transition matrix, keyed by construction options
+        self.graphs = {}
 
     def __str__(self):
         return "HSNE datascale %i with %i datapoints" % (self.scalenum, self.size)
@@ -151,6 +468,9 @@ class DataScale:
 
 
 class SubScale:
+    __slots__ = ('tmatrix', 'size', 'datapoints', 'scalenum', 'num_scales', 'graphs', 'lm_to_original',
+                 'lm_to_previous', 'lm_weights', 'previous_to_current', 'area_of_influence', 'best_representatives')
+
     def __init__(self, scalenum, num_scales, tmatrix,
                  lm_to_original, lm_to_previous, lm_weights, previous_to_current, area_of_influence):
         """
@@ -164,32 +484,35 @@ class SubScale:
         :param lm_weights: landmark weights
         :param previous_to_current: previous landmarks to current landmarks
         :param area_of_influence: area of influence
+        The landmark vectors are kept as int32 and float32 arrays, without a copy if they already are.
         """
         # The transition matrix / graph
         self.tmatrix = tmatrix
         # Number of landmarks in scale
         self.size = tmatrix.shape[0]
-        self.datapoints = [idx for idx in range(self.size)]
+        self.datapoints = range(self.size)
         # Scalenumber
         self.scalenum = scalenum
         # NUmber of scales in hierarchy
         self.num_scales = num_scales
+        # igraph Graphs of the transition matrix, keyed by construction options
+        self.graphs = {}
         # Which landmark is which original datapoint
-        self.lm_to_original = lm_to_original
+        self.lm_to_original = _np.asarray(lm_to_original, dtype=_np.int32)
         # Which landmark is which datapoint in the previous scale (reduntant
         # with lm_to_original on scale 1.
-        self.lm_to_previous = lm_to_previous
+        self.lm_to_previous = _np.asarray(lm_to_previous, dtype=_np.int32)
         # LM Weights is equal to the sum of AOI columns
-        self.lm_weights = lm_weights
+        self.lm_weights = _np.asarray(lm_weights, dtype=_np.float32)
         # Which landmark on previous scale is landmark on current scale
-        self.previous_to_current = previous_to_current
+        self.previous_to_current = _np.asarray(previous_to_current, dtype=_np.int32)
         # Comes in as S x S where all columns > S-1 are 0's
         # Cast to csc to efficiently slice all columns outside range S-1
         self.area_of_influence = csc_matrix(area_of_influence)[:, :self.size]
         # The best representative landmark in scale S  for each point in scale S-1 is
         # the node that was visited most often e.g. has the highest value in its row
         # in area_of_influence.
-        self.best_representatives = self.area_of_influence.argmax(axis=1).A1
+        self.best_representatives = _argmax_rows(self.area_of_influence).astype(_np.int32)
 
     def __str__(self):
         return "HSNE subscale %i with %i datapoints" % (self.scalenum, self.size)
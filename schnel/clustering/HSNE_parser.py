@@ -1,86 +1,400 @@
 # Functions for reading HSNE hierarchy
+import functools
+import mmap
+import os
 import struct
-import time
-from scipy.sparse import coo_matrix
+import numpy as _np
+from scipy.sparse import csr_matrix
 from schnel.clustering.HSNE import HSNE, DataScale, SubScale
 
+# Sparse rows are stored as interleaved (column, weight) pairs
+_ENTRY_DTYPE = _np.dtype([('col', '<i4'), ('weight', '<f4')])
+# Files of major version 2 start with a table of the byte offsets of the scales, which hold blocks of CSR arrays
+# and landmark vectors, see saveHSNEv2 in hdi/hierarchical_sne_inl.h
+_V2_MAJOR = 2
+_V2_TABLE_ENTRY = struct.Struct('<QQQ')
+
+
+class _MapCursor:
+    """
+    Read position in a memory mapped file, with the read, seek and tell methods of a file handle. The mapping itself
+    is only accessed at absolute offsets and every scale is read through a cursor of its own, so that the scales of
+    a hierarchy can be loaded from several threads at once.
+    """
+    __slots__ = ('buffer', 'position')
+
+    def __init__(self, buffer, position=0):
+        self.buffer = buffer
+        self.position = position
+
+    def __len__(self):
+        return len(self.buffer)
+
+    def read(self, size):
+        data = self.buffer[self.position:self.position + size]
+        self.position += len(data)
+        return data
+
+    def seek(self, offset, whence=os.SEEK_SET):
+        self.position = self.position + offset if whence == os.SEEK_CUR else offset
+
+    def tell(self):
+        return self.position
+
+
+def _read_array(handle, dtype, count):
+    """
+    Read count elements of dtype from the current position of handle and advance past them.
+    Memory mapped files are not copied, the returned array is a read-only view of the mapping.
+
+    :param handle: _MapCursor or seekable binary file handle
+    :param dtype: numpy dtype of the elements
+    :param count: number of elements
+    :return: np.ndarray
+    """
+    dtype = _np.dtype(dtype)
+    if isinstance(handle, _MapCursor):
+        vector = _np.frombuffer(handle.buffer, dtype=dtype, count=count, offset=handle.position)
+        handle.position += vector.nbytes
+        return vector
+    return _np.frombuffer(handle.read(dtype.itemsize * count), dtype=dtype, count=count)
+
 
 def read_uint_vector(handle):
     """
     Read unsigned int vector from HDI binary file.
 
-    :param handle: _io.BufferedReader (object result from calling native Python open() )
-    :return: list
+    :param handle: _MapCursor or seekable binary file handle
+    :return: np.ndarray of int32
     """
     vectorlength = struct.unpack('i', handle.read(4))[0]
-    vector = list(struct.unpack('i' * vectorlength, handle.read(4 * vectorlength)))
-    return vector
+    return _read_array(handle, '<i4', vectorlength)
 
 
 def read_scalar_vector(handle):
     """
     Read float vector from HDI binary file.
 
-    :param handle: _io.BufferedReader (object result from calling native Python open() )
-    :return: list
+    :param handle: _MapCursor or seekable binary file handle
+    :return: np.ndarray of float32
     """
     vectorlength = struct.unpack('i', handle.read(4))[0]
-    vector = list(struct.unpack('f' * vectorlength, handle.read(4 * vectorlength)))
-    return vector
+    return _read_array(handle, '<f4', vectorlength)
 
 
-def read_HSNE_binary(filename, verbose=True):
+def read_HSNE_binary(filename, verbose=True, lazy=True):
     """
     Read a HSNE binary from a file and construct a HSNE object with top- and sub-scales.
+    Both the original (v0) and the compact (v2) format are supported. The file is memory mapped and, unless lazy is
+    false, a scale is only parsed when it is first accessed, so that e.g. the data scale, the largest part of the
+    file, is never read when only subscales are clustered. Loaded scales are released with HSNE.unload, and the
+    file with HSNE.close or by using the hierarchy as a context manager.
 
     :param filename: str, file to read
     :param verbose: bool, controls verbosity of parser
-    :return: HSNE object
+    :param lazy: bool, load scales on first access instead of all at once
+    :return: HSNE object, raises a ValueError if the file is truncated or corrupt, also when a lazily loaded scale
+        is accessed
     """
     logger = Logger(verbose)
-    longtic = time.time()
-    with open(filename, 'rb') as handle:
-        _, _ = struct.unpack('ff', handle.read(8))  # Never used
-        numscales = int(struct.unpack('f', handle.read(4))[0])
-        scalesize = int(struct.unpack('f', handle.read(4))[0])
-        # logger.log("Number of scales %i" % numscales)
-        hierarchy = HSNE(numscales)
-        # logger.log("Start reading first scale of size %i" % scalesize)
-        tmatrix = read_sparse_matrix(handle)
-        # logger.log("Done reading first scale..")
-        hierarchy[0] = DataScale(num_scales=numscales, tmatrix=tmatrix)
-        for i in range(1, numscales):
-            hierarchy[i] = build_subscale(handle, i, numscales, logger)
-        # print('Total time spent parsing hierarchy and building objects: %f' % (time.time() - longtic))
-        return hierarchy
+    buffer = None
+    try:
+        buffer = _map_file(filename)
+        handle = _MapCursor(buffer)
+        major, _ = struct.unpack('ff', handle.read(8))
+        if int(major) == _V2_MAJOR:
+            table = read_scale_table(handle)
+            if any(offset + num_bytes > len(handle) for _, offset, num_bytes in table):
+                raise ValueError("scales extend beyond the end of the file")
+            sizes = [size for size, _, _ in table]
+            loader = functools.partial(_read_scale_v2, buffer, table)
+        else:
+            offsets, sizes = _scan_scale_offsets(handle)
+            loader = functools.partial(_read_scale_v0, buffer, offsets, logger)
+    except (struct.error, ValueError, OverflowError) as error:
+        if buffer is not None:
+            _close_map(buffer)
+        raise ValueError("%s is not a valid .hsne file, it is truncated or corrupt (%s)" % (filename, error))
+    loader = functools.partial(_checked_scale, filename, loader)
+    hierarchy = HSNE(len(sizes), loader=loader, sizes=sizes, closer=functools.partial(_close_map, buffer))
+    if not lazy:
+        for i in range(len(sizes)):
+            hierarchy[i] = loader(i)
+    return hierarchy
+
+
+def _close_map(buffer):
+    # Arrays of loaded scales are views into the mapping, if there are any it is released with the last of them
+    try:
+        buffer.close()
+    except BufferError:
+        pass
+
+
+def _checked_scale(filename, loader, i):
+    """
+    Read scale i with loader, turning the errors of reading past the end of the file or of decoding corrupt data
+    into a ValueError naming the file.
+    """
+    try:
+        return loader(i)
+    except (struct.error, ValueError, OverflowError) as error:
+        raise ValueError("Scale %i of %s is truncated or corrupt (%s)" % (i, filename, error))
+
+
+def read_HSNE_scale(filename, scalenum):
+    """
+    Read a single scale of a HSNE binary. For the compact (v2) format only the bytes of that scale are read,
+    uncompressed arrays are views into the memory mapped file. In files of the original format the scale is found
+    by skipping over the preceding ones.
+
+    :param filename: str, file to read
+    :param scalenum: number of the scale, 0 for the data scale
+    :return: DataScale or SubScale
+    """
+    return read_HSNE_binary(filename, verbose=False)[scalenum]
+
+
+def read_scale_table(handle):
+    """
+    Read the scale table of a v2 HSNE binary, the handle has to be positioned after the version.
+
+    :param handle: _MapCursor or seekable binary file handle
+    :return: list of (size, byte offset, number of bytes) per scale
+    """
+    _, numscales = struct.unpack('<QQ', handle.read(16))
+    table = handle.read(_V2_TABLE_ENTRY.size * numscales)
+    return list(_V2_TABLE_ENTRY.iter_unpack(table))
+
+
+def _map_file(filename):
+    # The mapping stays valid after the file is closed, vectors of the hierarchy are views into it
+    with open(filename, 'rb') as fileobj:
+        return mmap.mmap(fileobj.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def _scan_scale_offsets(handle):
+    """
+    Find the byte offsets of the scales of a v0 HSNE binary by skipping over their contents,
+    the handle has to be positioned after the version.
+
+    :param handle: _MapCursor or seekable binary file handle
+    :return: (list of byte offsets, list of the number of points) per scale
+    """
+    numscales = int(struct.unpack('f', handle.read(4))[0])
+    if numscales < 1:
+        raise ValueError("invalid number of scales %i" % numscales)
+    offsets = []
+    sizes = []
+    for i in range(numscales):
+        offsets.append(handle.tell())
+        handle.seek(4, os.SEEK_CUR)  # Scale size as float, the number of rows of the transition matrix is exact
+        sizes.append(_skip_sparse_matrix(handle))
+        if i > 0:
+            # Landmarks to original data, to previous scale, landmark weights and previous to current scale
+            for _ in range(4):
+                vectorlength = struct.unpack('i', handle.read(4))[0]
+                handle.seek(4 * vectorlength, os.SEEK_CUR)
+            _skip_sparse_matrix(handle)
+    return offsets, sizes
+
+
+def _skip_sparse_matrix(handle):
+    """
+    Advance the handle past a sparse matrix of a v0 HSNE binary.
+
+    :param handle: _MapCursor or seekable binary file handle
+    :return: number of rows of the matrix
+    """
+    numrows = struct.unpack('i', handle.read(4))[0]
+    rowlens = _scan_row_lengths(handle, numrows)
+    handle.seek(4 * numrows + 8 * int(rowlens.sum()), os.SEEK_CUR)
+    return numrows
+
+
+def _read_scale_v0(buffer, offsets, logger, i):
+    """
+    Read scale i of a v0 HSNE binary.
+
+    :param buffer: memory mapped file
+    :param offsets: byte offsets of the scales, see _scan_scale_offsets
+    :param logger: Logger object
+    :param i: number of the scale
+    :return: DataScale or SubScale
+    """
+    handle = _MapCursor(buffer, offsets[i])
+    if i == 0:
+        handle.seek(4, os.SEEK_CUR)
+        return DataScale(num_scales=len(offsets), tmatrix=read_sparse_matrix(handle))
+    return build_subscale(handle, i, len(offsets), logger)
+
+
+def _read_block(handle, dtype):
+    """
+    Read a block of a v2 HSNE binary: uint64 number of bytes, uint64 number of stored bytes and the data, LZ4
+    compressed if it is stored in fewer bytes, padded to a multiple of 8 bytes.
+
+    :param handle: _MapCursor or seekable binary file handle
+    :param dtype: numpy dtype of the elements
+    :return: np.ndarray
+    """
+    dtype = _np.dtype(dtype)
+    num_bytes, num_stored = struct.unpack('<QQ', handle.read(16))
+    if num_stored < num_bytes:
+        try:
+            import lz4.block  #pylint: disable=import-outside-toplevel
+        except ImportError:
+            raise ImportError("Reading compressed .hsne files requires the lz4 package")
+        try:
+            raw = lz4.block.decompress(handle.read(num_stored), uncompressed_size=num_bytes)
+        except lz4.block.LZ4BlockError as error:
+            raise ValueError("corrupt LZ4 block (%s)" % error)
+        vector = _np.frombuffer(raw, dtype=dtype)
+    else:
+        vector = _read_array(handle, dtype, num_bytes // dtype.itemsize)
+    handle.seek((8 - num_stored % 8) % 8, os.SEEK_CUR)
+    return vector
+
+
+def _read_csr_block(handle):
+    """
+    Read a sparse matrix of a v2 HSNE binary, stored as blocks of row pointers, column indices and weights.
+
+    :param handle: _MapCursor or seekable binary file handle
+    :return: scipy.sparse.csr_matrix
+    """
+    indptr = _read_block(handle, '<i8')
+    indices = _read_block(handle, '<i4')
+    weights = _read_block(handle, '<f4')
+    shape = len(indptr) - 1
+    return csr_matrix((weights, indices, indptr), shape=(shape, shape))
+
+
+def _read_scale_v2(buffer, table, i):
+    """
+    Read scale i of a v2 HSNE binary.
+
+    :param buffer: memory mapped file
+    :param table: scale table, see read_scale_table
+    :param i: number of the scale
+    :return: DataScale or SubScale
+    """
+    numscales = len(table)
+    handle = _MapCursor(buffer, table[i][1])
+    tmatrix = _read_csr_block(handle)
+    if i == 0:
+        return DataScale(num_scales=numscales, tmatrix=tmatrix)
+    return SubScale(scalenum=i,
+                    num_scales=numscales,
+                    tmatrix=tmatrix,
+                    lm_to_original=_read_block(handle, '<i4'),
+                    lm_to_previous=_read_block(handle, '<i4'),
+                    lm_weights=_read_block(handle, '<f4'),
+                    previous_to_current=_read_block(handle, '<i4'),
+                    area_of_influence=_read_csr_block(handle)
+                    )
+
+
+def _scan_row_lengths(handle, numrows):
+    """
+    Walk the row headers of a sparse matrix block and return the number of entries of every row.
+    The handle is left at the start of the block.
+
+    :param handle: _MapCursor or seekable binary file handle, positioned at the first row header
+    :param numrows: number of rows in the block
+    :return: np.ndarray of int64
+    """
+    start = handle.tell()
+    if numrows == 0:
+        return _np.zeros(0, dtype=_np.int64)
+    if isinstance(handle, _MapCursor):
+        # Rows of the kNN based data scale usually all have the same length, which can be verified
+        # without visiting every header from Python
+        rowlen = struct.unpack('i', handle.read(4))[0]
+        handle.seek(start)
+        stride = 1 + 2 * rowlen
+        if start + 4 * numrows * stride <= len(handle):
+            words = _read_array(handle, '<i4', numrows * stride)
+            handle.seek(start)
+            if (words[::stride] == rowlen).all():
+                return _np.full(numrows, rowlen, dtype=_np.int64)
+    rowlens = _np.empty(numrows, dtype=_np.int64)
+    for rownum in range(numrows):
+        rowlen = struct.unpack('i', handle.read(4))[0]
+        rowlens[rownum] = rowlen
+        handle.seek(8 * rowlen, os.SEEK_CUR)
+    handle.seek(start)
+    return rowlens
 
 
 def read_sparse_matrix(handle):
     """
     Read sparse matrix function.
+    Row lengths are scanned first, after which all (column, weight) pairs are decoded at once into CSR arrays.
 
-    :param handle: _io.BufferedReader (object result from calling native Python open() )
-    :return: matrix
+    :param handle: _MapCursor or seekable binary file handle
+    :return: scipy.sparse.csr_matrix
     """
-    cols = []
-    rows = []
-    weights = []
     numrows = struct.unpack('i', handle.read(4))[0]
     shape = numrows
-    for rownum in range(numrows):
-        rowlen = struct.unpack('i', handle.read(4))[0]
-        row = list(struct.unpack("if" * rowlen, handle.read(8 * rowlen)))
-        cols += row[::2]
-        weights += row[1::2]
-        rows += [rownum] * rowlen
-    return coo_matrix((weights, (rows, cols)), shape=(shape, shape))
+    rowlens = _scan_row_lengths(handle, numrows)
+    indptr = _np.zeros(numrows + 1, dtype=_np.int64)
+    _np.cumsum(rowlens, out=indptr[1:])
+    numwords = numrows + 2 * int(indptr[-1])
+    block = _read_array(handle, '<i4', numwords)
+    is_entry = _np.ones(numwords, dtype=bool)
+    is_entry[_np.arange(numrows) + 2 * indptr[:-1]] = False
+    entries = block[is_entry].view(_ENTRY_DTYPE)
+    indices = _np.ascontiguousarray(entries['col'])
+    weights = _np.ascontiguousarray(entries['weight'])
+    return csr_matrix((weights, indices, indptr), shape=(shape, shape))
+
+
+def read_HSNE_buffers(scales):
+    """
+    Construct a HSNE object with top- and sub-scales from the buffers returned by numpy_to_hsne.compute.
+    The arrays are owned by the C++ side and are used without copying them.
+
+    :param scales: list of dicts, one per scale, with CSR arrays of the sparse matrices and the landmark vectors
+    :return: HSNE object
+    """
+    numscales = len(scales)
+    hierarchy = HSNE(numscales)
+    hierarchy[0] = DataScale(num_scales=numscales, tmatrix=_buffers_to_csr(scales[0], 'tmatrix'))
+    for i in range(1, numscales):
+        scale = scales[i]
+        hierarchy[i] = SubScale(scalenum=i,
+                                num_scales=numscales,
+                                tmatrix=_buffers_to_csr(scale, 'tmatrix'),
+                                lm_to_original=scale['lm_to_original'].view(_np.int32),
+                                lm_to_previous=scale['lm_to_previous'].view(_np.int32),
+                                lm_weights=scale['lm_weights'],
+                                previous_to_current=scale['previous_to_current'],
+                                area_of_influence=_buffers_to_csr(scale, 'area_of_influence')
+                                )
+    if 'statistics' in scales[0]:
+        hierarchy.statistics = [scale['statistics'] for scale in scales]
+    return hierarchy
+
+
+def _buffers_to_csr(scale, name):
+    """
+    Wrap the CSR arrays of a sparse matrix of a scale returned by numpy_to_hsne.compute.
+
+    :param scale: dict of arrays of a single scale
+    :param name: name of the matrix, 'tmatrix' or 'area_of_influence'
+    :return: scipy.sparse.csr_matrix
+    """
+    indptr = scale[name + '_indptr']
+    shape = len(indptr) - 1
+    return csr_matrix((scale[name + '_data'], scale[name + '_indices'], indptr), shape=(shape, shape))
 
 
 def build_subscale(handle, i, numscales, logger):
     """
     Build a subscale of the hierarchy.
 
-    :param handle: _io.BufferedReader (object result from calling native Python open() )
+    :param handle: _MapCursor or seekable binary file handle
     :param i: int, current scale
     :param numscales: total number of scales
     :param logger: Logger object
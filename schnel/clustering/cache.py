@@ -0,0 +1,150 @@
+import hashlib
+import os
+import tempfile
+import zipfile
+import numpy as _np
+
+CACHE_VERSION = 2
+_DEFAULT_MAX_SIZE = 8 << 30
+_HASH_CHUNK = 1 << 26
+
+
+def default_cache_dir():
+    """
+    Cache directory used when none is given: $SCHNEL_CACHE_DIR, or ~/.cache/schnel.
+
+    :return: path
+    """
+    return os.environ.get('SCHNEL_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'schnel'))
+
+
+def hierarchy_key(data, **params):
+    """
+    Content address of a hierarchy: a hash of the input matrix together with all parameters of its computation.
+
+    :param data: 2d array the hierarchy is computed on
+    :param params: parameters of the computation, e.g. num_of_scales, num_of_neighbours and seed
+    :return: hex digest
+    """
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(repr((CACHE_VERSION, data.shape, str(data.dtype), sorted(params.items()))).encode())
+    flat = _np.ascontiguousarray(data).reshape(-1)
+    step = max(_HASH_CHUNK // max(flat.itemsize, 1), 1)
+    for start in range(0, len(flat), step):
+        digest.update(memoryview(_np.ascontiguousarray(flat[start:start + step])).cast('B'))
+    return digest.hexdigest()
+
+
+class HierarchyCache:
+    """
+    Directory of computed hierarchies, stored as .npz files of the CSR buffers returned by
+    numpy_to_hsne.compute and named after their hierarchy_key. When the files exceed max_size bytes,
+    the least recently used ones are removed.
+    """
+
+    def __init__(self, directory=None, max_size=_DEFAULT_MAX_SIZE):
+        """
+        Initialize the cache.
+
+        :param directory: cache directory, created if needed, see default_cache_dir if None
+        :param max_size: maximal total size of the cached files in bytes
+        """
+        self.directory = directory if directory is not None else default_cache_dir()
+        self.max_size = max_size
+        os.makedirs(self.directory, exist_ok=True)
+
+    def path(self, key):
+        """
+        :param key: hierarchy key
+        :return: path of the cache file of key
+        """
+        return os.path.join(self.directory, key + '.npz')
+
+    def __contains__(self, key):
+        return os.path.exists(self.path(key))
+
+    def keys(self):
+        """
+        :return: keys of the cached hierarchies, most recently used first
+        """
+        entries = self._entries()
+        return [os.path.basename(path)[:-4] for _, _, path in sorted(entries, reverse=True)]
+
+    def load(self, key):
+        """
+        Read a cached hierarchy and mark it as recently used.
+
+        :param key: hierarchy key
+        :return: list of scale dicts as returned by numpy_to_hsne.compute, None if key is not cached or its file is
+            truncated or corrupt
+        """
+        path = self.path(key)
+        try:
+            with _np.load(path) as archive:
+                num_scales = int(archive['num_scales'])
+                scales = [{} for _ in range(num_scales)]
+                for name in archive.files:
+                    if name.startswith('s'):
+                        scale, field = name[1:].split('_', 1)
+                        scales[int(scale)][field] = archive[name]
+        except (OSError, EOFError, KeyError, ValueError, zipfile.BadZipFile):
+            return None
+        os.utime(path)
+        for scale in scales:
+            scale['size'] = int(scale['size'])
+        return scales
+
+    def store(self, key, scales):
+        """
+        Write a hierarchy to the cache and evict the least recently used ones beyond max_size.
+
+        :param key: hierarchy key
+        :param scales: list of scale dicts as returned by numpy_to_hsne.compute
+        """
+        arrays = {'num_scales': _np.array(len(scales))}
+        for num, scale in enumerate(scales):
+            for field, value in scale.items():
+                # the statistics describe the run that computed the hierarchy, not the hierarchy
+                if field != 'statistics':
+                    arrays['s%i_%s' % (num, field)] = _np.asarray(value)
+        handle, tmp_path = tempfile.mkstemp(suffix='.npz.tmp', dir=self.directory)
+        try:
+            with os.fdopen(handle, 'wb') as tmp_file:
+                _np.savez(tmp_file, **arrays)
+            os.replace(tmp_path, self.path(key))
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+        self.evict(keep=key)
+
+    def evict(self, keep=None):
+        """
+        Remove the least recently used hierarchies until the cache fits in max_size.
+
+        :param keep: key that is never removed
+        """
+        entries = sorted(self._entries())
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in entries:
+            if total <= self.max_size:
+                break
+            if keep is not None and path == self.path(keep):
+                continue
+            os.remove(path)
+            total -= size
+
+    def clear(self):
+        """
+        Remove all cached hierarchies.
+        """
+        for _, _, path in self._entries():
+            os.remove(path)
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.directory):
+            if name.endswith('.npz'):
+                path = os.path.join(self.directory, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
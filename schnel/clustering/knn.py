@@ -0,0 +1,241 @@
+#pylint: disable=import-error,import-outside-toplevel
+import numpy as _np
+
+KNN_METHODS = ('flann', 'exact', 'hnsw', 'nndescent')
+_BLOCK_ELEMENTS = 1 << 24
+
+
+def knn_graph(data, num_neighbours, method='exact', seed=None, num_threads=0):
+    """
+    k nearest neighbour graph of data in the layout expected by numpy_to_hsne.compute.
+
+    :param data: float32 cell by feature matrix
+    :param num_neighbours: number of neighbours per point, the point itself not included
+    :param method: 'flann' (kd-trees of the C++ code), 'exact' (blocked brute force with BLAS), 'hnsw' (requires
+        hnswlib) or 'nndescent' (requires pynndescent)
+    :param seed: seed of the approximated methods, random if None
+    :param num_threads: number of threads of the approximated methods, all cores if 0
+    :return: (indices as int32, squared euclidean distances as float32), both points by num_neighbours+1 with every
+        point as its own first neighbour
+    """
+    _check_size(data, num_neighbours)
+    if method == 'exact':
+        return exact_knn(data, num_neighbours)
+    if method == 'flann':
+        import numpy_to_hsne
+        return numpy_to_hsne.knn(data, num_neighbours, seed=seed if seed is not None else -1,
+                                 num_threads=num_threads)
+    if method == 'hnsw':
+        return _hnsw_knn(data, num_neighbours, seed, num_threads)
+    if method == 'nndescent':
+        return _nndescent_knn(data, num_neighbours, seed, num_threads)
+    raise ValueError("Unknown knn method '%s', use one of %s" % (method, ', '.join(KNN_METHODS)))
+
+
+def exact_knn(data, num_neighbours, rows=None):
+    """
+    Exact nearest neighbours by brute force. Distances are computed for blocks of query rows at once as
+    |x|^2 - 2 x.y + |y|^2, so the work is done by matrix products.
+
+    :param data: float32 cell by feature matrix
+    :param num_neighbours: number of neighbours per point, the point itself not included
+    :param rows: indices of the query points, all points if None
+    :return: (indices, squared distances) with num_neighbours+1 columns, see knn_graph
+    """
+    _check_size(data, num_neighbours)
+    data = _np.asarray(data, dtype=_np.float32)
+    rows = _np.arange(len(data)) if rows is None else _np.asarray(rows)
+    num_cols = num_neighbours + 1
+    norms = _np.einsum('ij,ij->i', data, data)
+    indices = _np.empty((len(rows), num_cols), dtype=_np.int32)
+    distances = _np.empty((len(rows), num_cols), dtype=_np.float32)
+    block = max(1, min(4096, _BLOCK_ELEMENTS // max(len(data), 1)))
+    for start in range(0, len(rows), block):
+        query = rows[start:start + block]
+        dist = _squared_distances(data[query], data, norms[query], norms)
+        # the point itself always comes first, also when it has duplicates
+        dist[_np.arange(len(query)), query] = -1
+        indices[start:start + block], distances[start:start + block] = _nearest(dist, num_cols)
+    return indices, distances
+
+
+def _check_size(data, num_neighbours):
+    """
+    Raises a ValueError unless data has more points than num_neighbours, so that every point has num_neighbours
+    other points as neighbours.
+    """
+    if len(data) <= num_neighbours:
+        raise ValueError("%i neighbours per point need more than %i points, the data has %i"
+                         % (num_neighbours, num_neighbours, len(data)))
+
+
+def _squared_distances(queries, data, query_norms, norms):
+    """
+    Squared euclidean distances between two sets of points as |x|^2 - 2 x.y + |y|^2.
+
+    :return: queries x data float32 array
+    """
+    dist = queries @ data.T
+    dist *= -2
+    dist += query_norms[:, None]
+    dist += norms[None, :]
+    return dist
+
+
+def _nearest(dist, num_cols):
+    """
+    The num_cols smallest entries of every row of a distance block, sorted.
+
+    :param dist: queries x points array of squared distances
+    :param num_cols: number of neighbours to keep
+    :return: (indices as int32, squared distances clipped at 0 as float32)
+    """
+    nearest = _np.argpartition(dist, num_cols - 1, axis=1)[:, :num_cols]
+    nearest_dist = _np.take_along_axis(dist, nearest, axis=1)
+    order = _np.argsort(nearest_dist, axis=1, kind='stable')
+    return (_np.take_along_axis(nearest, order, axis=1).astype(_np.int32),
+            _np.maximum(_np.take_along_axis(nearest_dist, order, axis=1), 0).astype(_np.float32))
+
+
+def as_knn_graph(indices, distances, num_neighbours, squared=False):
+    """
+    Brings a precomputed neighbour graph into the layout of knn_graph. Every point is made its own first neighbour,
+    whether or not it is contained in its row, and only the num_neighbours closest other points are kept.
+
+    :param indices: points by neighbours array of neighbour indices
+    :param distances: euclidean distances of the same shape
+    :param num_neighbours: number of neighbours per point, the point itself not included
+    :param squared: true if distances are already squared
+    :return: (indices, squared distances) with num_neighbours+1 columns
+    """
+    indices = _np.asarray(indices, dtype=_np.int64)
+    distances = _np.asarray(distances, dtype=_np.float64)
+    if indices.ndim != 2 or indices.shape != distances.shape:
+        raise ValueError("Neighbour indices and distances must be 2d arrays of the same shape")
+    own = _np.arange(len(indices))[:, None]
+    # drop the point from its row and put it in front with distance -1, so that it sorts first
+    distances = _np.where(indices == own, _np.inf, distances if squared else distances ** 2)
+    indices = _np.hstack([own, indices])
+    distances = _np.hstack([_np.full((len(own), 1), -1.0), distances])
+    order = _np.argsort(distances, axis=1, kind='stable')[:, :num_neighbours + 1]
+    indices = _np.take_along_axis(indices, order, axis=1)
+    distances = _np.take_along_axis(distances, order, axis=1)
+    if indices.shape[1] < num_neighbours + 1 or not _np.isfinite(distances).all():
+        raise ValueError("The precomputed graph has fewer than %i neighbours per point" % num_neighbours)
+    distances[:, 0] = 0
+    return indices.astype(_np.int32), distances.astype(_np.float32)
+
+
+def _hnsw_knn(data, num_neighbours, seed=None, num_threads=0):
+    """
+    Approximated nearest neighbours with a hierarchical navigable small world graph.
+
+    :return: (indices, squared distances), see knn_graph
+    """
+    try:
+        import hnswlib
+    except ImportError:
+        raise ImportError("The 'hnsw' knn method requires the hnswlib package")
+    index = hnswlib.Index(space='l2', dim=data.shape[1])
+    index.init_index(max_elements=len(data), ef_construction=200, M=16,
+                     random_seed=seed if seed is not None else _np.random.randint(1 << 31))
+    index.add_items(data, num_threads=num_threads if num_threads > 0 else -1)
+    index.set_ef(max(2 * (num_neighbours + 1), 50))
+    indices, distances = index.knn_query(data, k=num_neighbours + 1,
+                                         num_threads=num_threads if num_threads > 0 else -1)
+    return as_knn_graph(indices, distances, num_neighbours, squared=True)
+
+
+def _nndescent_knn(data, num_neighbours, seed=None, num_threads=0):
+    """
+    Approximated nearest neighbours with nearest neighbour descent.
+
+    :return: (indices, squared distances), see knn_graph
+    """
+    try:
+        from pynndescent import NNDescent
+    except ImportError:
+        raise ImportError("The 'nndescent' knn method requires the pynndescent package")
+    index = NNDescent(data, n_neighbors=num_neighbours + 1, random_state=seed,
+                      n_jobs=num_threads if num_threads > 0 else -1)
+    indices, distances = index.neighbor_graph
+    return as_knn_graph(indices, distances, num_neighbours)
+
+
+class KnnIndex:
+    """
+    Nearest neighbour index of a reference data set, built once and queried with new points in batches.
+    The backends are those of knn_graph; 'exact' keeps the data and its norms, the others their search structure.
+    """
+
+    def __init__(self, data, method='exact', seed=None, num_threads=0):
+        """
+        Builds the index.
+
+        :param data: float32 cell by feature matrix of the reference points
+        :param method: 'flann', 'exact', 'hnsw' or 'nndescent', see knn_graph
+        :param seed: seed of the approximated methods, random if None
+        :param num_threads: number of threads of the approximated methods, all cores if 0
+        """
+        if method not in KNN_METHODS:
+            raise ValueError("Unknown knn method '%s', use one of %s" % (method, ', '.join(KNN_METHODS)))
+        self.method = method
+        self.num_threads = num_threads
+        self.num_points = len(data)
+        if method == 'exact':
+            self._data = _np.asarray(data, dtype=_np.float32)
+            self._norms = _np.einsum('ij,ij->i', self._data, self._data)
+        elif method == 'flann':
+            import numpy_to_hsne
+            self._index = numpy_to_hsne.FlannIndex(data, seed=seed if seed is not None else -1,
+                                                   num_threads=num_threads)
+        elif method == 'hnsw':
+            try:
+                import hnswlib
+            except ImportError:
+                raise ImportError("The 'hnsw' knn method requires the hnswlib package")
+            self._index = hnswlib.Index(space='l2', dim=data.shape[1])
+            self._index.init_index(max_elements=len(data), ef_construction=200, M=16,
+                                   random_seed=seed if seed is not None else _np.random.randint(1 << 31))
+            self._index.add_items(data, num_threads=num_threads if num_threads > 0 else -1)
+        else:
+            try:
+                from pynndescent import NNDescent
+            except ImportError:
+                raise ImportError("The 'nndescent' knn method requires the pynndescent package")
+            self._index = NNDescent(data, random_state=seed, n_jobs=num_threads if num_threads > 0 else -1)
+            self._index.prepare()
+
+    def query(self, queries, num_neighbours, batch_size=1 << 16):
+        """
+        Nearest reference points of every query point.
+
+        :param queries: float32 cell by feature matrix of new points
+        :param num_neighbours: number of neighbours per query point
+        :param batch_size: number of query points searched at once
+        :return: (indices as int32, squared euclidean distances as float32), both queries by num_neighbours
+        """
+        num_cols = min(num_neighbours, self.num_points)
+        indices = _np.empty((len(queries), num_cols), dtype=_np.int32)
+        distances = _np.empty((len(queries), num_cols), dtype=_np.float32)
+        if self.method == 'exact':
+            # blocks of query rows are kept to _BLOCK_ELEMENTS distances
+            batch_size = max(1, min(batch_size, _BLOCK_ELEMENTS // max(self.num_points, 1)))
+        for start in range(0, len(queries), batch_size):
+            batch = _np.ascontiguousarray(queries[start:start + batch_size], dtype=_np.float32)
+            indices[start:start + len(batch)], distances[start:start + len(batch)] = self._query(batch, num_cols)
+        return indices, distances
+
+    def _query(self, batch, num_cols):
+        if self.method == 'exact':
+            dist = _squared_distances(batch, self._data, _np.einsum('ij,ij->i', batch, batch), self._norms)
+            return _nearest(dist, num_cols)
+        if self.method == 'flann':
+            return self._index.query(batch, num_cols)
+        if self.method == 'hnsw':
+            self._index.set_ef(max(2 * num_cols, 50))
+            indices, distances = self._index.knn_query(batch, k=num_cols,
+                                                       num_threads=self.num_threads if self.num_threads > 0 else -1)
+            return indices.astype(_np.int32), distances.astype(_np.float32)
+        indices, distances = self._index.query(batch, k=num_cols)
+        return indices.astype(_np.int32), (distances ** 2).astype(_np.float32)
@@ -0,0 +1,138 @@
+# Clustering of several scales of a HSNE hierarchy in worker processes
+import os
+import shutil
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+import numpy as _np
+from scipy.sparse import csr_matrix
+from schnel.clustering.HSNE import HSNE
+
+_CSR_PARTS = ('indptr', 'indices', 'data')
+
+
+class _SharedScale:
+    __slots__ = ('scalenum', 'size', 'graphs', 'tmatrix', 'area_of_influence', 'best_representatives')
+
+    def __init__(self, directory, scalenum, info):
+        """
+        Scale of a hierarchy backed by the memory mapped buffers written by _export_hierarchy.
+        Only holds what clustering and label propagation need.
+
+        :param directory: directory with the shared buffers
+        :param scalenum: scale number
+        :param info: dict with the size of the scale and the shapes of the exported matrices
+        """
+        self.scalenum = scalenum
+        self.size = info['size']
+        self.graphs = {}
+        if 'tmatrix' in info:
+            self.tmatrix = _load_csr(directory, 'tmatrix%i' % scalenum, info['tmatrix'])
+        if 'area_of_influence' in info:
+            self.area_of_influence = _load_csr(directory, 'aoi%i' % scalenum, info['area_of_influence'])
+            self.best_representatives = _np.load(os.path.join(directory, 'best_representatives%i.npy' % scalenum),
+                                                 mmap_mode='r')
+
+
+def _shared_directory():
+    """
+    Create a directory for the shared buffers, in memory (/dev/shm) where available.
+
+    :return: path of the directory
+    """
+    shm = '/dev/shm'
+    return tempfile.mkdtemp(prefix='schnel_', dir=shm if os.path.isdir(shm) else None)
+
+
+def _export_csr(directory, name, matrix):
+    """
+    Write the CSR arrays of a sparse matrix as .npy files.
+
+    :param directory: directory with the shared buffers
+    :param name: name of the matrix
+    :param matrix: scipy sparse matrix
+    :return: shape of the matrix
+    """
+    matrix = csr_matrix(matrix)
+    for part in _CSR_PARTS:
+        _np.save(os.path.join(directory, '%s_%s.npy' % (name, part)), getattr(matrix, part))
+    return matrix.shape
+
+
+def _load_csr(directory, name, shape):
+    """
+    Memory map the CSR arrays of a sparse matrix written by _export_csr.
+
+    :param directory: directory with the shared buffers
+    :param name: name of the matrix
+    :param shape: shape of the matrix
+    :return: scipy.sparse.csr_matrix
+    """
+    indptr, indices, data = [_np.load(os.path.join(directory, '%s_%s.npy' % (name, part)), mmap_mode='r')
+                             for part in _CSR_PARTS]
+    return csr_matrix((data, indices, indptr), shape=shape)
+
+
+def _export_hierarchy(hsne, scalenumbers, directory):
+    """
+    Write the matrices needed to cluster the given scales and propagate their labels to the data scale.
+
+    :param hsne: HSNE object
+    :param scalenumbers: scales that will be clustered
+    :param directory: directory for the shared buffers
+    :return: list with a dict of sizes and shapes per scale
+    """
+    infos = []
+    for scalenum in range(max(scalenumbers) + 1):
+        info = {'size': hsne.scale_size(scalenum)}
+        if scalenum == 0 and 0 not in scalenumbers:
+            # the data scale is only needed when it is clustered itself
+            infos.append(info)
+            continue
+        scale = hsne[scalenum]
+        if scalenum in scalenumbers:
+            info['tmatrix'] = _export_csr(directory, 'tmatrix%i' % scalenum, scale.tmatrix)
+        if scalenum > 0:
+            info['area_of_influence'] = _export_csr(directory, 'aoi%i' % scalenum, scale.area_of_influence)
+            _np.save(os.path.join(directory, 'best_representatives%i.npy' % scalenum), scale.best_representatives)
+        infos.append(info)
+    return infos
+
+
+def _cluster_scale_worker(task):
+    """
+    Cluster a single scale in a worker process.
+
+    :param task: tuple of the shared directory, scale infos, number of scales and the cluster_scale arguments
+    :return: clustering results of the scale
+    """
+    directory, infos, num_scales, scalenumber, prop_method, symmetrize, seed, resolution = task
+    hsne = HSNE(num_scales)
+    for scalenum, info in enumerate(infos):
+        hsne[scalenum] = _SharedScale(directory, scalenum, info)
+    return hsne.cluster_scale(scalenumber, prop_method=prop_method, symmetrize=symmetrize, seed=seed,
+                              resolution=resolution)
+
+
+def cluster_scales_in_processes(hsne, scalenumbers, prop_method, symmetrize, seeds, n_jobs, resolution=None):
+    """
+    Cluster several scales of a hierarchy in a process pool.
+    The sparse matrices are shared with the workers as memory mapped files instead of being pickled.
+
+    :param hsne: HSNE object
+    :param scalenumbers: scales that clustering should be applied to
+    :param prop_method: label or cluster
+    :param symmetrize: cluster the undirected graph in which the weights of (i, j) and (j, i) are summed
+    :param seeds: seed of the Leiden algorithm for every scale
+    :param n_jobs: number of worker processes
+    :param resolution: resolution of the RBConfigurationVertexPartition, modularity if None
+    :return: list of clustering results in the order of scalenumbers
+    """
+    directory = _shared_directory()
+    try:
+        infos = _export_hierarchy(hsne, scalenumbers, directory)
+        tasks = [(directory, infos, hsne.num_scales, scalenumber, prop_method, symmetrize, seed, resolution)
+                 for scalenumber, seed in zip(scalenumbers, seeds)]
+        with ProcessPoolExecutor(max_workers=n_jobs) as executor:
+            return list(executor.map(_cluster_scale_worker, tasks))
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
@@ -70,9 +70,11 @@ setup(
         "anndata==0.7.3",
         "fcsparser==0.2.1",
         "leidenalg==0.8.0",
+        "lz4>=3.0.0",
         "mlxtend==0.17.2",
         "numpy==1.18.5",
-        "scanpy==1.5.1",
+        "pandas==1.0.5",
+        "scikit-learn==0.23.1",
         "scipy==1.4.1",
         "python-igraph>=0.8.0"
     ],
@@ -80,6 +82,9 @@ setup(
     author_email="__",
     description="__",
     keywords="__ __ __",
+    entry_points={
+        "console_scripts": ["schnel=schnel.cli:main"]
+    },
     ext_modules=[CMakeExtension('py_hdi')],
     cmdclass=dict(build_ext=CMakeBuild),
 )
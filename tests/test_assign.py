@@ -0,0 +1,93 @@
+# Assignment of new points to the clusters of a fitted hierarchy, on toy hierarchies built without numpy_to_hsne
+# Run with: python -m pytest tests
+import numpy as np
+import pytest
+from scipy.sparse import csr_matrix
+from schnel.algorithm import Schnel
+from schnel.clustering.HSNE import HSNE, DataScale, SubScale
+
+NUM_LANDMARKS = 8
+
+
+def _fitted(reference, blob, landmarks, influence, labels, prop_method='cluster'):
+    """
+    Schnel estimator as left by fit, with a data scale and a single subscale.
+
+    :param reference: reference points
+    :param blob: group of every reference point, points only influence the landmarks of their group
+    :param landmarks: reference point of every landmark
+    :param influence: number of landmarks every point influences
+    :param labels: labels of the reference points on every subscale
+    """
+    rng = np.random.default_rng(1)
+    rows, cols = [], []
+    for point, group in enumerate(blob):
+        rows += [point] * influence
+        cols += rng.choice(np.flatnonzero(blob[landmarks] == group), influence, replace=False).tolist()
+    area_of_influence = csr_matrix((rng.random(len(rows)) + 0.1, (rows, cols)), shape=(len(reference), len(landmarks)))
+    hsne = HSNE(2)
+    hsne[0] = DataScale(num_scales=2, tmatrix=csr_matrix((len(reference), len(reference))))
+    hsne[1] = SubScale(scalenum=1, num_scales=2, tmatrix=csr_matrix((len(landmarks), len(landmarks))),
+                       lm_to_original=landmarks, lm_to_previous=landmarks,
+                       lm_weights=np.asarray(area_of_influence.sum(axis=0)).ravel(),
+                       previous_to_current=np.zeros(len(reference)), area_of_influence=area_of_influence)
+    model = Schnel(knn_method='exact', num_of_neighbours=5, prop_method=prop_method)
+    model.hsne_, model.labels_, model.reference_ = hsne, labels, reference
+    model.lengths_ = [len(reference)]
+    return model
+
+
+@pytest.fixture
+def blobs():
+    rng = np.random.default_rng(0)
+    centers = np.array([[0, 0, 0], [20, 20, 20]], dtype=np.float32)
+    blob = np.repeat([0, 1], 60)
+    reference = (centers[blob] + rng.normal(size=(120, 3))).astype(np.float32)
+    landmarks = np.concatenate([rng.choice(60, NUM_LANDMARKS // 2, replace=False),
+                                60 + rng.choice(60, NUM_LANDMARKS // 2, replace=False)])
+    labels = np.column_stack([blob, 7 - blob]).astype(np.int64)
+    new_points = (centers[[0, 1, 1, 0, 1]] + rng.normal(size=(5, 3))).astype(np.float32)
+    return reference, blob, landmarks, labels, new_points
+
+
+@pytest.mark.parametrize('prop_method', ['cluster', 'label'])
+def test_new_points_get_the_labels_of_their_blob(blobs, prop_method):
+    reference, blob, landmarks, labels, new_points = blobs
+    model = _fitted(reference, blob, landmarks, 3, labels, prop_method)
+    assigned = model.assign(new_points)
+    assert assigned.shape == (len(new_points), labels.shape[1]) and assigned.dtype == labels.dtype
+    np.testing.assert_array_equal(assigned, [[0, 7], [1, 6], [1, 6], [0, 7], [1, 6]])
+    np.testing.assert_array_equal(model.assign(new_points, batch_size=2), assigned)
+    np.testing.assert_array_equal(model.predict(new_points), assigned)
+
+
+def test_label_propagation_by_hand():
+    # Random points and labels, the labels of the landmark with the largest influence computed densely
+    rng = np.random.default_rng(2)
+    reference = rng.normal(size=(80, 4)).astype(np.float32)
+    landmarks = rng.choice(80, NUM_LANDMARKS, replace=False)
+    labels = rng.integers(0, 4, size=(80, 3))
+    model = _fitted(reference, np.zeros(80, dtype=int), landmarks, 4, labels, 'label')
+    new_points = rng.normal(size=(30, 4)).astype(np.float32)
+    distances = ((new_points[:, None, :].astype(np.float64) - reference[None]) ** 2).sum(axis=2)
+    nearest = np.argsort(distances, axis=1)[:, :5]
+    nearest_distances = np.take_along_axis(distances, nearest, axis=1)
+    nearest_distances -= nearest_distances[:, :1]
+    weights = np.exp(-nearest_distances / nearest_distances.mean(axis=1, keepdims=True))
+    influence = np.zeros((len(new_points), len(reference)))
+    np.put_along_axis(influence, nearest, weights / weights.sum(axis=1, keepdims=True), axis=1)
+    influence = influence @ model.hsne_[1].area_of_influence.toarray()
+    expected = labels[landmarks][influence.argmax(axis=1)]
+    np.testing.assert_array_equal(model.assign(new_points), expected)
+
+
+def test_invalid_input(blobs):
+    reference, blob, landmarks, labels, new_points = blobs
+    with pytest.raises(ValueError, match='fitted first'):
+        Schnel().assign(new_points)
+    model = _fitted(reference, blob, landmarks, 3, labels)
+    with pytest.raises(ValueError, match='features'):
+        model.assign(new_points[:, :2])
+    model.reference_ = None
+    with pytest.raises(ValueError, match='similarity matrix'):
+        model.assign(new_points)
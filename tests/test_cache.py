@@ -0,0 +1,86 @@
+# Hierarchy cache: keys, store and load round trips, eviction and corrupt entries
+# Run with: python -m pytest tests
+import os
+import numpy as np
+import pytest
+from schnel.clustering.cache import HierarchyCache, hierarchy_key
+
+
+def _scales(num_points, seed=0):
+    # Scale dicts shaped like the result of numpy_to_hsne.compute
+    rng = np.random.default_rng(seed)
+    scales = []
+    for size in (num_points, num_points // 4):
+        indptr = np.arange(size + 1, dtype=np.int64) * 2
+        scales.append({'size': size, 'tmatrix_indptr': indptr,
+                       'tmatrix_indices': rng.integers(0, size, size=2 * size).astype(np.int32),
+                       'tmatrix_data': rng.random(2 * size).astype(np.float32),
+                       'statistics': {'seconds': 1.0}})
+    scales[1]['lm_to_original'] = np.arange(num_points // 4, dtype=np.uint32)
+    return scales
+
+
+@pytest.fixture
+def cache(tmp_path):
+    return HierarchyCache(str(tmp_path / 'cache'))
+
+
+def test_key_depends_on_data_and_parameters():
+    data = np.arange(12, dtype=np.float32).reshape(4, 3)
+    key = hierarchy_key(data, seed=1, num_of_scales=3)
+    assert key == hierarchy_key(data.copy(), num_of_scales=3, seed=1)
+    assert key != hierarchy_key(data, seed=2, num_of_scales=3)
+    assert key != hierarchy_key(data.reshape(3, 4), seed=1, num_of_scales=3)
+    changed = data.copy()
+    changed[3, 2] += 1
+    assert key != hierarchy_key(changed, seed=1, num_of_scales=3)
+
+
+def test_store_and_load(cache):
+    scales = _scales(40)
+    cache.store('a', scales)
+    assert 'a' in cache and 'b' not in cache
+    loaded = cache.load('a')
+    assert len(loaded) == len(scales)
+    for stored, original in zip(loaded, scales):
+        assert stored['size'] == original['size'] and isinstance(stored['size'], int)
+        assert 'statistics' not in stored
+        for field in original:
+            if field not in ('size', 'statistics'):
+                np.testing.assert_array_equal(stored[field], original[field])
+                assert stored[field].dtype == original[field].dtype
+    assert cache.load('b') is None
+
+
+def test_evicts_least_recently_used(cache):
+    for num, key in enumerate('abc'):
+        cache.store(key, _scales(40, num))
+        os.utime(cache.path(key), (1000 + num, 1000 + num))
+    # Loading a marks it as the most recently used one
+    cache.load('a')
+    assert cache.keys() == ['a', 'c', 'b']
+    cache.max_size = os.path.getsize(cache.path('a')) + os.path.getsize(cache.path('c'))
+    cache.evict()
+    assert cache.keys() == ['a', 'c']
+    # A newly stored hierarchy is kept even if it alone exceeds max_size
+    cache.max_size = 1
+    cache.store('d', _scales(40, 3))
+    assert cache.keys() == ['d']
+    cache.clear()
+    assert cache.keys() == []
+
+
+@pytest.mark.parametrize('damage', ['truncate', 'garbage', 'empty'])
+def test_corrupt_entries_are_misses(cache, damage):
+    cache.store('a', _scales(400))
+    path = cache.path('a')
+    if damage == 'truncate':
+        with open(path, 'r+b') as handle:
+            handle.truncate(os.path.getsize(path) // 2)
+    else:
+        with open(path, 'wb') as handle:
+            handle.write(b'' if damage == 'empty' else np.random.default_rng(0).bytes(1000))
+    assert cache.load('a') is None
+    # The entry is overwritten by the recomputed hierarchy
+    cache.store('a', _scales(400))
+    assert cache.load('a')[0]['size'] == 400
@@ -0,0 +1,53 @@
+# The schnel command: input expansion, output paths and a run on small csv files
+# Run with: python -m pytest tests (the full run requires the compiled numpy_to_hsne module)
+import json
+import numpy as np
+import pytest
+from schnel.cli import expand_inputs, label_paths, main
+
+
+@pytest.fixture
+def inputs(tmp_path):
+    rng = np.random.default_rng(0)
+    centers = rng.uniform(-10, 10, size=(3, 4))
+    directory = tmp_path / 'in'
+    directory.mkdir()
+    for name, rows in (('a', 300), ('b', 200)):
+        data = rng.standard_normal((rows, 4)) + centers[rng.integers(0, 3, size=rows)]
+        np.savetxt(str(directory / (name + '.csv')), data, delimiter=',')
+    (directory / 'notes.txt').write_text('not an input')
+    return directory
+
+
+def test_expand_inputs(inputs, tmp_path):
+    files = expand_inputs([str(inputs)])
+    assert files == [str(inputs / 'a.csv'), str(inputs / 'b.csv')]
+    assert expand_inputs([str(inputs / 'b.csv'), str(inputs)], ext='.csv')[0] == str(inputs / 'b.csv')
+    with pytest.raises(ValueError, match='No input files'):
+        expand_inputs([str(inputs)], ext='.fcs')
+    with pytest.raises(ValueError, match='No such file'):
+        expand_inputs([str(tmp_path / 'missing.csv')])
+
+
+def test_label_paths(tmp_path):
+    assert label_paths(['x/a.csv', 'y/b.fcs'], 'out', 'npy') == ['out/a.labels.npy', 'out/b.labels.npy']
+    with pytest.raises(ValueError, match='same name'):
+        label_paths(['x/a.csv', 'y/a.fcs'], 'out')
+
+
+def test_invalid_inputs_exit_before_clustering(tmp_path, capsys):
+    assert main([str(tmp_path / 'missing.csv'), '-o', str(tmp_path / 'out')]) == 2
+    assert 'No such file' in capsys.readouterr().err
+    assert not (tmp_path / 'out').exists()
+    with pytest.raises(SystemExit):
+        main(['--knn-method', 'kd-tree', str(tmp_path)])
+
+
+def test_run(inputs, tmp_path):
+    pytest.importorskip("numpy_to_hsne")
+    out, stats = tmp_path / 'out', tmp_path / 'stats.json'
+    assert main([str(inputs), '-o', str(out), '--ext', '.csv', '--scales', '3', '--seed', '1', '--threads', '1',
+                 '--stats', str(stats)]) == 0
+    labels = [np.loadtxt(str(out / (name + '.labels.csv')), delimiter=',', dtype=np.int64) for name in 'ab']
+    assert [label.shape for label in labels] == [(300, 2), (200, 2)]
+    assert set(json.loads(stats.read_text())) >= {'total_time', 'scales', 'cache_key'}
@@ -0,0 +1,111 @@
+# Label propagation and data scale mappings of HSNE hierarchies, checked against the loops they replaced
+# Run with: python -m pytest tests
+import numpy as np
+import pytest
+from scipy.sparse import coo_matrix, csc_matrix, lil_matrix, random as sparse_random
+from schnel.clustering.HSNE import HSNE, DataScale, SubScale, _argmax_rows
+
+SIZES = (300, 80, 20)
+
+
+def _random_matrix(rng, rows, cols, density=0.1):
+    # Small integer weights, so that rows have ties, and some empty rows
+    return sparse_random(rows, cols, density=density, format='csr', random_state=rng,
+                         data_rvs=lambda num: rng.integers(1, 4, size=num).astype(np.float32))
+
+
+@pytest.fixture(scope='module')
+def hsne():
+    rng = np.random.default_rng(0)
+    hierarchy = HSNE(len(SIZES))
+    hierarchy[0] = DataScale(num_scales=len(SIZES), tmatrix=_random_matrix(rng, SIZES[0], SIZES[0]))
+    for num in range(1, len(SIZES)):
+        area_of_influence = _random_matrix(rng, SIZES[num - 1], SIZES[num], density=0.2)
+        hierarchy[num] = SubScale(scalenum=num, num_scales=len(SIZES),
+                                  tmatrix=_random_matrix(rng, SIZES[num], SIZES[num]),
+                                  lm_to_original=rng.choice(SIZES[0], SIZES[num], replace=False),
+                                  lm_to_previous=rng.choice(SIZES[num - 1], SIZES[num], replace=False),
+                                  lm_weights=np.asarray(area_of_influence.sum(axis=0)).ravel(),
+                                  previous_to_current=rng.integers(0, SIZES[num], size=SIZES[num - 1]),
+                                  area_of_influence=area_of_influence)
+    return hierarchy
+
+
+def _baseline_map_by_cluster(hierarchy, scalenumber, clustering):
+    # The column by column lil_matrix loop get_map_by_cluster used before
+    for scale in hierarchy.scales[scalenumber:0:-1]:
+        new_aoi = lil_matrix((scale.area_of_influence.shape[0], len(set(clustering))))
+        for i, label in enumerate(np.unique(clustering)):
+            new_aoi[:, i] = scale.area_of_influence * [[1] if label == x else [0] for x in clustering]
+        clustering = csc_matrix(new_aoi).argmax(axis=1).A1
+    return clustering
+
+
+def test_argmax_rows_matches_scipy():
+    rng = np.random.default_rng(1)
+    matrix = _random_matrix(rng, 500, 40)
+    assert (np.diff(matrix.indptr) == 0).any()
+    np.testing.assert_array_equal(_argmax_rows(matrix), np.asarray(matrix.argmax(axis=1)).ravel())
+    np.testing.assert_array_equal(_argmax_rows(matrix.tocsc()), np.asarray(matrix.argmax(axis=1)).ravel())
+
+
+def test_argmax_rows_duplicates_and_explicit_zeros():
+    # Duplicates are summed and explicit zeros are no entries: row 0 has (0, 2) + (0, 2) = 2 > (0, 1) = 1.5,
+    # row 1 only explicit zeros and row 2 a tie between columns 1 and 3
+    matrix = coo_matrix(([1, 1, 1.5, 0, 0, 2, 2], ([0, 0, 0, 1, 1, 2, 2], [2, 2, 1, 0, 3, 3, 1])), shape=(3, 4))
+    np.testing.assert_array_equal(_argmax_rows(matrix), [2, 0, 1])
+
+
+@pytest.mark.parametrize('scalenumber', [1, 2])
+def test_map_by_cluster_matches_baseline(hsne, scalenumber):
+    rng = np.random.default_rng(scalenumber)
+    clustering = rng.integers(0, 5, size=SIZES[scalenumber]) * 3
+    np.testing.assert_array_equal(hsne.get_map_by_cluster(scalenumber, clustering),
+                                  _baseline_map_by_cluster(hsne, scalenumber, clustering))
+
+
+def test_map_by_cluster_checks_labels(hsne):
+    with pytest.raises(ValueError):
+        hsne.get_map_by_cluster(2, np.zeros(SIZES[2] + 1))
+
+
+def _baseline_datascale_mappings(hierarchy, scalenumber):
+    # The dict of best representatives composed one data point at a time, as before
+    maps = None
+    for scale in hierarchy.scales[1:scalenumber + 1]:
+        if maps is None:
+            maps = dict(enumerate(scale.best_representatives))
+        else:
+            for key in maps:
+                maps[key] = scale.best_representatives[maps[key]]
+    return np.array(list(maps.values()))
+
+
+def test_datascale_mappings_match_baseline(hsne):
+    # Scale 2 first, so that scale 1 is served from the cache filled on the way and scale 2 again from its own entry
+    for scalenumber in (2, 1, 2):
+        mapping = hsne.get_datascale_mappings(scalenumber)
+        assert mapping.dtype == np.int32 and len(mapping) == SIZES[0]
+        np.testing.assert_array_equal(mapping, _baseline_datascale_mappings(hsne, scalenumber))
+
+
+def test_datascale_mappings_follow_replaced_scales(hsne):
+    hierarchy = HSNE(len(SIZES))
+    for num in range(len(SIZES)):
+        hierarchy[num] = hsne[num]
+    before = hierarchy.get_datascale_mappings(2).copy()
+    scale = hsne[2]
+    # Reversing the columns of the area of influence of scale 2 changes its best representatives
+    hierarchy[2] = SubScale(scalenum=2, num_scales=len(SIZES), tmatrix=scale.tmatrix,
+                            lm_to_original=scale.lm_to_original, lm_to_previous=scale.lm_to_previous,
+                            lm_weights=scale.lm_weights, previous_to_current=scale.previous_to_current,
+                            area_of_influence=scale.area_of_influence[:, ::-1])
+    np.testing.assert_array_equal(hierarchy.get_datascale_mappings(2),
+                                  _baseline_datascale_mappings(hierarchy, 2))
+    assert (hierarchy.get_datascale_mappings(2) != before).any()
+
+
+@pytest.mark.parametrize('scalenumber', [0, len(SIZES)])
+def test_datascale_mappings_of_invalid_scales(hsne, scalenumber):
+    with pytest.raises(ValueError):
+        hsne.get_datascale_mappings(scalenumber)
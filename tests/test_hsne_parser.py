@@ -0,0 +1,112 @@
+# Round trips of the .hsne formats through the C++ writers and the Python readers
+# Run with: python -m pytest tests (requires the compiled numpy_to_hsne module)
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import pytest
+from schnel.clustering.HSNE_parser import read_HSNE_binary, read_HSNE_buffers, read_HSNE_scale
+
+numpy_to_hsne = pytest.importorskip("numpy_to_hsne")
+
+NUM_SCALES = 3
+SUBSCALE_FIELDS = ('lm_to_original', 'lm_to_previous', 'lm_weights', 'previous_to_current')
+
+
+@pytest.fixture(scope='module')
+def data():
+    rng = np.random.default_rng(0)
+    centers = rng.uniform(-10, 10, size=(4, 5))
+    return (rng.standard_normal((800, 5)) + centers[rng.integers(0, 4, size=800)]).astype(np.float32)
+
+
+def _write(data, path, file_version, compress=False):
+    """
+    Computes the hierarchy of data, saves it to path and returns the scales handed over in memory.
+    """
+    return numpy_to_hsne.compute(data, NUM_SCALES, 1, 1.5, 10, 6, 1024, 1.5, 50, 50, True, True, str(path),
+                                 num_threads=1, file_version=file_version, compress=compress)
+
+
+def _assert_same(hsne, expected):
+    assert hsne.num_scales == expected.num_scales
+    for num in range(hsne.num_scales):
+        scale, other = hsne[num], expected[num]
+        assert (scale.tmatrix != other.tmatrix).nnz == 0
+        if num > 0:
+            for field in SUBSCALE_FIELDS:
+                np.testing.assert_array_equal(getattr(scale, field), getattr(other, field))
+            assert (scale.area_of_influence != other.area_of_influence).nnz == 0
+
+
+def test_v0_lazy_equals_eager(data, tmp_path):
+    path = tmp_path / 'v0.hsne'
+    scales = _write(data, path, 0)
+    eager = read_HSNE_binary(str(path), verbose=False, lazy=False)
+    lazy = read_HSNE_binary(str(path), verbose=False)
+    _assert_same(lazy, eager)
+    _assert_same(eager, read_HSNE_buffers(scales))
+    assert [lazy.scale_size(num) for num in range(NUM_SCALES)] == [len(scale['tmatrix_indptr']) - 1
+                                                                    for scale in scales]
+
+
+@pytest.mark.parametrize('compress', [False, True])
+def test_v2_round_trip(data, tmp_path, compress):
+    if compress:
+        pytest.importorskip("lz4")
+    path = tmp_path / 'v2.hsne'
+    scales = _write(data, path, 2, compress)
+    expected = read_HSNE_buffers(scales)
+    _assert_same(read_HSNE_binary(str(path), verbose=False, lazy=False), expected)
+    _assert_same(read_HSNE_binary(str(path), verbose=False), expected)
+    top = NUM_SCALES - 1
+    np.testing.assert_array_equal(read_HSNE_scale(str(path), top).lm_to_original, expected[top].lm_to_original)
+
+
+@pytest.mark.parametrize('file_version', [0, 2])
+def test_concurrent_lazy_loads(data, tmp_path, file_version):
+    path = tmp_path / 'concurrent.hsne'
+    expected = read_HSNE_buffers(_write(data, path, file_version))
+    with read_HSNE_binary(str(path), verbose=False) as hsne:
+        def load(num):
+            for _ in range(4):
+                hsne.unload(num)
+                assert (hsne[num].tmatrix != expected[num].tmatrix).nnz == 0
+        with ThreadPoolExecutor(8) as pool:
+            list(pool.map(load, [num % NUM_SCALES for num in range(16)]))
+        top = hsne[NUM_SCALES - 1]
+    # Scales loaded before the file was closed stay usable
+    assert hsne[NUM_SCALES - 1] is top
+
+
+@pytest.mark.parametrize('file_version', [0, 2])
+def test_truncated_file(data, tmp_path, file_version):
+    path = tmp_path / 'truncated.hsne'
+    _write(data, path, file_version)
+    with open(path, 'r+b') as handle:
+        handle.truncate(path.stat().st_size // 2)
+    with pytest.raises(ValueError, match='truncated or corrupt'):
+        hsne = read_HSNE_binary(str(path), verbose=False)
+        for num in range(hsne.num_scales):
+            hsne[num]  # pylint: disable=pointless-statement
+
+
+def test_corrupt_compressed_block(data, tmp_path):
+    pytest.importorskip("lz4")
+    path = tmp_path / 'corrupt.hsne'
+    _write(data, path, 2, compress=True)
+    raw = bytearray(path.read_bytes())
+    # The first block of the data scale holds its row pointers, which compress well. Its payload follows the
+    # 16 byte header of the block, the offset of the scale is the second field of the first entry of the table,
+    # which starts after the version, the flags and the number of scales
+    offset = int(np.frombuffer(bytes(raw[32:40]), dtype='<u8')[0])
+    raw[offset + 16:offset + 48] = b'\xff' * 32
+    path.write_bytes(bytes(raw))
+    with pytest.raises(ValueError, match='truncated or corrupt'):
+        read_HSNE_binary(str(path), verbose=False)[0]  # pylint: disable=expression-not-assigned
+
+
+def test_not_an_hsne_file(tmp_path):
+    path = tmp_path / 'random.hsne'
+    path.write_bytes(np.random.default_rng(0).bytes(1000))
+    with pytest.raises(ValueError, match='truncated or corrupt'):
+        read_HSNE_binary(str(path), verbose=False, lazy=False)
+
@@ -0,0 +1,78 @@
+# Exact neighbour search and precomputed neighbour graphs, checked against brute force distances
+# Run with: python -m pytest tests
+import numpy as np
+import pytest
+from schnel.clustering.knn import as_knn_graph, exact_knn, knn_graph
+
+NUM_NEIGHBOURS = 7
+
+
+def _brute_force(data, num_neighbours, rows=None):
+    # Every point first, then its nearest other points, with squared euclidean distances in float64
+    rows = np.arange(len(data)) if rows is None else np.asarray(rows)
+    dist = ((data[rows, None, :].astype(np.float64) - data[None, :, :]) ** 2).sum(axis=2)
+    dist[np.arange(len(rows)), rows] = -1
+    order = np.argsort(dist, axis=1, kind='stable')[:, :num_neighbours + 1]
+    return order, np.maximum(np.take_along_axis(dist, order, axis=1), 0)
+
+
+@pytest.fixture
+def data():
+    return np.random.default_rng(0).normal(size=(300, 5)).astype(np.float32)
+
+
+def test_exact_knn_matches_brute_force(data):
+    indices, distances = exact_knn(data, NUM_NEIGHBOURS)
+    expected_indices, expected_distances = _brute_force(data, NUM_NEIGHBOURS)
+    assert indices.shape == distances.shape == (len(data), NUM_NEIGHBOURS + 1)
+    assert indices.dtype == np.int32 and distances.dtype == np.float32
+    np.testing.assert_array_equal(indices, expected_indices)
+    np.testing.assert_allclose(distances, expected_distances, rtol=1e-4, atol=1e-4)
+
+
+def test_exact_knn_of_some_rows(data):
+    rows = [5, 0, 299, 5]
+    indices, distances = exact_knn(data, NUM_NEIGHBOURS, rows=rows)
+    expected_indices, expected_distances = _brute_force(data, NUM_NEIGHBOURS, rows)
+    np.testing.assert_array_equal(indices, expected_indices)
+    np.testing.assert_allclose(distances, expected_distances, rtol=1e-4, atol=1e-4)
+
+
+def test_duplicates_come_after_the_point_itself(data):
+    data[10] = data[3]
+    indices, distances = exact_knn(data, NUM_NEIGHBOURS)
+    assert indices[3, 0] == 3 and indices[3, 1] == 10
+    assert indices[10, 0] == 10 and indices[10, 1] == 3
+    assert distances[3, 1] == distances[10, 1] == 0
+
+
+def test_knn_graph_exact(data):
+    for graph, expected in zip(knn_graph(data, NUM_NEIGHBOURS, method='exact'), exact_knn(data, NUM_NEIGHBOURS)):
+        np.testing.assert_array_equal(graph, expected)
+    with pytest.raises(ValueError, match='Unknown knn method'):
+        knn_graph(data, NUM_NEIGHBOURS, method='kd-tree')
+
+
+def test_precomputed_graph(data):
+    # Euclidean distances without the points themselves, one more neighbour than needed
+    indices, distances = _brute_force(data, NUM_NEIGHBOURS + 1)
+    graph_indices, graph_distances = as_knn_graph(indices[:, 1:], np.sqrt(distances[:, 1:]), NUM_NEIGHBOURS)
+    expected_indices, expected_distances = exact_knn(data, NUM_NEIGHBOURS)
+    np.testing.assert_array_equal(graph_indices, expected_indices)
+    np.testing.assert_allclose(graph_distances, expected_distances, rtol=1e-4, atol=1e-4)
+    with pytest.raises(ValueError, match='fewer than'):
+        as_knn_graph(indices[:, 1:4], distances[:, 1:4], NUM_NEIGHBOURS)
+
+
+@pytest.mark.parametrize('num_points', [1, NUM_NEIGHBOURS - 1, NUM_NEIGHBOURS])
+def test_too_few_points(data, num_points):
+    with pytest.raises(ValueError, match='need more than %i points' % NUM_NEIGHBOURS):
+        exact_knn(data[:num_points], NUM_NEIGHBOURS)
+    with pytest.raises(ValueError, match='need more than %i points' % NUM_NEIGHBOURS):
+        knn_graph(data[:num_points], NUM_NEIGHBOURS, method='exact')
+
+
+def test_just_enough_points(data):
+    indices, _ = exact_knn(data[:NUM_NEIGHBOURS + 1], NUM_NEIGHBOURS)
+    assert (np.sort(indices, axis=1) == np.arange(NUM_NEIGHBOURS + 1)).all()
+    np.testing.assert_array_equal(indices[:, 0], np.arange(NUM_NEIGHBOURS + 1))
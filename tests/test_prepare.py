@@ -0,0 +1,43 @@
+# Preparation of the input of the pipeline, for arrays and files in either orientation
+# Run with: python -m pytest tests
+import numpy as np
+import pytest
+from schnel.algorithm import _prepare_input
+
+
+@pytest.fixture
+def data():
+    return np.random.default_rng(0).random((120, 30)).astype(np.float32)
+
+
+def test_feature_by_cell_files_match_cell_by_feature(tmp_path, data):
+    np.save(str(tmp_path / 'x.npy'), data)
+    np.savetxt(str(tmp_path / 'a.csv'), data[:70].T, delimiter=',')
+    np.save(str(tmp_path / 'b.npy'), np.ascontiguousarray(data[70:].T))
+    expected, expected_lens, _ = _prepare_input([str(tmp_path / 'x.npy')], p_comps=5,
+                                                transformation_method='arcsinh')
+    prepared, lens, projection = _prepare_input([str(tmp_path / 'a.csv'), str(tmp_path / 'b.npy')], p_comps=5,
+                                                transformation_method='arcsinh', cell_by_feature=False)
+    assert lens == [70, 120] and expected_lens == [120]
+    assert projection.n_components_ == 5
+    np.testing.assert_allclose(prepared, expected, rtol=1e-4, atol=1e-4)
+
+
+def test_feature_by_cell_files_without_pca(tmp_path, data):
+    np.savetxt(str(tmp_path / 'a.csv'), data.T, delimiter=',', fmt='%.8g')
+    prepared, lens, projection = _prepare_input(str(tmp_path / 'a.csv'), cell_by_feature=False)
+    assert lens == [120] and projection is None
+    np.testing.assert_allclose(prepared, data, rtol=1e-6)
+
+
+def test_feature_by_cell_files_with_different_features(tmp_path, data):
+    np.savetxt(str(tmp_path / 'a.csv'), data.T, delimiter=',')
+    np.savetxt(str(tmp_path / 'b.csv'), data[:, :-1].T, delimiter=',')
+    with pytest.raises(ValueError, match='features'):
+        _prepare_input([str(tmp_path / 'a.csv'), str(tmp_path / 'b.csv')], cell_by_feature=False)
+
+
+def test_feature_by_cell_array(data):
+    prepared, lens, _ = _prepare_input(np.ascontiguousarray(data.T), cell_by_feature=False)
+    assert lens == [30]
+    np.testing.assert_array_equal(prepared, data)
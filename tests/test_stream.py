@@ -0,0 +1,85 @@
+# Streaming of csv input into one float32 array, checked against np.loadtxt
+# Run with: python -m pytest tests
+import numpy as np
+import pytest
+from schnel.Data_Prep.stream import file_shapes, stream_to_numpy
+
+NUM_COLS = 6
+
+
+def _write_csv(path, data, header=False, blank_lines=()):
+    """
+    Writes data as csv with a line of column names if header is set and empty lines before the given rows.
+    """
+    lines = [','.join('c%i' % col for col in range(data.shape[1]))] if header else []
+    for num, row in enumerate(data):
+        if num in blank_lines:
+            lines.append('')
+        lines.append(','.join('%.6g' % value for value in row))
+    path.write_text('\n'.join(lines) + '\n')
+    return str(path)
+
+
+def _loadtxt(path, header=False):
+    return np.loadtxt(path, delimiter=',', skiprows=int(header), dtype=np.float32, ndmin=2)
+
+
+@pytest.fixture
+def data():
+    return np.random.default_rng(0).normal(size=(50, NUM_COLS)).astype(np.float32)
+
+
+@pytest.mark.parametrize('header', [False, True])
+@pytest.mark.parametrize('blank_lines', [(), (0, 17, 49)])
+def test_matches_loadtxt(tmp_path, data, header, blank_lines):
+    path = _write_csv(tmp_path / 'a.csv', data, header, blank_lines)
+    streamed, lengths = stream_to_numpy([path], csv_header=header, chunk_rows=8)
+    expected = _loadtxt(path, header)
+    assert lengths == [len(expected)]
+    assert streamed.dtype == np.float32 and streamed.flags.c_contiguous
+    np.testing.assert_array_equal(streamed, expected)
+
+
+def test_row_counts_are_upper_bounds(tmp_path, data):
+    path = _write_csv(tmp_path / 'a.csv', data, True, (3, 9))
+    assert file_shapes([path], csv_header=True) == [(len(data) + 2, NUM_COLS)]
+
+
+@pytest.mark.parametrize('feature_ids', [[4, 0, 2], slice(1, 4), np.array([5])])
+def test_feature_ids(tmp_path, data, feature_ids):
+    path = _write_csv(tmp_path / 'a.csv', data, blank_lines=(5,))
+    streamed, _ = stream_to_numpy([path], feature_ids=feature_ids, chunk_rows=16)
+    np.testing.assert_array_equal(streamed, _loadtxt(path)[:, feature_ids])
+
+
+def test_transformation(tmp_path, data):
+    path = _write_csv(tmp_path / 'a.csv', np.abs(data))
+    streamed, _ = stream_to_numpy([path], transformation='arcsinh', cofactor=5)
+    np.testing.assert_allclose(streamed, np.arcsinh(_loadtxt(path) / 5), rtol=1e-6)
+
+
+def test_non_finite_values(tmp_path, data):
+    data[7, 2] = np.nan
+    path = _write_csv(tmp_path / 'a.csv', data)
+    with pytest.raises(ValueError, match='NaN or Inf'):
+        stream_to_numpy([path])
+    streamed, _ = stream_to_numpy([path], check_finite=False)
+    assert np.isnan(streamed[7, 2])
+
+
+def test_different_numbers_of_columns(tmp_path, data):
+    paths = [_write_csv(tmp_path / 'a.csv', data), _write_csv(tmp_path / 'b.csv', data[:, :-1])]
+    with pytest.raises(ValueError, match='different numbers of columns'):
+        stream_to_numpy(paths)
+
+
+@pytest.mark.parametrize('num_threads', [1, 3])
+def test_several_files_in_threads(tmp_path, data, num_threads):
+    # Blank lines make the row counts of the files too large, later files are moved up over the gaps
+    paths = [_write_csv(tmp_path / 'a.csv', data[:20], True, (4,)),
+             _write_csv(tmp_path / 'b.csv', data[20:45], True),
+             _write_csv(tmp_path / 'c.csv', data[45:], True, (0, 2))]
+    streamed, lengths = stream_to_numpy(paths, feature_ids=[1, 3], csv_header=True, chunk_rows=7,
+                                        num_threads=num_threads)
+    assert lengths == [20, 25, 5]
+    np.testing.assert_array_equal(streamed, np.vstack([_loadtxt(path, True) for path in paths])[:, [1, 3]])